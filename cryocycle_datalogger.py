@@ -14,21 +14,57 @@ abs_path = os.path.dirname(os.path.abspath(__file__))
 if abs_path not in sys.path:
     sys.path.insert(0, abs_path)
 
-from drivers.tempcontroller_ctc100 import TempControl_CTC100
+from drivers.tempcontroller_ctc100 import TempControl_CTC100, QueryCancelled, LinkLost
 from drivers.generic_instrument_dependencies.generic_instrument import GenericInstrument
 from drivers.liveplotter_heavy import LivePlotAgent 
 from drivers.slack import Slack
+from drivers.alert_router import AlertRouter
+from drivers.columnar_logger import ColumnarLogger, ColumnarReader
+from drivers.columnar_rollups import RollupPipeline, RollupReader
+from drivers.cycle_scheduler import CycleScheduler, next_daily_time
+from drivers.threshold_monitor import ThresholdMonitor
+from drivers.cycle_checkpoint import CycleCheckpoint
+from drivers.simulated_ctc100 import VirtualClock, simulated_tempcontroller
+from drivers.ctc100_macros import CTC100MacroPipeline, MacroError
 
 json_matterhorn_config_path = ".json" 
 
 
 
+def make_tempcontroller(tempcontroller_config, log_dir = None):
+    """
+    TempControl_CTC100 from a config["tempcontroller"] block: init_args for the real
+    controller, or simulated = {"rate": ...} for a SimulatedCTC100, see drivers/simulated_ctc100.py.
+    record_trace = "file.trc" records every serial transaction under log_dir for replay.
+    """
+    simulated = tempcontroller_config.get("simulated")
+    if simulated:
+        tempcontroller = simulated_tempcontroller(clock = VirtualClock(**simulated))
+    else:
+        tempcontroller = TempControl_CTC100(**tempcontroller_config["init_args"])
+    trace_path = tempcontroller_config.get("record_trace")
+    if trace_path and log_dir:
+        os.makedirs(log_dir, exist_ok = True)
+        tempcontroller.start_recording(os.path.join(log_dir, trace_path))
+    return tempcontroller
+
+
 class CryoCycler:
 
-    def __init__(self, config_dir = config_relative_path):
+    def __init__(self, config_dir = config_relative_path, config = None, liveplotter = None, slack = None):
+        """
+        config: dict to use instead of config_dir/config.json. liveplotter/slack: shared
+        instances (e.g. from CryostatSupervisor), created here when not given.
+        """
 
         self.config_dir = config_dir
-        self.config = self.load_config('config.json')
+        self.data_logger = None
+        self.data_rollups = None
+        self.tempcontroller = None
+        self.macro_pipeline = None
+        self.liveplotter = liveplotter
+        self._owns_liveplotter = liveplotter is None
+        self.config = self.load_config('config.json') if config is None else config
         self.handshake()
 
         if self.tempcontroller: 
@@ -38,7 +74,15 @@ class CryoCycler:
             self.tempcontroller._auto_cycle_stop = None
             self.tempcontroller._auto_cycle_thread = None
 
-        self.slack = Slack(config_dir="config")
+        self._owns_slack = slack is None
+        ### alerts go out from a background thread, undelivered ones wait in the logging folder
+        self.slack = slack if slack is not None else Slack(config_dir="config", queue_path = os.path.join(getattr(self, "log_dir", "log/"), "slack_queue.json"))
+        ### repeated codes and bursts are folded into a periodic digest with the latest Tr/Tp, see config["alerts"]
+        self.alerts = AlertRouter(self.slack, readings = self.__latest_readings__,
+                                  name = self.tempcontroller._name if self.tempcontroller else None,
+                                  clock = self.tempcontroller.clock if self.tempcontroller else None,
+                                  log_dir = getattr(self, "log_dir", None),
+                                  **self.config.get("alerts", {}))
         
         # self.liveplot_tempcontroller()
 
@@ -50,34 +94,51 @@ class CryoCycler:
         return 
     
     def close(self):
+        self.stop_data_logging()
         if self.tempcontroller:
             self.tempcontroller.close()
             self.tempcontroller = None
         if self.liveplotter:
-            self.liveplotter.close()
+            if self._owns_liveplotter:
+                self.liveplotter.close()
             self.liveplotter = None
+        if getattr(self, "alerts", None) is not None:
+            self.alerts.close()
+        if getattr(self, "slack", None) is not None and self._owns_slack:
+            self.slack.close()
 
         self.__exit__(None, None, None)
         return
 
+    def __latest_readings__(self):
+        """ Tr/Tp of the last logged frame for the alert digest, no serial traffic """
+        if self.tempcontroller is None:
+            return {}
+        values, _ = self.tempcontroller.buffer.last()
+        if values is None:
+            return {}
+        return {name: float(values[self.tempcontroller.data_index[name.lower()]])
+                for name in ["Tr", "Tp"] if name.lower() in self.tempcontroller.data_index}
+
     def load_config(self, config_name=False):
+        """ Parsed config_dir/config_name, self.config is left alone """
         config_path = os.path.join(self.config_dir, config_name)
         with open(config_path, 'r') as f:
-            self.config = json.load(f)
-        return self.config
+            return json.load(f)
 
     def handshake(self):
         
         print("Trying to establish driver instantiations...")
         try:
-            self.liveplotter: LivePlotAgent = LivePlotAgent()
+            if self.liveplotter is None:
+                self.liveplotter: LivePlotAgent = LivePlotAgent()
             self.liveplot_refresh_rate = self.config["liveplotter"]["refresh_rate"]
 
-            self.tempcontroller: TempControl_CTC100 = TempControl_CTC100(**self.config["tempcontroller"]["init_args"])
+            self.log_dir = self.config["logging"]["relative_dir"]
+            self.tempcontroller: TempControl_CTC100 = make_tempcontroller(self.config["tempcontroller"], log_dir = self.log_dir)
             self.tempcontroller_macro_dir = os.path.join(self.config_dir, self.config["tempcontroller"]["macro_dir"])
             print(f"Loading temp controller macros from {self.tempcontroller_macro_dir}")
             self.load_tempcontroller_macros(self.tempcontroller_macro_dir)
-            self.log_dir = self.config["logging"]["relative_dir"]
 
             print("Driver instantiation successful!!!.")
             return 
@@ -85,15 +146,89 @@ class CryoCycler:
         except Exception as e:
             print(f"Error during driver instantiation: {e}")
 
-    def load_tempcontroller_macros(self, macro_dir):
-        macro_files = [f for f in os.listdir(macro_dir) if f.endswith('.txt')]
-        self.tempcontroller_macros = {}
-        for file in macro_files:
-            macro_name = os.path.splitext(file)[0]
-            with open(os.path.join(macro_dir, file), 'r') as f:
-                self.tempcontroller_macros[macro_name] = f.read()
+    def load_tempcontroller_macros(self, macro_dir, cryo_config = None):
+        """
+        Loads the macros of macro_dir into a CTC100MacroPipeline (parameters filled in
+        from cryo_config, validated) and returns {name: macro text}. Upload hashes
+        are kept in macro_hashes.json in the logging folder.
+        """
+        self.macro_pipeline = CTC100MacroPipeline(self.tempcontroller, macro_dir, cryo_config = cryo_config,
+                                                  cache_path = os.path.join(self.log_dir, "macro_hashes.json"))
+        self.tempcontroller_macros = self.macro_pipeline.texts()
         return self.tempcontroller_macros
 
+    def __run_step__(self, kind, stop_event, progress_callback, resume):
+        """
+        Runs the condensation or evaporation step. With tempcontroller.on_device_macros,
+        e.g. {"condensation": "aaa_condense"}, that step runs as a macro on the
+        controller and the host only supervises it. A step resumed after a host
+        restart then re-attaches to the macro if it still runs. Otherwise it runs
+        as the python procedure.
+
+        Once the macro has ended, the python procedure takes over in its checks step
+        (tr_checks, cond_checks), so a macro step ends on the same Tr/Tp conditions
+        and return codes as the host procedure. A macro that cannot be uploaded or
+        started puts the controller in a safe state and hard aborts (4, 5).
+        """
+        macro = self.config["tempcontroller"].get("on_device_macros", {}).get(kind)
+        run = self.tempcontroller.run_evaporation if kind == "evaporation" else self.tempcontroller.run_condensation
+        checks = "tr_checks" if kind == "evaporation" else "cond_checks"
+        past_macro = resume is not None and resume.get("resume_step") != macro ### restarted in the checks after it
+        if macro and self.macro_pipeline is not None and not past_macro:
+            try:
+                status = self.macro_pipeline.run(macro, stop_event = stop_event, progress_callback = progress_callback)
+            except MacroError as e:
+                print(f"Macro {macro} failed, setting the controller to a safe state: {e}")
+                self.tempcontroller.set_pid_off()
+                return 4 if kind == "evaporation" else 5
+            if status != 0:
+                return status
+            resume = {"resume_step": checks, "resume_elapsed_s": 0.}
+        return run(stop_event=stop_event, json_config_file=self.cryo_config, progress_callback = progress_callback, **(resume or {}))
+
+    def start_data_logging(self):
+        """
+        Streams every TempControl_CTC100 frame to disk under logging.relative_dir,
+        written in batches every data_logging_cycle_s by a background thread,
+        together with its 1 min / 10 min / 1 h min-max-mean rollups.
+        Starts the temp controller polling loop if it is not running yet.
+        """
+        if self.data_logger is not None:
+            print("Data logging already running.")
+            return self.data_logger
+
+        self.data_logger = ColumnarLogger(self.log_dir, self.tempcontroller.data_names,
+                                          flush_interval_s = self.data_logging_cycle_s).start()
+        self.data_rollups = RollupPipeline(self.log_dir, self.tempcontroller.data_names,
+                                           flush_interval_s = self.data_logging_cycle_s).start()
+        self.tempcontroller.add_frame_listener(self.data_logger.push)
+        self.tempcontroller.add_frame_listener(self.data_rollups.push)
+        if not self.tempcontroller.is_monitoring:
+            self.tempcontroller.start_logging(refresh_s = self.data_monitoring_refresh_s)
+        print(f"Logging temp controller data to {self.log_dir}")
+        return self.data_logger
+
+    def stop_data_logging(self):
+        if self.data_logger is None:
+            return
+        if self.tempcontroller:
+            self.tempcontroller.remove_frame_listener(self.data_logger.push)
+            self.tempcontroller.remove_frame_listener(self.data_rollups.push)
+        self.data_logger.stop()
+        self.data_rollups.stop()
+        self.data_logger = None
+        self.data_rollups = None
+        return
+
+    def open_history(self, rollups = False):
+        """
+        Memory-mapped reader over everything logged to logging.relative_dir.
+        rollups = True gives a RollupReader, which picks the tier from a point budget.
+        """
+        if rollups:
+            return RollupReader(self.log_dir)
+        return ColumnarReader(self.log_dir)
+
     def liveplot_tempcontroller(self):
 
         no_plots = 5
@@ -117,17 +252,24 @@ class CryoCycler:
     
     
     
-    def run_ctc100_automatic_cycle_thread(self, stop_event = None, evap_time = False, cond_time = False, json_location = None, slack_json_location = None): # function to run in thread (in the background)
+    def run_ctc100_automatic_cycle_thread(self, stop_event = None, evap_time = False, cond_time = False, json_location = None, slack_json_location = None, checkpoint_path = None): # function to run in thread (in the background)
         """
         Docstring for run_ctc100_automatic_cycle_thread
         
         :param evap_time: See the next  function for a clear discription of these
         :param cond_time: See the next  function for a clear discription of these
         
-        This function runs the cycle by checking every 10 minutes what time it is during the day in minutes. If the evap time or cond time are within ± 15min of that time, it starts the process.
+        This function runs the cycle from a timer heap (CycleScheduler): it computes the exact next fire time of the evaporation, the condensation and the daily reset (reseting_time_1) and sleeps until the earliest one. A process that fires more than time_within_range minutes late (e.g. because another one was still running) is skipped for the day.
+        
+        Tr is watched on every sample of the logging loop by a ThresholdMonitor: crossing Tr_cold_abort_temp, or evap_monitering_temp after an evaporation (helium run-out), wakes the scheduler within one sample period. The same checks also run every cycle_check_time as a fallback in case the logging loop is down.
         
         It also takes into consideration what happens if a leak or a sudden heating up of th ecryo after successfully evaporating. 
         
+        The state (ran-today flags, last evap/cond times and the running procedure and its step) is checkpointed to checkpoint_path (default: auto_cycle_checkpoint.json in the logging folder) on every transition. After a restart the flags are restored if no daily reset happened in between, and a procedure that was running is resumed in the step it was in, accounting for the time already spent there.
+        
+        If the controller gives no readings for longer than tempcontroller.outage_wait_s, the PIDs are set off, code 7 is alerted and the cycle stops.
+        Code 7 is also what the supervisor watchdog alerts when the cycle thread ends without being stopped.
+        
         
         
         """
@@ -143,6 +285,12 @@ class CryoCycler:
         
         self.tempcontroller.set_initial_input_config(self.cryo_config)
         self.tempcontroller.set_initial_output_config(self.cryo_config)
+        if self.macro_pipeline is not None and self.config["tempcontroller"].get("on_device_macros"):
+            try:
+                self.macro_pipeline.load(self.cryo_config) ### parameters from this cryo config
+                self.macro_pipeline.sync()
+            except MacroError as e:
+                print(f"Could not bring the controller macros up to date: {e}")
 
         
         
@@ -162,6 +310,7 @@ class CryoCycler:
             
         
 
+        clock = self.tempcontroller.clock # wall clock, or the virtual one of a simulated controller
         start_evap = evap_time * 60 # time in minutes
         start_cond = cond_time * 60 # time in minutes
         evap_ran_today = False 
@@ -169,96 +318,207 @@ class CryoCycler:
         monitor_after_evap = False
         t_condensation = None
         t_evap = None
+        late_limit_s = cycle_time_window * 60 # a scheduled process more than this late is skipped for the day
+
+        ### crash safe state, restored from the last checkpoint and saved again on every transition
+        if checkpoint_path is None:
+            checkpoint_path = os.path.join(self.log_dir, "auto_cycle_checkpoint.json")
+        checkpoint = CycleCheckpoint(checkpoint_path, clock = clock)
+        self._cycle_checkpoint = checkpoint
+        saved = checkpoint.load()
+        resume_kind, resume_args = None, None
+        if saved:
+            t_condensation = saved.get("t_condensation")
+            t_evap = saved.get("t_evap")
+            last_reset = next_daily_time(reset_time_for_new_day_1, now = clock.time()) - 24 * 3600
+            if saved.get("saved_at", 0) >= last_reset: # no daily reset since, the flags still hold
+                evap_ran_today = saved.get("evap_ran_today", False)
+                cond_ran_today = saved.get("cond_ran_today", False)
+                monitor_after_evap = saved.get("monitor_after_evap", False)
+            phase = saved.get("phase")
+            if phase in ["evaporation", "condensation", "runout_condensation"] and saved.get("step"):
+                resume_kind = {"evaporation": "evaporation", "condensation": "condensation", "runout_condensation": "runout"}[phase]
+                resume_args = {"resume_step": saved["step"], "resume_elapsed_s": clock.time() - saved["step_started"]}
+                if phase == "runout_condensation":
+                    monitor_after_evap, cond_ran_today = True, False
+                print(f"Resuming {phase} from checkpoint in step '{saved['step']}' ({resume_args['resume_elapsed_s']/60:.0f} min in)")
+
+        def save_state(**changes):
+            checkpoint.save(evap_ran_today = evap_ran_today, cond_ran_today = cond_ran_today, monitor_after_evap = monitor_after_evap,
+                            t_condensation = t_condensation, t_evap = t_evap, **changes)
+
+        def on_step(step):
+            checkpoint.save(step = step, step_started = clock.time())
+
+        if resume_kind is None:
+            save_state(phase = None, step = None)
+
+        ### exact fire times for every process, the thread sleeps until the earliest one is due
+        scheduler = CycleScheduler(clock = clock)
+        self._cycle_scheduler = scheduler
+        scheduler.schedule(next_daily_time(start_evap, now = clock.time(), grace_s = late_limit_s), "evaporation")
+        scheduler.schedule(next_daily_time(start_cond, now = clock.time(), grace_s = late_limit_s), "condensation")
+        scheduler.schedule(next_daily_time(reset_time_for_new_day_1, now = clock.time()), "reset")
+        scheduler.schedule_in(0, "safety_check")
+        if resume_kind is not None:
+            scheduler.schedule(0, resume_kind, resume_args) # fire time 0 so it runs before anything else that is due
+        
+        ### Tr is also watched on every sample of the logging loop, a crossing wakes the scheduler straight away
+        if not self.tempcontroller.is_monitoring:
+            self.tempcontroller.start_logging(refresh_s = self.data_monitoring_refresh_s)
+        monitor = ThresholdMonitor(self.tempcontroller.data_names)
+        self.threshold_monitor = monitor
+        self.tempcontroller.add_frame_listener(monitor.push)
+        monitor.add_level_trigger("Tr", Tr_abort_temp_thresh, lambda *args: scheduler.schedule_in(0, "tr_abort"),
+                                  direction = "above", name = "Tr abort")
+        runout_trigger = None
+        if monitor_after_evap and not cond_ran_today and resume_kind is None: # restored mid-day, keep watching for run-out
+            runout_trigger = monitor.add_level_trigger("Tr", Tr_monitoring_temperature_thresh,
+                                                       lambda *args: scheduler.schedule_in(0, "runout"),
+                                                       direction = "above", name = "Tr helium run-out")
+            scheduler.schedule_in(0, "monitor")
     
         
-        while not stop_event.is_set():
-            
-            
-            if float(self.tempcontroller.get_channel_value(channel="Tr")) > Tr_abort_temp_thresh:
-                """Message error slack channel"""
-                print("Tr way too high, please check before running automatic cryo cycle")
-                self.slack.send_message_to_slack(error_code = 6, json_slack=self.slack_config)
-                return 6
-            
+        try:
+            with self.tempcontroller.cancel_on(stop_event): ### a stop request also interrupts pending reads
+                while True:
+                    event = scheduler.wait_next(stop_event)
+                    if event is None:
+                        break
+                    fire_time, kind, resume = event
+                    late_s = clock.time() - fire_time
             
-            now = self.tempcontroller.get_local_system_time() # local time of system (bound to internet) in minutes
+                    if self.tempcontroller.get_snapshot_value(channel="Tr") > Tr_abort_temp_thresh:
+                        """Message error slack channel"""
+                        print("Tr way too high, please check before running automatic cryo cycle")
+                        self.alerts.send_message_to_slack(error_code = 6, json_slack=self.slack_config)
+                        stop_event.set() ### alerted already, the supervisor watchdog is not to report it again
+                        return 6
             
             
-            if reset_time_for_new_day_1 < now < reset_time_for_new_day_2: # reset at new day 2:00-4:00am giving a window incase condensation is aborting late
-                evap_ran_today = False # flags to allow running of scheduled processes only once per day
-                cond_ran_today = False
-                monitor_after_evap = False
+                    if kind == "safety_check": # periodic fallback in case the logging loop is down
+                        scheduler.schedule_in(time_between_time_of_day_check, "safety_check")
             
-            cond_ok = (t_condensation is not None) and ((time.time() - t_condensation) > time_since_last_cond) # when code runs for the first time, it doesnt evap and goes straight to condensation when the time is right
+                    elif kind == "reset": # reset at new day (reseting_time_1), fires late if a process was still running then
+                        evap_ran_today = False # flags to allow running of scheduled processes only once per day
+                        cond_ran_today = False
+                        monitor_after_evap = False
+                        scheduler.cancel("monitor")
+                        if runout_trigger is not None:
+                            monitor.remove_trigger(runout_trigger)
+                            runout_trigger = None
+                        scheduler.schedule(next_daily_time(reset_time_for_new_day_1, now = fire_time + 60), "reset")
+                        save_state()
             
-            if abs(now - start_evap) <= cycle_time_window and (not evap_ran_today) and cond_ok: # check if time is within 15 min of scheduled evap time + check if evap has not run today + check if condensation has been running for at least 4h
-                print("Starting scheduled evaporation process")
-                evap_status = self.tempcontroller.run_evaporation(stop_event=stop_event, json_config_file=self.cryo_config)
-                if evap_status != 0:
-                    self.slack.send_message_to_slack(error_code= evap_status, json_slack=self.slack_config)
-
-                if evap_status == 3:
-                    cond_ran_today = True
-                if evap_status == 4:
-                    
-                    print("Hard abort. Auto cycler stopped, please check cryo.")
-                    self.tempcontroller.stop_ctc100_automatic_cycle()
-                    return    
-                t_evap = time.time()
-                print(f"Time: {datetime.now.strftime("%H:%M")}")
-                evap_ran_today = True
-                monitor_after_evap = True # Monitor evap temp throughout the day to make sure the cryo doesnt run out of helium
+                    elif kind == "evaporation":
+                        if resume is None:
+                            scheduler.schedule(next_daily_time(start_evap, now = fire_time + 60), "evaporation")
+                        cond_ok = (t_condensation is not None) and ((clock.time() - t_condensation) > time_since_last_cond) # when code runs for the first time, it doesnt evap and goes straight to condensation when the time is right
+                
+                        if resume is None and late_s > late_limit_s:
+                            print(f"Scheduled evaporation is {late_s/60:.0f} min late, skipping it today")
+                        elif resume is None and (evap_ran_today or not cond_ok): # check if evap has not run today + check if condensation has been running for at least 4h
+                            print("Skipping scheduled evaporation (already ran today or not condensed for long enough)")
+                        else:
+                            print("Starting scheduled evaporation process" if resume is None else "Resuming evaporation process")
+                            save_state(phase = "evaporation", step = None)
+                            evap_status = self.__run_step__("evaporation", stop_event, on_step, resume)
+                            save_state(phase = None, step = None)
+                            if evap_status != 0:
+                                self.alerts.send_message_to_slack(error_code= evap_status, json_slack=self.slack_config)
+
+                            if evap_status == 3:
+                                cond_ran_today = True
+                            if evap_status == 4:
+                        
+                                print("Hard abort. Auto cycler stopped, please check cryo.")
+                                stop_event.set()
+                                return evap_status
+                            t_evap = clock.time()
+                            print(f"Time: {clock.now().strftime('%H:%M')}")
+                            evap_ran_today = True
+                            monitor_after_evap = True # Monitor evap temp throughout the day to make sure the cryo doesnt run out of helium
+                            ### run-out is caught within one sample by the trigger, the periodic check is only a fallback
+                            runout_trigger = monitor.add_level_trigger("Tr", Tr_monitoring_temperature_thresh,
+                                                                       lambda *args: scheduler.schedule_in(0, "runout"),
+                                                                       direction = "above", name = "Tr helium run-out")
+                            scheduler.schedule_in(time_between_time_of_day_check, "monitor")
+                            save_state()
                 
                 
-            if monitor_after_evap and (not cond_ran_today):
-                Tr = float(self.tempcontroller.get_channel_value(channel="Tr"))
-                if Tr > Tr_monitoring_temperature_thresh:
-                    print("Tr > 3K after evaporation -> starting immediate condensation") # If helium runout, start condensation now, and wont start again when cond time is there. Send alert message with hold time 
-                    print(f"Time: {datetime.now.strftime("%H:%M")}")
-                    monitor_cond_status = self.tempcontroller.run_condensation(stop_event=stop_event, json_config_file=self.cryo_config)
-                    if monitor_cond_status != 0:
-                        self.slack.send_message_to_slack(error_code= monitor_cond_status, json_slack=self.slack_config)
-
-                    t_condensation = time.time()
-                    cond_ran_today = True
+                    elif kind in ["monitor", "runout"] and monitor_after_evap and (not cond_ran_today):
+                        Tr = self.tempcontroller.get_snapshot_value(channel="Tr")
+                        if resume is not None or Tr > Tr_monitoring_temperature_thresh:
+                            print("Tr > 3K after evaporation -> starting immediate condensation") # If helium runout, start condensation now, and wont start again when cond time is there. Send alert message with hold time 
+                            print(f"Time: {clock.now().strftime('%H:%M')}")
+                            save_state(phase = "runout_condensation", step = None)
+                            monitor_cond_status = self.__run_step__("condensation", stop_event, on_step, resume)
+                            if monitor_cond_status != 0:
+                                self.alerts.send_message_to_slack(error_code= monitor_cond_status, json_slack=self.slack_config)
+
+                            t_condensation = clock.time()
+                            cond_ran_today = True
                     
-                    held_s = time.time() - t_evap
-                    print(f"Held cryo for {held_s/3600:.2f} hours")
-                    if monitor_cond_status == 5:
-                        print("Hard aborted condensation process. Stopping auto cycler.")
-                        self.tempcontroller.stop_ctc100_automatic_cycle()
-                        return
+                            save_state(phase = None, step = None)
+                            held_s = clock.time() - t_evap if t_evap is not None else 0.
+                            print(f"Held cryo for {held_s/3600:.2f} hours")
+                            if monitor_cond_status == 5:
+                                print("Hard aborted condensation process. Stopping auto cycler.")
+                                stop_event.set()
+                                return monitor_cond_status
                     
                     
-                    """Slack notification: Evaporation held for {held_s/3600:.2f} hours, immediate condensation started.
-                    """
+                            """Slack notification: Evaporation held for {held_s/3600:.2f} hours, immediate condensation started.
+                            """
                     
-                    monitor_after_evap = False
-                
+                            monitor_after_evap = False
+                            scheduler.cancel("monitor")
+                            if runout_trigger is not None:
+                                monitor.remove_trigger(runout_trigger)
+                                runout_trigger = None
+                        elif kind == "monitor":
+                            scheduler.schedule_in(time_between_time_of_day_check, "monitor")
                 
                 
-            
-            if abs(now - start_cond) <= cycle_time_window and (not cond_ran_today): # check if time is within 15 min of scheduled cond time + check if cond has not run today
-                print("Starting scheduled condensation process")
-                t_condensation = time.time()
-                cond_status = self.tempcontroller.run_condensation(stop_event=stop_event, json_config_file=self.cryo_config)
-                self.slack.send_message_to_slack(error_code= cond_status, json_slack=self.slack_config)
-                cond_ran_today = True
-                print(f"Time: {datetime.now.strftime("%H:%M")}")
-                if cond_status == 5:
-                        print("Hard aborted condensation process. Stopping auto cycler.")
-                        self.tempcontroller.stop_ctc100_automatic_cycle()
-                        return
-                
-                
-            stop_event.wait(time_between_time_of_day_check)
-            # time.sleep(60*10) # Check every 10 minutes
+                    elif kind == "condensation":
+                        if resume is None:
+                            scheduler.schedule(next_daily_time(start_cond, now = fire_time + 60), "condensation")
+                        if resume is None and late_s > late_limit_s:
+                            print(f"Scheduled condensation is {late_s/60:.0f} min late, skipping it today")
+                        elif resume is not None or not cond_ran_today: # check if cond has not run today
+                            print("Starting scheduled condensation process" if resume is None else "Resuming condensation process")
+                            if resume is None:
+                                t_condensation = clock.time()
+                            save_state(phase = "condensation", step = None)
+                            cond_status = self.__run_step__("condensation", stop_event, on_step, resume)
+                            self.alerts.send_message_to_slack(error_code= cond_status, json_slack=self.slack_config)
+                            cond_ran_today = True
+                            save_state(phase = None, step = None)
+                            print(f"Time: {clock.now().strftime('%H:%M')}")
+                            if cond_status == 5:
+                                    print("Hard aborted condensation process. Stopping auto cycler.")
+                                    stop_event.set()
+                                    return cond_status
                 
+
+        except QueryCancelled:
+            print("Auto cycle stopped during an instrument read, setting the controller to a safe state")
+            self.tempcontroller.set_pid_off()
+            return 1
+        except LinkLost as e: ### no readings for longer than tempcontroller.outage_wait_s
+            status = self.tempcontroller.__link_lost_abort__("Auto cycle", e, 7)
+            self.alerts.send_message_to_slack(error_code = status, json_slack=self.slack_config)
+            if stop_event is not None:
+                stop_event.set()
+            return status
+        finally:
+            self.tempcontroller.remove_frame_listener(monitor.push)
+
         print("Auto cycle thread exiting cleanly")
         return
     
     
-    def run_ctc100_automatic_cycle(self, start_evaporation_time: int, start_condensation_time: int, json_cryo_config_path, json_cryo_slack_config_path):
+    def run_ctc100_automatic_cycle(self, start_evaporation_time: int, start_condensation_time: int, json_cryo_config_path, json_cryo_slack_config_path, checkpoint_path = None):
         
         """
         
@@ -276,6 +536,8 @@ class CryoCycler:
         
         Make sure to run this where the condition cycle happens first.
         
+        The cycle state is checkpointed to checkpoint_path (default: auto_cycle_checkpoint.json in the logging folder), so restarting the program with the same call resumes where it was, including a half-done evaporation or condensation.
+        
         """
         
         
@@ -289,7 +551,7 @@ class CryoCycler:
         
 
         
-        t = threading.Thread(target=self.run_ctc100_automatic_cycle_thread, args=(stop_event, start_evaporation_time, start_condensation_time, json_cryo_config_path, json_cryo_slack_config_path), daemon=True)
+        t = threading.Thread(target=self.run_ctc100_automatic_cycle_thread, args=(stop_event, start_evaporation_time, start_condensation_time, json_cryo_config_path, json_cryo_slack_config_path, checkpoint_path), daemon=True)
         self._auto_cycle_thread = t
         t.start()
         
@@ -308,6 +570,9 @@ class CryoCycler:
             return
         
         stop_event.set()
+        scheduler = getattr(self, "_cycle_scheduler", None)
+        if scheduler is not None:
+            scheduler.wake()
         # Optional: wait for clean exit
         t.join(timeout=join_timeout)
 
@@ -0,0 +1,238 @@
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cryocycle_datalogger import CryoCycler, config_relative_path
+from drivers.liveplotter_heavy import LivePlotAgent
+from drivers.slack import Slack
+
+
+class CryostatSupervisor:
+    """
+    Runs several cryostats from one process, one CryoCycler (and so one
+    TempControl_CTC100 on its own port) per entry of config["cryostats"]:
+
+        {"logging": {"relative_dir": "log/"},
+         "liveplotter": {"refresh_rate": 1},
+         "watchdog_s": 30,
+         "alerts": {"dedupe_window_s": 600, "max_per_window": 5, "digest_interval_s": 600},
+         "cryostats": {
+            "matterhorn": {"tempcontroller": {"init_args": {"address": "ASRL3::INSTR", "name": "matterhorn"},
+                                              "macro_dir": "ctc100/macros"},
+                           "cryo_config": "ctc100/matterhorn/matterhorn_configuration.json",
+                           "slack_config": "ctc100/matterhorn/slack_integration.json",
+                           "auto_cycle": {"evap_time": 7, "cond_time": 20}}}}
+
+    Shared: the Slack client, the live plotter and the log root (each cryostat
+    logs to <relative_dir>/<name>/). Isolated: every cryostat connects, polls
+    (its own logging thread per port, so sampling latency does not add up over
+    fridges) and cycles on its own threads. A cryostat that fails to connect or
+    whose logging loop dies is reported in status() and retried by the watchdog,
+    the others carry on. An auto cycle that ends without being stopped (by the
+    user or one of its own aborts, which alert themselves) is alerted with code 7
+    and reported in status(), but not restarted: the cryostat needs a look first.
+    stop() stops the auto cycles, the watchdog and the logging, close() also
+    disconnects.
+    """
+
+    def __init__(self, config_dir = config_relative_path, config_name = "supervisor.json"):
+        self.config_dir = config_dir
+        with open(os.path.join(config_dir, config_name), 'r') as f:
+            self.config = json.load(f)
+        self.log_root = self.config["logging"]["relative_dir"]
+        self.watchdog_s = float(self.config.get("watchdog_s", 30))
+
+        self.slack = Slack(config_dir = config_dir, queue_path = os.path.join(self.log_root, "slack_queue.json"))
+        self.liveplotter = None
+        if "liveplotter" in self.config:
+            try:
+                self.liveplotter = LivePlotAgent()
+            except Exception as e:
+                print(f"Live plotter unavailable, running without it: {e}")
+
+        self.cyclers = {}
+        self.errors = {}
+        self.restarts = {}
+        self.cycle_alerted = set() ### cryostats whose dead auto cycle was alerted already
+        self._watchdog_stop = threading.Event()
+        self._watchdog_thread = None
+        self.connect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+    def __cryostat_config__(self, name):
+        """ config a CryoCycler expects, built from the cryostat entry and the shared blocks """
+        cryostat = self.config["cryostats"][name]
+        return {"tempcontroller": cryostat["tempcontroller"],
+                "liveplotter": self.config.get("liveplotter", {"refresh_rate": 1}),
+                "alerts": self.config.get("alerts", {}),
+                "logging": {"relative_dir": os.path.join(self.log_root, name)}}
+
+    def __connect_one__(self, name):
+        cycler = CryoCycler(config_dir = self.config_dir, config = self.__cryostat_config__(name),
+                            liveplotter = self.liveplotter, slack = self.slack)
+        if cycler.tempcontroller is None:
+            raise ConnectionError(f"could not instantiate the temp controller of {name}")
+        return cycler
+
+    def connect(self, names = None):
+        """ Connects the cryostats (default: all not connected yet) in parallel, a failure only affects its own """
+        names = [name for name in (names or self.config["cryostats"]) if name not in self.cyclers]
+        if not names:
+            return self.cyclers
+        with ThreadPoolExecutor(max_workers = len(names)) as pool:
+            futures = {name: pool.submit(self.__connect_one__, name) for name in names}
+            for name, future in futures.items():
+                try:
+                    self.cyclers[name] = future.result()
+                    self.errors.pop(name, None)
+                    print(f"[{name}] connected")
+                except Exception as e:
+                    self.errors[name] = repr(e)
+                    print(f"[{name}] failed to connect: {e}")
+        return self.cyclers
+
+    def __start_one__(self, name):
+        cycler = self.cyclers[name]
+        cycler.start_data_logging()
+        auto_cycle = self.config["cryostats"][name].get("auto_cycle")
+        thread = getattr(cycler, "_auto_cycle_thread", None)
+        if auto_cycle and not (thread and thread.is_alive()):
+            cycler.run_ctc100_automatic_cycle(start_evaporation_time = auto_cycle["evap_time"],
+                                              start_condensation_time = auto_cycle["cond_time"],
+                                              json_cryo_config_path = self.config["cryostats"][name]["cryo_config"],
+                                              json_cryo_slack_config_path = self.config["cryostats"][name]["slack_config"])
+        return
+
+    def start(self):
+        """ Starts logging (and the auto cycle where configured) on every connected cryostat, then the watchdog """
+        for name in list(self.cyclers):
+            try:
+                self.__start_one__(name)
+            except Exception as e:
+                self.errors[name] = repr(e)
+                print(f"[{name}] failed to start: {e}")
+        if self._watchdog_thread is None or not self._watchdog_thread.is_alive():
+            self._watchdog_stop.clear()
+            self._watchdog_thread = threading.Thread(target = self.__watchdog__, daemon = True)
+            self._watchdog_thread.start()
+        return self
+
+    def __watchdog__(self):
+        while not self._watchdog_stop.wait(self.watchdog_s):
+            self.connect() ### retries the ones that failed
+            for name, cycler in list(self.cyclers.items()):
+                try:
+                    tempcontroller = cycler.tempcontroller
+                    if cycler.data_logger is None or (tempcontroller is not None and not tempcontroller.is_monitoring):
+                        self.restarts[name] = self.restarts.get(name, 0) + 1
+                        print(f"[{name}] logging loop down, restarting it (restart {self.restarts[name]})")
+                        if cycler.data_logger is not None:
+                            tempcontroller.start_logging(refresh_s = cycler.data_monitoring_refresh_s)
+                        else:
+                            self.__start_one__(name)
+                except Exception as e:
+                    self.errors[name] = repr(e)
+                    print(f"[{name}] watchdog could not recover it: {e}")
+                self.__check_auto_cycle__(name, cycler)
+        return
+
+    def __check_auto_cycle__(self, name, cycler):
+        """ Alerts once when a configured auto cycle thread died without being stopped """
+        thread = getattr(cycler, "_auto_cycle_thread", None)
+        stop_event = getattr(cycler, "_auto_cycle_stop", None)
+        if not self.config["cryostats"][name].get("auto_cycle") or thread is None:
+            return
+        if thread.is_alive():
+            self.cycle_alerted.discard(name)
+            return
+        if (stop_event is not None and stop_event.is_set()) or name in self.cycle_alerted:
+            return
+        self.cycle_alerted.add(name)
+        self.errors[name] = "auto cycle stopped unexpectedly"
+        print(f"[{name}] auto cycle thread died, not restarting it, please check the cryostat")
+        try:
+            slack_config = getattr(cycler, "slack_config", None)
+            if slack_config is None:
+                with open(os.path.join(self.config_dir, self.config["cryostats"][name]["slack_config"]), 'r') as f:
+                    slack_config = json.load(f)
+            cycler.alerts.send_message_to_slack(error_code = 7, json_slack = slack_config,
+                                                text = "Auto cycle stopped unexpectedly and was not restarted, please check the cryostat")
+        except Exception as e:
+            print(f"[{name}] could not alert the dead auto cycle: {e}")
+        return
+
+    def status(self):
+        """ {name: {...}} health of every configured cryostat """
+        status = {}
+        for name in self.config["cryostats"]:
+            cycler = self.cyclers.get(name)
+            tempcontroller = cycler.tempcontroller if cycler is not None else None
+            last_frame_age_s = None
+            if tempcontroller is not None:
+                _, timestamp = tempcontroller.buffer.last()
+                if timestamp is not None:
+                    last_frame_age_s = tempcontroller.clock.time() - timestamp
+            thread = getattr(cycler, "_auto_cycle_thread", None)
+            status[name] = {"connected": bool(tempcontroller is not None and tempcontroller.connected),
+                            "reconnects": tempcontroller.reconnects if tempcontroller is not None else 0,
+                            "monitoring": bool(tempcontroller is not None and tempcontroller.is_monitoring),
+                            "last_frame_age_s": last_frame_age_s,
+                            "auto_cycle_running": bool(thread and thread.is_alive()),
+                            "restarts": self.restarts.get(name, 0),
+                            "error": self.errors.get(name)}
+        return status
+
+    def latest(self):
+        """ {name: {channel: value}} latest frame of every connected cryostat """
+        frames = {}
+        for name, cycler in self.cyclers.items():
+            tempcontroller = cycler.tempcontroller
+            values, _ = tempcontroller.buffer.last() if tempcontroller is not None else (None, None)
+            if values is None:
+                continue
+            frames[name] = dict(zip(tempcontroller.data_names, values.tolist()))
+        return frames
+
+    def stop(self):
+        self._watchdog_stop.set()
+        if self._watchdog_thread is not None:
+            self._watchdog_thread.join(timeout = 5)
+        for name, cycler in self.cyclers.items():
+            thread = getattr(cycler, "_auto_cycle_thread", None)
+            if thread and thread.is_alive():
+                cycler.stop_ctc100_automatic_cycle()
+            try:
+                cycler.stop_data_logging()
+                if cycler.tempcontroller is not None:
+                    cycler.tempcontroller.stop_logging()
+            except Exception as e:
+                print(f"[{name}] error while stopping the logging: {e}")
+        return self
+
+    def close(self):
+        self.stop()
+        for name, cycler in list(self.cyclers.items()):
+            try:
+                cycler.close()
+            except Exception as e:
+                print(f"[{name}] error while closing: {e}")
+        self.cyclers = {}
+        if self.liveplotter is not None:
+            self.liveplotter.close()
+            self.liveplotter = None
+        self.slack.close()
+        return
+
+
+if __name__ == '__main__':
+    with CryostatSupervisor() as supervisor:
+        print("\n>>>> USE SUPERVISOR OBJECT AS sv <<<<\n")
+        sv = supervisor
+        import code; code.interact(local=locals())
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import json
+import threading
+
+from generic_instrument_dependencies.clock import SYSTEM_CLOCK
+from slack import SEVERITIES
+
+
+'''
+Alert router in front of the Notifier (drivers/slack.py)
+
+During an incident the cycle can report the same code again and again. The
+router sends the first one straight away and folds the rest into a periodic
+digest:
+
+    dedupe      the same code on the same channel within dedupe_window_s
+    rate limit  more than max_per_window alerts to one channel within rate_window_s
+
+Critical codes (see Notifier.severity, 4/5/6/7 by default) bypass both: they
+are sent every time, and do not count towards the rate limit.
+
+Everything held back is counted and sent as one digest message per channel
+every digest_interval_s, with the latest readings (e.g. Tr/Tp). The digest is
+routed like the most severe code it holds back:
+
+    [matterhorn] 7 alert(s) held back in the last 10 min:
+      code 2 x5: Evaporation start conditions never met
+      code 3 x2: Evaporation soft aborted
+    Tr = 0.412, Tp = 38.1
+
+A channel is one notification config, i.e. its slack_url and sinks. The
+config is the one Notifier.notify takes (error_code_messages, severity,
+sinks, routes), the router settings come from the "alerts" block of the
+cryostat config:
+
+    slack = Slack(config_dir, queue_path = "log/slack_queue.json")
+    alerts = AlertRouter(slack, readings = lambda: {"Tr": 0.41, "Tp": 38.1}, name = "matterhorn",
+                         log_dir = "log/matterhorn",   ### relative logfile sinks write here
+                         **config.get("alerts", {}))   ### dedupe_window_s, max_per_window, ...
+    alerts.send_message_to_slack(error_code = 4, json_slack = slack_config)   ### same call as Slack
+    ...
+    alerts.close()   ### last digest, then slack.close()
+'''
+
+
+class __Channel__:
+    """ Per webhook state: when each code was last sent, recent sends, what is held back """
+
+    def __init__(self, json_slack):
+        self.json_slack = json_slack
+        self.last_sent = {} ### code -> time
+        self.sends = [] ### times of the recent sends, for the rate limit
+        self.held = {} ### code -> count since the last digest
+        self.held_since = None
+
+
+class AlertRouter:
+    """ Dedupe, rate limit and digest in front of Notifier.notify, critical codes always go out at once """
+
+    def __init__(self, slack, readings = None, name = None, dedupe_window_s = 600., max_per_window = 5,
+                 rate_window_s = 600., digest_interval_s = 600., clock = None, log_dir = None):
+        """
+        readings() -> {label: value} for the digest, called on the digest thread, should not do I/O.
+        log_dir: logging folder of the cryostat, where relative logfile sinks write.
+        """
+        self.slack = slack
+        self.readings = readings
+        self.name = name
+        self.log_dir = log_dir
+        self.dedupe_window_s = dedupe_window_s
+        self.max_per_window = max_per_window
+        self.rate_window_s = rate_window_s
+        self.digest_interval_s = digest_interval_s
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.channels = {} ### slack_url -> __Channel__
+        self.sent = 0
+        self.suppressed = 0
+        self.digests = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return
+
+    @staticmethod
+    def channel_key(json_slack):
+        return json.dumps([json_slack.get("slack_url"), json_slack.get("sinks")], sort_keys = True)
+
+    def send_message_to_slack(self, error_code: int, json_slack = False, text = None):
+        """
+        Drop-in for Slack.send_message_to_slack: sends now, or holds the alert for the next digest.
+        text replaces the code's error_code_messages entry (a digest still counts it under the code).
+        """
+        if not json_slack or error_code is None:
+            return self.slack.send_message_to_slack(error_code = error_code, json_slack = json_slack)
+        code = str(error_code)
+        if text is None and self.slack.message(code, json_slack) is None: ### silenced code, or an info code with nothing to say
+            return None
+        if self.slack.severity(code, json_slack) == "critical":
+            self.sent += 1
+            return self.slack.notify(code, json_slack, text = text, source = self.name, log_dir = self.log_dir)
+
+        now = self.clock.monotonic()
+        with self._lock:
+            channel = self.channels.setdefault(self.channel_key(json_slack), __Channel__(json_slack))
+            channel.json_slack = json_slack
+            channel.sends = [t for t in channel.sends if now - t < self.rate_window_s]
+            duplicate = code in channel.last_sent and now - channel.last_sent[code] < self.dedupe_window_s
+            limited = len(channel.sends) >= self.max_per_window
+            if duplicate or limited:
+                channel.held[code] = channel.held.get(code, 0) + 1
+                if channel.held_since is None:
+                    channel.held_since = now
+                self.suppressed += 1
+                self.__start_digests__()
+                return None
+            channel.last_sent[code] = now
+            channel.sends.append(now)
+            self.sent += 1
+        return self.slack.notify(code, json_slack, text = text, source = self.name, log_dir = self.log_dir)
+
+    def __start_digests__(self):
+        """ Called with self._lock held """
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target = self.__digest_loop__, name = "alert digest", daemon = True)
+            self._thread.start()
+        return
+
+    def __digest_loop__(self):
+        while not self.clock.wait(self._stop, self.digest_interval_s):
+            self.flush()
+        return
+
+    def __readings_line__(self):
+        if self.readings is None:
+            return ""
+        try:
+            readings = self.readings() or {}
+        except Exception as e:
+            return f"\n(readings unavailable: {e})"
+        return "\n" + ", ".join(f"{label} = {value:.4g}" if isinstance(value, (int, float)) else f"{label} = {value}"
+                                for label, value in readings.items())
+
+    def digest_text(self, channel, now = None):
+        now = self.clock.monotonic() if now is None else now
+        messages = channel.json_slack.get("error_code_messages", {})
+        total = sum(channel.held.values())
+        minutes = (now - channel.held_since) / 60 if channel.held_since is not None else 0
+        header = f"[{self.name}] " if self.name else ""
+        lines = [f"{header}{total} alert(s) held back in the last {minutes:.0f} min:"]
+        for code, count in sorted(channel.held.items()):
+            lines.append(f"  code {code} x{count}: {messages.get(code) or 'no message configured'}")
+        return "\n".join(lines) + self.__readings_line__()
+
+    def flush(self):
+        """ Sends the digest of every channel that has alerts held back, returns how many were sent """
+        now = self.clock.monotonic()
+        with self._lock:
+            due = []
+            for channel in self.channels.values():
+                if channel.held:
+                    ### routed like the most severe code it holds back
+                    code = max(channel.held, key = lambda code: SEVERITIES.index(self.slack.severity(code, channel.json_slack)))
+                    due.append((channel.json_slack, code, self.digest_text(channel, now)))
+                    channel.held = {}
+                    channel.held_since = None
+        for json_slack, code, text in due:
+            ### a digest goes out whatever the rate limit, it is what keeps the channel readable
+            self.slack.notify(code, json_slack, text = text, log_dir = self.log_dir)
+            self.digests += 1
+        return len(due)
+
+    def stats(self):
+        with self._lock:
+            held = sum(sum(channel.held.values()) for channel in self.channels.values())
+        return {"sent": self.sent, "suppressed": self.suppressed, "held": held, "digests": self.digests}
+
+    def close(self):
+        """ Stops the digest thread, whatever is still held back goes out as a last digest """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout = 2)
+        self.flush()
+        return
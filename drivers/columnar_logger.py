@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import threading
+from datetime import datetime, timedelta
+from queue import Queue, Empty, Full
+import numpy as np
+
+
+'''
+Append-only columnar storage for instrument frames (e.g. TempControl_CTC100.data)
+
+Layout on disk:
+
+    <root_dir>/
+        index.json                  sidecar index of segment start/end times
+        20261017_000000/            one segment per day (or per change of channel names)
+            meta.json               {"names": [...], "files": {...}, "dtype": "<f8", ...}
+            timestamps.f64          unix time of every frame
+            Tp.f64, Tr.f64, ...     one raw little-endian column per channel
+
+Columns are plain raw arrays so readers can np.memmap them without parsing.
+ColumnarLogger.push only drops the frame into a queue, a background thread
+batches the queue to disk every flush_interval_s, so the acquisition thread
+never waits on the disk.
+
+ColumnarReader uses index.json to find the segments overlapping a time range
+and returns np.memmap slices, so nothing is loaded into RAM until used.
+'''
+
+DTYPE = np.dtype('<f8')
+TIMESTAMP_FILE = "timestamps.f64"
+META_FILE = "meta.json"
+INDEX_FILE = "index.json"
+
+
+def column_filename(name):
+    """ Channel name -> safe file name, e.g. 'In 1' -> 'In_1.f64' """
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(name)) + ".f64"
+
+
+def segment_name(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y%m%d_%H%M%S")
+
+
+def load_index(root_dir):
+    path = os.path.join(root_dir, INDEX_FILE)
+    if not os.path.exists(path):
+        return {"segments": []}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_index(root_dir, index):
+    """ Atomic write so a reader never sees half an index """
+    path = os.path.join(root_dir, INDEX_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent = 2)
+    os.replace(tmp_path, path)
+    return
+
+
+class ColumnarLogger:
+
+    def __init__(self, root_dir, names, flush_interval_s = 20, queue_size = 100000, verbose = False):
+        self.root_dir = root_dir
+        self.names = list(names)
+        self.flush_interval_s = flush_interval_s
+        self.verbose = verbose
+
+        self._queue = Queue(maxsize = queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._segment_dir = None
+        self._segment_day = None
+        self._files = {}
+        self._write_lock = threading.Lock()
+        self._index = None
+        self.frames_written = 0
+        self.frames_dropped = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return self
+        os.makedirs(self.root_dir, exist_ok = True)
+        self._stop.clear()
+        self._thread = threading.Thread(target = self.__writer_loop__, daemon = True, name = "Columnar logger thread")
+        self._thread.start()
+        return self
+
+    def stop(self, timeout = 10.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout = timeout)
+            self._thread = None
+        return self
+
+    def push(self, timestamp, values):
+        """ Non-blocking, safe to call from the acquisition thread (frame listener signature) """
+        try:
+            self._queue.put_nowait((timestamp, np.asarray(values, dtype = DTYPE)))
+        except Full:
+            self.frames_dropped += 1
+        return
+
+    def set_names(self, names):
+        """ Channel names changed (e.g. after a reconnect), next frame opens a new segment """
+        self._queue.put(("names", list(names)))
+        return self
+
+    def __writer_loop__(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.flush_interval_s)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Columnar logger failed to write batch: {e}")
+        self.flush()
+        self.__close_segment__()
+        if self.verbose:
+            print("Columnar logger thread exiting")
+        return
+
+    def flush(self):
+        """ Drains the queue and writes it as one batch per segment """
+        with self._write_lock:
+            self.__drain__()
+        return self
+
+    def __drain__(self):
+        times, rows = [], []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                break
+            if item[0] == "names":
+                self.__write_batch__(times, rows)
+                times, rows = [], []
+                self.names = item[1]
+                self.__close_segment__()
+                continue
+            times.append(item[0])
+            rows.append(item[1])
+        self.__write_batch__(times, rows)
+        return
+
+    def __write_batch__(self, times, rows):
+        if not times:
+            return
+        times = np.asarray(times, dtype = DTYPE)
+        block = np.vstack(rows).T ### (channels x frames)
+
+        ### split the batch wherever the local day changes so segments rotate daily
+        days = [datetime.fromtimestamp(t).date() for t in times]
+        start = 0
+        for i in range(1, len(days) + 1):
+            if i == len(days) or days[i] != days[start]:
+                self.__append__(times[start:i], block[:, start:i], days[start])
+                start = i
+        return
+
+    def __append__(self, times, block, day):
+        if self._segment_dir is None or day != self._segment_day:
+            self.__open_segment__(times[0], day)
+
+        self._files[TIMESTAMP_FILE].write(times.tobytes())
+        for name, column in zip(self.names, block):
+            self._files[column_filename(name)].write(np.ascontiguousarray(column, dtype = DTYPE).tobytes())
+        for f in self._files.values():
+            f.flush()
+        self.frames_written += len(times)
+        self.__on_batch_written__(self._segment_dir, times)
+        return
+
+    def __on_batch_written__(self, segment_dir, times):
+        ### keep the sidecar index up to date, one small atomic write per batch
+        if self._index is None:
+            self._index = load_index(self.root_dir)
+        name = os.path.basename(segment_dir)
+        segments = self._index["segments"]
+        if not segments or segments[-1]["dir"] != name:
+            segments.append({"dir": name, "start": float(times[0]), "end": float(times[-1]), "frames": 0})
+        entry = segments[-1]
+        entry["end"] = max(entry["end"], float(times[-1]))
+        entry["frames"] += len(times)
+        save_index(self.root_dir, self._index)
+        return
+
+    def __open_segment__(self, first_timestamp, day):
+        self.__close_segment__()
+        self._segment_dir = os.path.join(self.root_dir, segment_name(first_timestamp))
+        self._segment_day = day
+        os.makedirs(self._segment_dir, exist_ok = True)
+
+        meta = {
+            "names": self.names,
+            "files": {name: column_filename(name) for name in self.names},
+            "timestamps": TIMESTAMP_FILE,
+            "dtype": DTYPE.str,
+            "created": first_timestamp,
+        }
+        with open(os.path.join(self._segment_dir, META_FILE), 'w') as f:
+            json.dump(meta, f, indent = 2)
+
+        self._files = {TIMESTAMP_FILE: open(os.path.join(self._segment_dir, TIMESTAMP_FILE), 'ab')}
+        for name in self.names:
+            filename = column_filename(name)
+            self._files[filename] = open(os.path.join(self._segment_dir, filename), 'ab')
+        if self.verbose:
+            print(f"Columnar logger writing to {self._segment_dir}")
+        return
+
+    def __close_segment__(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        self._segment_dir = None
+        self._segment_day = None
+        return
+
+
+
+class ColumnarReader:
+    """
+    Read side of ColumnarLogger. Every read returns np.memmap slices, one per
+    segment, so asking for 30 days of Tr only touches the pages actually used.
+
+        reader = ColumnarReader("log/")
+        for times, tr in reader.read("Tr", t_start, t_end):
+            ...
+        nights = reader.read_daily_window("Tr", "02:00", "08:00", days = 30)
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.refresh()
+
+    def refresh(self):
+        """ Reloads index.json, rebuilding it from the segment folders if it is missing """
+        self._meta = {}
+        self.index = load_index(self.root_dir)
+        if not self.index["segments"] and os.path.isdir(self.root_dir):
+            self.index = self.rebuild_index()
+        return self
+
+    def rebuild_index(self):
+        segments = []
+        for name in sorted(os.listdir(self.root_dir)):
+            segment_dir = os.path.join(self.root_dir, name)
+            if not os.path.exists(os.path.join(segment_dir, META_FILE)):
+                continue
+            times = self.__timestamps__(name)
+            if len(times) == 0:
+                continue
+            segments.append({"dir": name, "start": float(times[0]), "end": float(times[-1]), "frames": len(times)})
+        index = {"segments": segments}
+        save_index(self.root_dir, index)
+        return index
+
+    @property
+    def names(self):
+        """ Channel names of the newest segment """
+        if not self.index["segments"]:
+            return []
+        return self.__segment_meta__(self.index["segments"][-1]["dir"])["names"]
+
+    def __segment_meta__(self, segment):
+        if segment not in self._meta:
+            with open(os.path.join(self.root_dir, segment, META_FILE), 'r') as f:
+                self._meta[segment] = json.load(f)
+        return self._meta[segment]
+
+    def __frames__(self, segment):
+        ### a crash can leave columns a batch apart, only trust what every column has
+        meta = self.__segment_meta__(segment)
+        files = [meta["timestamps"]] + list(meta["files"].values())
+        sizes = [os.path.getsize(os.path.join(self.root_dir, segment, f)) for f in files]
+        return min(sizes) // np.dtype(meta["dtype"]).itemsize
+
+    def __memmap__(self, segment, filename, frames):
+        meta = self.__segment_meta__(segment)
+        if frames == 0:
+            return np.zeros(0, dtype = meta["dtype"])
+        return np.memmap(os.path.join(self.root_dir, segment, filename), dtype = meta["dtype"],
+                         mode = 'r', shape = (frames,))
+
+    def __timestamps__(self, segment):
+        frames = self.__frames__(segment)
+        return self.__memmap__(segment, self.__segment_meta__(segment)["timestamps"], frames)
+
+    def __column_file__(self, segment, channel):
+        files = self.__segment_meta__(segment)["files"]
+        if channel in files:
+            return files[channel]
+        for name, filename in files.items():
+            if name.lower() == str(channel).lower():
+                return filename
+        return None
+
+    def segments(self, t_start = None, t_end = None):
+        """ Index entries of the segments overlapping [t_start, t_end] """
+        return [seg for seg in self.index["segments"]
+                if (t_end is None or seg["start"] <= t_end) and (t_start is None or seg["end"] >= t_start)]
+
+    def read(self, channel, t_start = None, t_end = None):
+        """
+        List of (timestamps, values) memmap slices, one per segment overlapping
+        [t_start, t_end] (unix seconds, None = open ended). Zero copy.
+        """
+        out = []
+        for seg in self.segments(t_start, t_end):
+            segment = seg["dir"]
+            filename = self.__column_file__(segment, channel)
+            if filename is None:
+                continue
+            times = self.__timestamps__(segment)
+            lo = 0 if t_start is None else np.searchsorted(times, t_start, side = 'left')
+            hi = len(times) if t_end is None else np.searchsorted(times, t_end, side = 'right')
+            if hi <= lo:
+                continue
+            values = self.__memmap__(segment, filename, len(times))
+            out.append((times[lo:hi], values[lo:hi]))
+        return out
+
+    def read_concat(self, channel, t_start = None, t_end = None):
+        """ Same as read but joined into two plain arrays (this one copies) """
+        chunks = self.read(channel, t_start, t_end)
+        if not chunks:
+            return np.zeros(0), np.zeros(0)
+        return (np.concatenate([np.asarray(t) for t, _ in chunks]),
+                np.concatenate([np.asarray(v) for _, v in chunks]))
+
+    def read_daily_window(self, channel, start = "00:00", end = "23:59", days = 1, now = None):
+        """
+        The same local time-of-day window over the last `days` days, e.g.
+        read_daily_window("Tr", "02:00", "08:00", days = 30).
+        Returns a list of (day, [(timestamps, values), ...]) oldest first.
+        """
+        now = datetime.now() if now is None else now
+        h0, m0 = [int(x) for x in start.split(":")]
+        h1, m1 = [int(x) for x in end.split(":")]
+        out = []
+        for d in range(days - 1, -1, -1):
+            day = (now - timedelta(days = d)).date()
+            t0 = datetime(day.year, day.month, day.day, h0, m0).timestamp()
+            t1 = datetime(day.year, day.month, day.day, h1, m1).timestamp()
+            if t1 < t0: ### window over midnight, e.g. 22:00 -> 06:00
+                t1 += 24 * 3600
+            out.append((day, self.read(channel, t0, t1)))
+        return out
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+
+from columnar_logger import ColumnarLogger, ColumnarReader
+
+
+'''
+Multi-resolution min/max/mean/count rollups of the columnar history
+
+RollupPipeline is a frame listener like ColumnarLogger.push. Every sample
+updates a running min/max/sum/count per channel for each tier (1 min, 10 min,
+1 h by default), which is O(1) per sample whatever the history length. When a
+sample lands in a new bucket the closed bucket is handed to a ColumnarLogger
+writing under <root_dir>/rollup_<tier>s/, so rollups are stored in the same
+segment format as the raw data, right next to it.
+
+RollupReader picks the tier to read from a point budget, e.g. a month of Tr
+for an 800 px wide plot comes from the 1 h tier instead of 2.6M raw samples.
+'''
+
+ROLLUP_TIERS_S = (60, 600, 3600)
+ROLLUP_STATS = ("min", "max", "mean", "count")
+
+
+def rollup_dirname(tier_s):
+    return f"rollup_{int(tier_s)}s"
+
+
+def rollup_column(name, stat):
+    return f"{name}.{stat}"
+
+
+class __RollupTier__:
+
+    def __init__(self, tier_s, channels):
+        self.tier_s = tier_s
+        self.bucket = None
+        self.mins = np.full(channels, np.inf)
+        self.maxs = np.full(channels, -np.inf)
+        self.sums = np.zeros(channels)
+        self.counts = np.zeros(channels)
+
+    def add(self, timestamp, values):
+        """ Returns (bucket_start, row) of the bucket this sample closed, else None """
+        bucket = np.floor(timestamp / self.tier_s) * self.tier_s
+        closed = None
+        if self.bucket is not None and bucket != self.bucket:
+            closed = self.close()
+        if self.bucket is None:
+            self.bucket = bucket
+
+        valid = ~np.isnan(values)
+        np.fmin(self.mins, values, out = self.mins, where = valid)
+        np.fmax(self.maxs, values, out = self.maxs, where = valid)
+        np.add(self.sums, values, out = self.sums, where = valid)
+        self.counts += valid
+        return closed
+
+    def close(self):
+        if self.bucket is None:
+            return None
+        with np.errstate(invalid = 'ignore', divide = 'ignore'):
+            means = self.sums / self.counts
+        empty = self.counts == 0
+        mins = np.where(empty, np.nan, self.mins)
+        maxs = np.where(empty, np.nan, self.maxs)
+        ### columns are interleaved per channel: min, max, mean, count
+        row = np.column_stack((mins, maxs, means, self.counts)).ravel()
+        closed = (self.bucket, row)
+
+        self.bucket = None
+        self.mins.fill(np.inf)
+        self.maxs.fill(-np.inf)
+        self.sums.fill(0.)
+        self.counts.fill(0.)
+        return closed
+
+
+class RollupPipeline:
+
+    def __init__(self, root_dir, names, tiers_s = ROLLUP_TIERS_S, flush_interval_s = 20, verbose = False):
+        self.root_dir = root_dir
+        self.names = list(names)
+        self.tiers_s = tuple(tiers_s)
+        columns = [rollup_column(name, stat) for name in self.names for stat in ROLLUP_STATS]
+        self._tiers = [__RollupTier__(tier_s, len(self.names)) for tier_s in self.tiers_s]
+        self.writers = {
+            tier_s: ColumnarLogger(os.path.join(root_dir, rollup_dirname(tier_s)), columns,
+                                   flush_interval_s = flush_interval_s, verbose = verbose)
+            for tier_s in self.tiers_s
+        }
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return
+
+    def start(self):
+        for writer in self.writers.values():
+            writer.start()
+        return self
+
+    def stop(self):
+        ### hand over the partial buckets so nothing measured is lost on shutdown
+        for tier in self._tiers:
+            closed = tier.close()
+            if closed is not None:
+                self.writers[tier.tier_s].push(*closed)
+        for writer in self.writers.values():
+            writer.stop()
+        return self
+
+    def push(self, timestamp, values):
+        """ Frame listener, O(1) per sample and tier """
+        values = np.asarray(values, dtype = float)
+        for tier in self._tiers:
+            closed = tier.add(timestamp, values)
+            if closed is not None:
+                self.writers[tier.tier_s].push(*closed)
+        return
+
+
+class RollupReader:
+    """
+    Budgeted reads over the raw history and its rollup tiers.
+
+        reader = RollupReader("log/")
+        out = reader.read("Tr", t_start, t_end, max_points = 800)
+        out["tier_s"], out["times"], out["min"], out["max"], out["mean"], out["count"]
+
+    Uses the finest resolution that still fits in max_points (raw data when it
+    fits, otherwise the first tier coarse enough). tier_s is None for raw data.
+    """
+
+    def __init__(self, root_dir, tiers_s = ROLLUP_TIERS_S):
+        self.root_dir = root_dir
+        self.tiers_s = tuple(sorted(tiers_s))
+        self.raw = ColumnarReader(root_dir)
+        self.tiers = {}
+        for tier_s in self.tiers_s:
+            tier_dir = os.path.join(root_dir, rollup_dirname(tier_s))
+            if os.path.isdir(tier_dir):
+                self.tiers[tier_s] = ColumnarReader(tier_dir)
+
+    def refresh(self):
+        self.raw.refresh()
+        for reader in self.tiers.values():
+            reader.refresh()
+        return self
+
+    def raw_points(self, t_start, t_end):
+        """ Raw frames in [t_start, t_end] estimated from the segment index """
+        points = 0.
+        for seg in self.raw.segments(t_start, t_end):
+            span = max(seg["end"] - seg["start"], 1e-9)
+            overlap = min(seg["end"], t_end) - max(seg["start"], t_start)
+            points += seg["frames"] * max(min(overlap / span, 1.), 0.)
+        return points
+
+    def choose_tier(self, t_start, t_end, max_points):
+        if self.raw_points(t_start, t_end) <= max_points:
+            return None
+        for tier_s in self.tiers_s:
+            if tier_s in self.tiers and (t_end - t_start) / tier_s <= max_points:
+                return tier_s
+        ### nothing fits, coarsest tier available is the best we can do
+        return max(self.tiers) if self.tiers else None
+
+    def read(self, channel, t_start, t_end, max_points = 1000):
+        tier_s = self.choose_tier(t_start, t_end, max_points)
+        if tier_s is None:
+            times, values = self.raw.read_concat(channel, t_start, t_end)
+            return {"tier_s": None, "times": times, "min": values, "max": values,
+                    "mean": values, "count": np.ones_like(values)}
+
+        reader = self.tiers[tier_s]
+        out = {"tier_s": tier_s}
+        for stat in ROLLUP_STATS:
+            times, out[stat] = reader.read_concat(rollup_column(channel, stat), t_start, t_end)
+        out["times"] = times
+        return out
@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import hashlib
+import threading
+
+from generic_instrument_dependencies.clock import SYSTEM_CLOCK
+from generic_instrument_dependencies.io_scheduler import SAFETY
+from generic_instrument_dependencies.shadow_registers import parse_readback
+
+
+'''
+Macro pipeline for the CTC100's on-board macro engine
+
+A macro file (config/ctc100/macros/*.txt) carries its tunables as #PARAM value
+lines. The pipeline fills them in from the cryo json config, checks the
+result and uploads it only when its content hash differs from the last upload.
+The controller then runs the condensation / evaporation step on its own. The
+host only starts it, watches its status and kills it on request.
+
+    macros = CTC100MacroPipeline(tc, "config/ctc100/macros", cryo_config, cache_path = "log/macro_hashes.json")
+    macros.sync()                      ### uploads what changed, returns the names sent
+    macros.start("aaa_condense")
+    macros.status()                    ### {"running": True, "name": "aaa_condense", "raw": ...}
+    macros.run("aaa_evaporate", stop_event)   ### start + supervise, 0 when done, 1 when stopped
+
+Parameter values, later ones win:
+    1. the #PARAM lines of the file
+    2. CONFIG_PARAMETERS, read from the cryo config (e.g. the PID setpoints)
+    3. the optional "macros" block of the cryo config:
+           "macros": {"HPUMP_ON_TR_THRES": 5,                  ### every macro
+                      "aaa_condense": {"CONDENSATION_WAIT_MIN": 45}}   ### one macro
+'''
+
+
+### Remote macro commands. They follow the macro section of the CTC100 manual
+### as we read it, check them against the manual of your firmware before use.
+MACRO_DEFINE = 'macro.define "{name}"' ### the lines that follow are the macro body
+MACRO_END = "macro.end"
+MACRO_RUN = 'macro.run "{name}"'
+MACRO_KILL = 'macro.kill "{name}"'
+MACRO_STATUS = "macro.status?" ### name of the running macro, "idle" when none
+
+### controller side limits, conservative until checked on the device
+MAX_MACRO_BYTES = 16384
+MAX_LINE_LENGTH = 120
+
+DEFINE_RE = re.compile(r"^\s*#([A-Za-z_][A-Za-z0-9_]*)\s+(\S+)\s*$")
+REFERENCE_RE = re.compile(r"#([A-Za-z_][A-Za-z0-9_]*)")
+NAME_RE = re.compile(r"^\s*name\s+'([^']+)'\s*$")
+STRING_RE = re.compile(r"\"[^\"]*\"|'[^']*'")
+HASH_PREFIX = "'sha256 "
+
+### macro parameter -> value taken from the cryo config, skipped when the config lacks it
+CONFIG_PARAMETERS = {
+    "HPUMP_ON_K": lambda config: config["outputs"]["hpump"]["PID"]["Setpoint"],
+    "SWITCH_ON_T": lambda config: config["outputs"]["switch"]["PID"]["Setpoint"],
+}
+
+
+class MacroError(ValueError):
+    """ A macro that does not parse, fails validation or could not be uploaded """
+    pass
+
+
+def format_value(value):
+    """ 40.0 -> '40', 3.8 -> '3.8', strings are kept as they are """
+    if isinstance(value, bool):
+        raise MacroError(f"Macro parameters are numbers, got {value!r}")
+    if isinstance(value, (int, float)):
+        return f"{value:g}"
+    return str(value).strip()
+
+
+def is_comment(line):
+    return line.lstrip().startswith("'")
+
+
+class CTC100Macro:
+    """ One macro: its text, the name it registers under and its #PARAM values """
+
+    def __init__(self, text, source = None):
+        self.text = text.replace("\r\n", "\n")
+        self.source = source
+        self.name = None
+        self.params = {} ### PARAM -> value string, in file order
+        for line in self.text.split("\n"):
+            if is_comment(line):
+                continue
+            match = NAME_RE.match(line)
+            if match and self.name is None:
+                self.name = match.group(1)
+            match = DEFINE_RE.match(line)
+            if match:
+                self.params[match.group(1)] = match.group(2)
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r') as f:
+            return cls(f.read(), source = path)
+
+    def __repr__(self):
+        return f"CTC100Macro({self.name}, {self.hash})"
+
+    def references(self):
+        """ Every #PARAM used outside its own definition, comments and strings """
+        used = set()
+        for line in self.text.split("\n"):
+            if is_comment(line) or DEFINE_RE.match(line):
+                continue
+            used.update(REFERENCE_RE.findall(STRING_RE.sub("", line)))
+        return used
+
+    def substitute(self, values):
+        """
+        New macro with the #PARAM lines set to values. A referenced parameter that
+        the file does not define gets its #PARAM line added after the name line.
+        Values for parameters the macro does not use are ignored.
+        """
+        values = {key: format_value(value) for key, value in values.items()
+                  if key in self.params or key in self.references()}
+        lines = []
+        missing = [key for key in values if key not in self.params]
+        for line in self.text.split("\n"):
+            match = None if is_comment(line) else DEFINE_RE.match(line)
+            if match and match.group(1) in values:
+                line = f"#{match.group(1)} {values[match.group(1)]}"
+            lines.append(line)
+            if missing and not is_comment(line) and NAME_RE.match(line):
+                lines.extend(f"#{key} {values[key]}" for key in missing)
+                missing = []
+        if missing: ### no name line, put them first
+            lines = [f"#{key} {values[key]}" for key in missing] + lines
+        return CTC100Macro("\n".join(lines), source = self.source)
+
+    def body(self):
+        """ Lines sent to the controller: no comments, no blank lines, the content hash first """
+        lines = [line.rstrip() for line in self.text.split("\n") if line.strip() and not is_comment(line)]
+        return [HASH_PREFIX + self.hash] + lines
+
+    @property
+    def hash(self):
+        """ sha256 of what gets uploaded, so comment edits do not trigger an upload """
+        lines = [line.rstrip() for line in self.text.split("\n") if line.strip() and not is_comment(line)]
+        return hashlib.sha256("\n".join(lines).encode('utf-8')).hexdigest()[:16]
+
+    def problems(self):
+        """ [str] of everything that would keep the controller from running it, empty when fine """
+        problems = []
+        if self.name is None:
+            problems.append("no name 'macro_name' line")
+        for key, value in self.params.items():
+            try:
+                float(value)
+            except ValueError:
+                problems.append(f"#{key} is not a number: {value}")
+        for key in sorted(self.references() - set(self.params)):
+            problems.append(f"#{key} is used but never defined")
+
+        depth = {"{": 0, "(": 0}
+        for number, line in enumerate(self.text.split("\n"), 1):
+            if is_comment(line):
+                continue
+            try:
+                line.encode('ascii')
+            except UnicodeEncodeError:
+                problems.append(f"line {number}: non ascii characters")
+            if len(line.rstrip()) > MAX_LINE_LENGTH:
+                problems.append(f"line {number}: longer than {MAX_LINE_LENGTH} characters")
+            code = STRING_RE.sub("", line)
+            for opening, closing in [("{", "}"), ("(", ")")]:
+                depth[opening] += code.count(opening) - code.count(closing)
+                if depth[opening] < 0:
+                    problems.append(f"line {number}: unmatched '{closing}'")
+                    depth[opening] = 0
+        for opening, left in depth.items():
+            if left > 0:
+                problems.append(f"{left} unclosed '{opening}'")
+
+        size = sum(len(line) + 1 for line in self.body())
+        if size > MAX_MACRO_BYTES:
+            problems.append(f"{size} bytes, more than the {MAX_MACRO_BYTES} the controller holds")
+        return problems
+
+    def validate(self):
+        problems = self.problems()
+        if problems:
+            raise MacroError(f"Macro {self.name or self.source} is invalid:\n  " + "\n  ".join(problems))
+        return self
+
+
+def config_parameters(cryo_config, macro_name):
+    """ {PARAM: value} for macro_name from the cryo config, see the module docstring """
+    values = {}
+    if not cryo_config:
+        return values
+    for key, read in CONFIG_PARAMETERS.items():
+        try:
+            values[key] = float(read(cryo_config))
+        except (KeyError, TypeError, ValueError):
+            continue
+    overrides = {}
+    for key, value in cryo_config.get("macros", {}).items():
+        if key.startswith("_"): ### _comment entries
+            continue
+        if isinstance(value, dict):
+            if key == macro_name:
+                overrides.update(value)
+        else:
+            values[key] = value
+    values.update(overrides)
+    return values
+
+
+class CTC100MacroPipeline:
+    """
+    Keeps the macros of macro_dir on one TempControl_CTC100 up to date and runs them.
+    The hash of every upload is kept in cache_path (json, optional) so a restart
+    of the host does not upload unchanged macros again.
+    """
+
+    def __init__(self, instrument, macro_dir, cryo_config = None, cache_path = None, clock = None):
+        self.instrument = instrument
+        self.macro_dir = macro_dir
+        self.cryo_config = cryo_config
+        self.cache_path = cache_path
+        self.clock = clock if clock is not None else getattr(instrument, "clock", SYSTEM_CLOCK)
+        self.macros = {}
+        self.uploaded = {} ### macro name -> hash on the controller
+        self._lock = threading.Lock()
+        self.__load_cache__()
+        self.load()
+
+    def __load_cache__(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                self.uploaded = json.load(f).get(self.instrument._name, {})
+        except (OSError, ValueError) as e:
+            print(f"Could not read macro hash cache {self.cache_path}: {e}")
+        return
+
+    def __save_cache__(self):
+        if self.cache_path is None:
+            return
+        cache = {}
+        if os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path, 'r') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+        cache[self.instrument._name] = self.uploaded
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok = True)
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(cache, f, indent = 2)
+        os.replace(tmp_path, self.cache_path)
+        return
+
+    def load(self, cryo_config = None):
+        """
+        (Re)reads every *.txt of macro_dir and fills in the parameters. Returns
+        {file name: CTC100Macro}. A macro that does not validate is reported and
+        left out, the others load.
+        """
+        if cryo_config is not None:
+            self.cryo_config = cryo_config
+        macros = {}
+        for file in sorted(os.listdir(self.macro_dir)):
+            if not file.endswith('.txt'):
+                continue
+            name = os.path.splitext(file)[0]
+            try:
+                macro = CTC100Macro.from_file(os.path.join(self.macro_dir, file))
+                macro = macro.substitute(config_parameters(self.cryo_config, macro.name or name)).validate()
+            except (OSError, MacroError) as e:
+                print(f"Skipping macro {file}: {e}")
+                continue
+            if macro.name != name:
+                print(f"Macro {file} registers as '{macro.name}', use that name to run it")
+            macros[macro.name] = macro
+        self.macros = macros
+        return macros
+
+    def texts(self):
+        """ {name: macro text with the parameters filled in} """
+        return {name: macro.text for name, macro in self.macros.items()}
+
+    def changed(self):
+        """ Names of the macros whose content differs from the last upload """
+        return [name for name, macro in self.macros.items() if self.uploaded.get(name) != macro.hash]
+
+    def upload(self, name, force = False):
+        """ Uploads macro name if its hash changed (or force), True if it was sent """
+        macro = self.macros.get(name)
+        if macro is None:
+            raise MacroError(f"No macro {name}, loaded: {list(self.macros)}")
+        with self._lock:
+            if not force and self.uploaded.get(name) == macro.hash:
+                return False
+            if self.status().get("name") == name:
+                raise MacroError(f"Macro {name} is running on {self.instrument._name}, stop it before uploading")
+            commands = [MACRO_DEFINE.format(name = name)] + macro.body() + [MACRO_END]
+            replies = self.instrument.query_batch(commands)
+            if replies is None:
+                self.uploaded.pop(name, None) ### may be half written on the controller
+                self.__save_cache__()
+                raise MacroError(f"Upload of {name} to {self.instrument._name} failed")
+            self.uploaded[name] = macro.hash
+            self.__save_cache__()
+        print(f"Uploaded macro {name} ({len(commands)} lines, {macro.hash})")
+        return True
+
+    def sync(self, force = False):
+        """ Uploads every changed macro, returns the names that were sent """
+        return [name for name in list(self.macros) if self.upload(name, force = force)]
+
+    def start(self, name):
+        """ Uploads name if it changed, then starts it on the controller """
+        self.upload(name)
+        ### whatever the macro sets happens behind the shadow registers' back
+        self.instrument.shadow.invalidate()
+        response = self.instrument.query(MACRO_RUN.format(name = name))
+        if response is None:
+            raise MacroError(f"Could not start macro {name} on {self.instrument._name}")
+        return response
+
+    def stop(self, name = None):
+        """ Kills name (default: whatever macro runs), its abortMacro handler puts the outputs in a safe state """
+        name = name if name is not None else self.status().get("name")
+        if name is None:
+            return None
+        response = self.instrument.query(MACRO_KILL.format(name = name), priority = SAFETY)
+        self.instrument.shadow.invalidate()
+        return response
+
+    def status(self):
+        """ {"running": bool, "name": running macro or None, "raw": reply}, raw is None when the read failed """
+        raw = self.instrument.query(MACRO_STATUS)
+        value = parse_readback(raw)
+        running = value is not None and value.strip("\"' ").lower() not in ["", "idle", "none", "0"]
+        return {"running": running, "name": value.strip("\"' ") if running else None, "raw": raw}
+
+    def run(self, name, stop_event = None, poll_s = 10., progress_callback = None):
+        """
+        Starts name (or keeps watching it if it already runs, e.g. after a restart
+        of the host) and waits until it ends. Returns 0 when the macro finished,
+        1 when stop_event got set (the macro is killed and the PIDs set off).
+        0 only means the macro ended, whether the step worked is for the caller to
+        check on Tr/Tp. Raises MacroError if it cannot be uploaded or started.
+        """
+        if self.status().get("name") != name:
+            self.start(name)
+        if progress_callback is not None:
+            progress_callback(name)
+        while True:
+            stopped = self.clock.wait(stop_event, poll_s) if stop_event is not None else (self.clock.sleep(poll_s) or False)
+            if stopped:
+                print(f"Macro {name} stopped by user.")
+                self.stop(name)
+                self.instrument.set_pid_off()
+                return 1
+            status = self.status()
+            if status["raw"] is None: ### link down, the controller carries on without us
+                continue
+            if status["name"] != name:
+                print(f"Macro {name} finished on {self.instrument._name}")
+                return 0
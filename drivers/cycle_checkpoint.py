@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os
+import json
+
+from generic_instrument_dependencies.clock import SYSTEM_CLOCK
+
+
+class CycleCheckpoint:
+    """
+    Small on-disk snapshot of the auto cycle state machine.
+
+    Every save writes a temp file, fsyncs it and os.replace's it over the old
+    one, so after a crash or power cut the file is either the previous state
+    or the new one, never half written.
+
+    State is a flat json dict, e.g.
+        {"evap_ran_today": true, "cond_ran_today": false, "monitor_after_evap": true,
+         "t_condensation": 1792100000.0, "t_evap": 1792150000.0,
+         "phase": "evaporation", "step": "tr_checks", "step_started": 1792153600.0,
+         "saved_at": 1792153600.2}
+    phase is None when no procedure is running.
+    """
+
+    def __init__(self, path, clock = SYSTEM_CLOCK):
+        self.path = path
+        self.clock = clock
+        self.state = {}
+
+    def load(self):
+        """ Last saved state, None if there is no (readable) checkpoint """
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                self.state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Could not read auto cycle checkpoint {self.path}: {e}")
+            return None
+        return self.state
+
+    def save(self, **changes):
+        """ Updates the state with changes and persists it atomically """
+        self.state.update(changes)
+        self.state["saved_at"] = self.clock.time()
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.state, f, indent = 2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return self.state
+
+    def clear(self):
+        self.state = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        return self
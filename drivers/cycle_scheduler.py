@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+import heapq
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta
+
+from generic_instrument_dependencies.clock import SYSTEM_CLOCK
+
+
+def next_daily_time(minute_of_day, now = None, grace_s = 0.):
+    """
+    Unix time of the next local occurrence of minute_of_day (e.g. 7.5 h -> 450).
+    An occurrence less than grace_s in the past still counts as the next one,
+    so starting the cycle a few minutes after the scheduled time fires it now.
+    """
+    now = time.time() if now is None else now
+    today = datetime.fromtimestamp(now).replace(hour = 0, minute = 0, second = 0, microsecond = 0)
+    fire = today + timedelta(minutes = float(minute_of_day))
+    if fire.timestamp() < now - grace_s:
+        fire += timedelta(days = 1)
+    return fire.timestamp()
+
+
+class CycleScheduler:
+    """
+    Timer heap driving the auto cycle.
+
+    Events are (fire_time, kind) pairs, fire_time in unix seconds. wait_next
+    sleeps until the earliest one is due and returns it, so a process starts
+    within milliseconds of its time instead of at the next polling tick.
+    Anything that schedules a new event, or wake(), interrupts the sleep, so
+    events can be pushed from other threads (e.g. threshold callbacks).
+    """
+
+    def __init__(self, clock = SYSTEM_CLOCK):
+        self.clock = clock
+        self._heap = []
+        self._counter = itertools.count() ### tie breaker, keeps same-time events FIFO
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, fire_time, kind, payload = None):
+        with self._lock:
+            heapq.heappush(self._heap, (fire_time, next(self._counter), kind, payload))
+        self._wake.set()
+        return fire_time
+
+    def schedule_in(self, delay_s, kind, payload = None):
+        return self.schedule(self.clock.time() + delay_s, kind, payload)
+
+    def cancel(self, kind):
+        with self._lock:
+            self._heap = [event for event in self._heap if event[2] != kind]
+            heapq.heapify(self._heap)
+        return self
+
+    def is_scheduled(self, kind):
+        with self._lock:
+            return any(event[2] == kind for event in self._heap)
+
+    def next_event(self):
+        """ (fire_time, kind) of the earliest event, None if empty """
+        with self._lock:
+            if not self._heap:
+                return None
+            return self._heap[0][0], self._heap[0][2]
+
+    def wake(self):
+        """ Interrupts wait_next so it re-checks the heap and the stop event """
+        self._wake.set()
+        return self
+
+    def wait_next(self, stop_event):
+        """
+        Blocks until the earliest event is due and pops it as
+        (fire_time, kind, payload). Returns None once stop_event is set
+        (call wake() after setting it to interrupt a long sleep).
+        """
+        while not stop_event.is_set():
+            with self._lock:
+                self._wake.clear()
+                if self._heap and self._heap[0][0] <= self.clock.time():
+                    fire_time, _, kind, payload = heapq.heappop(self._heap)
+                    return fire_time, kind, payload
+                timeout = self._heap[0][0] - self.clock.time() if self._heap else None
+            self.clock.wait(self._wake, timeout)
+        return None
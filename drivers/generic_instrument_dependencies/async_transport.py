@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import asyncio
+
+try:
+    import serial_asyncio ### pyserial-asyncio, only needed for AsyncSerialTransport
+except ImportError:
+    serial_asyncio = None
+
+
+class AsyncStreamTransport:
+    """
+    Text protocol over an asyncio stream pair: query() writes command + write_term
+    and returns the reply up to read_term. One command on the wire at a time,
+    callers queue on an asyncio.Lock (FIFO) instead of a thread each.
+    Subclasses only implement __open__, which returns (reader, writer).
+    """
+
+    def __init__(self, read_term = '\r\n', write_term = '\n', timeout_s = 2.):
+        self.read_term = read_term
+        self.write_term = write_term
+        self.timeout_s = timeout_s
+        self.reader = None
+        self.writer = None
+        self._lock = None ### created on first use, inside the running loop
+
+    async def __open__(self):
+        raise NotImplementedError
+
+    async def connect(self):
+        if self.writer is None:
+            self.reader, self.writer = await self.__open__()
+        return self
+
+    async def query(self, command, timeout_s = None):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        timeout_s = self.timeout_s if timeout_s is None else timeout_s
+        async with self._lock:
+            await self.connect()
+            try:
+                self.writer.write((command + self.write_term).encode('ascii'))
+                await self.writer.drain()
+                reply = await asyncio.wait_for(self.reader.readuntil(self.read_term.encode('ascii')), timeout_s)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                await self.close() ### the stream is out of step now, start clean next time
+                raise
+        return reply.decode('ascii')[:-len(self.read_term)]
+
+    async def write(self, command):
+        return await self.query(command)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+        self.reader, self.writer = None, None
+        return
+
+
+class AsyncTCPTransport(AsyncStreamTransport):
+    """ CTC100 (or any text protocol instrument) on its ethernet port """
+
+    def __init__(self, host, port, read_term = '\r\n', write_term = '\n', timeout_s = 2.):
+        super().__init__(read_term = read_term, write_term = write_term, timeout_s = timeout_s)
+        self.host = host
+        self.port = int(port)
+
+    async def __open__(self):
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout_s)
+
+
+class AsyncSerialTransport(AsyncStreamTransport):
+    """ Serial port through pyserial-asyncio (pip install pyserial-asyncio) """
+
+    def __init__(self, port, baud_rate = 9600, read_term = '\r\n', write_term = '\n', timeout_s = 2.):
+        super().__init__(read_term = read_term, write_term = write_term, timeout_s = timeout_s)
+        self.port = port
+        self.baud_rate = baud_rate
+
+    async def __open__(self):
+        if serial_asyncio is None:
+            raise ImportError("AsyncSerialTransport needs pyserial-asyncio (pip install pyserial-asyncio)")
+        return await serial_asyncio.open_serial_connection(url = self.port, baudrate = self.baud_rate)
+
+
+class InProcessAsyncTransport:
+    """
+    Async face of an in-process transport that answers instantly (SimulatedCTC100,
+    ReplayTransport): calls its query directly on the loop, no thread, no lock.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def query(self, command, timeout_s = None):
+        return self.client.query(command)
+
+    async def write(self, command):
+        return self.client.query(command)
+
+    async def close(self):
+        return
+
+
+def blocking(fn):
+    """ fn as a coroutine function that never suspends, for procedures written once for both APIs """
+    async def call(*args, **kwargs):
+        return fn(*args, **kwargs)
+    return call
+
+
+def run_blocking(coroutine):
+    """ Runs a coroutine whose awaits all resolve straight away (see blocking) to its result, no event loop """
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    coroutine.close()
+    raise RuntimeError("procedure awaited something that is not blocking(), run it in an event loop")
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import time
+import asyncio
+from datetime import datetime
+
+
+class SystemClock:
+    """
+    Real time, the default clock of every instrument and scheduler.
+
+    Anything that reads the time or waits goes through a clock object, so a
+    virtual clock (see simulated_ctc100.VirtualClock) can be swapped in to run
+    hours of cycle logic in seconds.
+    """
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(max(seconds, 0.))
+        return
+
+    def wait(self, event, seconds = None):
+        """ event.wait(seconds), True if the event got set """
+        if seconds is not None:
+            seconds = max(seconds, 0.)
+        return event.wait(seconds)
+
+    async def await_event(self, event, seconds = None):
+        """ asyncio flavour of wait() for an asyncio.Event """
+        if seconds is None:
+            await event.wait()
+            return True
+        try:
+            await asyncio.wait_for(event.wait(), max(seconds, 0.))
+            return True
+        except asyncio.TimeoutError:
+            return event.is_set()
+
+
+SYSTEM_CLOCK = SystemClock()
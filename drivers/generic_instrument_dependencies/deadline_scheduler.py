@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import asyncio
+import numpy as np
+
+from .clock import SYSTEM_CLOCK
+
+
+### histogram bin edges in seconds, last bin catches everything slower than 1 s
+DEFAULT_EDGES_S = (0., 1e-3, 2e-3, 5e-3, 1e-2, 2e-2, 5e-2, 0.1, 0.2, 0.5, 1.)
+
+
+class DeadlineScheduler:
+    """
+    Drift free periodic timer on the monotonic clock.
+
+    Tick k is due at start + k * period_s no matter how long the work in
+    between took, so a 1 s loop around a slow serial query stays at 1 s
+    instead of 1 s + query time. If the work overruns one or more whole
+    periods, those ticks are skipped (counted in missed_ticks) rather than
+    fired back to back.
+
+    Keeps histograms of
+        lag:    how late each tick actually woke up after its deadline
+        jitter: |actual interval between ticks - period_s|
+
+        scheduler = DeadlineScheduler(1.0)
+        while running:
+            do_work()
+            if scheduler.wait(stop_event):
+                break
+    """
+
+    def __init__(self, period_s, edges_s = DEFAULT_EDGES_S, clock = SYSTEM_CLOCK):
+        self.period_s = float(period_s)
+        self.clock = clock
+        self.edges_s = np.asarray(edges_s, dtype = float)
+        self.reset()
+
+    def reset(self):
+        self._start = None
+        self._deadline = None
+        self._last_tick = None
+        self.ticks = 0
+        self.missed_ticks = 0
+        self.last_lag_s = 0.
+        self.max_lag_s = 0.
+        self._lag_sum_s = 0.
+        self.lag_histogram = np.zeros(len(self.edges_s), dtype = int)
+        self.jitter_histogram = np.zeros(len(self.edges_s), dtype = int)
+        return self
+
+    def start(self):
+        """ First deadline is now, later ones are multiples of period_s after it """
+        self._start = self.clock.monotonic()
+        self._deadline = self._start
+        self._last_tick = self._start
+        return self
+
+    def __bin__(self, value):
+        return max(np.searchsorted(self.edges_s, value, side = 'right') - 1, 0)
+
+    def __next_deadline__(self):
+        """ Moves to the next deadline and returns the time left until it """
+        if self._deadline is None:
+            self.start()
+
+        now = self.clock.monotonic()
+        self._deadline += self.period_s
+        if now > self._deadline:
+            ### overran: skip the ticks we missed instead of bursting to catch up
+            missed = int((now - self._deadline) // self.period_s) + 1
+            self.missed_ticks += missed
+            self._deadline += missed * self.period_s
+        return self._deadline - now
+
+    def wait(self, stop_event = None):
+        """
+        Sleeps until the next deadline. Returns True if stop_event was set
+        while waiting (the caller should stop), else False.
+        """
+        remaining = self.__next_deadline__()
+        if stop_event is not None:
+            if self.clock.wait(stop_event, remaining):
+                return True
+        else:
+            self.clock.sleep(remaining)
+        return self.__tick__()
+
+    async def await_next(self, stop_event = None):
+        """ wait() for asyncio, stop_event is an asyncio.Event """
+        remaining = self.__next_deadline__()
+        if stop_event is not None:
+            if await self.clock.await_event(stop_event, remaining):
+                return True
+        else:
+            await self.clock.await_event(asyncio.Event(), remaining)
+        return self.__tick__()
+
+    def __tick__(self):
+        tick = self.clock.monotonic()
+        lag = max(tick - self._deadline, 0.)
+        jitter = abs((tick - self._last_tick) - self.period_s)
+        self._last_tick = tick
+        self.ticks += 1
+        self.last_lag_s = lag
+        self.max_lag_s = max(self.max_lag_s, lag)
+        self._lag_sum_s += lag
+        self.lag_histogram[self.__bin__(lag)] += 1
+        self.jitter_histogram[self.__bin__(jitter)] += 1
+        return False
+
+    def stats(self):
+        return {
+            "period_s": self.period_s,
+            "ticks": self.ticks,
+            "missed_ticks": self.missed_ticks,
+            "last_lag_s": self.last_lag_s,
+            "mean_lag_s": self._lag_sum_s / self.ticks if self.ticks else 0.,
+            "max_lag_s": self.max_lag_s,
+            "histogram_edges_s": self.edges_s.tolist(),
+            "lag_histogram": self.lag_histogram.tolist(),
+            "jitter_histogram": self.jitter_histogram.tolist(),
+        }
@@ -1,32 +1,70 @@
 #!/usr/bin/env python3
 
 import logging
+import asyncio
 from pyvisa import ResourceManager, VisaIOError
+from pyvisa.constants import StatusCode
 import numpy as np
 import threading
 import time
-from queue import Queue
+from concurrent.futures import CancelledError, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
 from datetime import datetime, timezone
 import json
 import matplotlib.pyplot as plt 
 import requests
 
+from .sample_store import SampleStore
+from .deadline_scheduler import DeadlineScheduler
+from .clock import SYSTEM_CLOCK
+from .transaction_trace import RecordingTransport
+from .tcp_transport import TCPTransport
+from .io_scheduler import IOScheduler, SAFETY, CONTROL, BACKGROUND, is_write
+
+
+class QueryCancelled(Exception):
+    """ Raised by query() when its cancel_event got set before the reply came """
+    pass
+
+
+class LinkLost(Exception):
+    """ Raised by reads that gave up waiting for a dropped link to come back """
+    pass
+
+
 class GenericInstrument:
 
     def __init__(self, address, name, scaling = 1., 
-                 read_term = '\n', write_term = '\n', special_init = None):
+                 read_term = '\n', write_term = '\n', special_init = None,
+                 transport = None, clock = None):
         self._name = name
         self._address = address
         self.scaling = scaling
         self.read_term = read_term
         self.write_term = write_term
         self.special_init = special_init
+        ### transport: any object with query/write/read/close used instead of a pyvisa
+        ### resource (e.g. simulated_ctc100.SimulatedCTC100), clock: see clock.SystemClock
+        self.transport = transport
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self._connected = threading.Event() ### set by handshake, cleared while the link is down
+        ### reconnect_with_backoff waits reconnect_backoff_s, doubling up to max_reconnect_backoff_s
+        self.reconnect_backoff_s = 1.
+        self.max_reconnect_backoff_s = 60.
+        self.reconnects = 0
 
-        self.rm = ResourceManager()
+        self.rm = ResourceManager() if transport is None and not str(address).lower().startswith("tcp://") else None
         self.client = self.handshake()
 
-        self.queue = Queue()
-        self.processing_commands = False
+        ### owns the port: every query/write goes through it, most urgent first
+        self.io = IOScheduler(self.__transact__, name = self._name, clock = self.clock)
+        ### [(fnmatch pattern, seconds)], first match sets the port timeout of a command, e.g.
+        ### [("waitForSample", 30.), ("*.Value?", 1.)], no match leaves the timeout alone
+        self.timeout_profiles = []
+        self._local = threading.local() ### per thread default cancel_event, see cancel_on
+        ### async transport used by aquery, see attach_async
+        self.aio = None
 
 
 
@@ -35,6 +73,12 @@ class GenericInstrument:
         self.updated = False
         ### when we want all the data over time
         self.accumulate = False
+        ### accumulate mode only: samples kept in RAM before the oldest half
+        ### is spilled to spill_path (None = never spill)
+        self.memory_cap = None
+        self.spill_path = None
+        self.store = None
+        self.measurement_scheduler = None
         self._io_lock = threading.Lock()
 
     def __enter__(self):
@@ -44,13 +88,35 @@ class GenericInstrument:
         self.close()
         return
     
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    @connected.setter
+    def connected(self, value):
+        if value:
+            self._connected.set()
+        else:
+            self._connected.clear()
+
+    def wait_connected(self, timeout_s = None):
+        """ Blocks until the link is up (again), returns False on timeout """
+        return self._connected.wait(timeout_s)
+
     def handshake(self):
         self.client = None
+        self.connected = False
         try:
-            if self.special_init is None:
+            if self.transport is not None:
+                self.client = self.transport
+            elif str(self._address).lower().startswith("tcp://"): ### network interface, e.g. tcp://192.168.1.50:23
+                self.client = TCPTransport.from_address(self._address, read_term = self.read_term, write_term = self.write_term,
+                                                        **(self.special_init or {}))
+            elif self.special_init is None:
                 self.client = self.rm.open_resource(self._address, read_termination = self.read_term, write_termination = self.write_term)
             else:
                 self.client = self.rm.open_resource(self._address, read_termination = self.read_term, write_termination = self.write_term, **self.special_init)
+            self.connected = self.client is not None
             logging.info(f"Connected to {self._name}.")
 
         except Exception as e:
@@ -58,61 +124,281 @@ class GenericInstrument:
         finally:
             return self.client
 
+    def probe(self):
+        """ True if the freshly opened link answers, overridden by instruments with a cheap query """
+        return True
+
+    def after_reconnect(self):
+        """ Runs once the link is back, e.g. to restore the instrument's configuration """
+        return
+
+    def reconnect(self):
+        """
+        Closes the client and opens it again. A trace being recorded carries on
+        over the new link. Returns True once the new link answers probe().
+        """
+        with self._io_lock:
+            self.connected = False
+            previous = self.client
+            recording = previous if isinstance(previous, RecordingTransport) else None
+            stale = recording.client if recording is not None else previous
+            if stale is not None:
+                try:
+                    stale.close()
+                except Exception as e:
+                    logging.debug(f"Closing the stale link of {self._name} failed: {e}")
+            client = self.handshake()
+            self.connected = False ### not before the probe answered
+            if client is not None and recording is not None:
+                recording.client = client
+                self.client = recording
+        try:
+            alive = self.client is not None and bool(self.probe())
+        except Exception as e:
+            logging.error(f"{self._name} did not answer after reconnecting: {e}")
+            alive = False
+        self.connected = alive
+        return alive
+
+    def reconnect_with_backoff(self, stop_event = None, max_attempts = None):
+        """
+        Calls reconnect until it succeeds, waiting reconnect_backoff_s after the
+        first failure and doubling up to max_reconnect_backoff_s. Runs
+        after_reconnect() once the link is back. Returns False if stop_event got
+        set or max_attempts ran out.
+        """
+        delay_s = self.reconnect_backoff_s
+        attempt = 0
+        while stop_event is None or not stop_event.is_set():
+            attempt += 1
+            if self.reconnect():
+                self.reconnects += 1
+                logging.warning(f"Reconnected to {self._name} after {attempt} attempt(s)")
+                try:
+                    self.after_reconnect()
+                except Exception as e:
+                    logging.error(f"Restoring {self._name} after the reconnect failed: {e}")
+                return True
+            if max_attempts is not None and attempt >= max_attempts:
+                break
+            logging.warning(f"Reconnect to {self._name} failed (attempt {attempt}), next try in {delay_s:.1f} s")
+            ### real time on purpose: the hardware comes back on its own schedule, not the virtual clock's
+            if stop_event is not None:
+                if stop_event.wait(delay_s):
+                    break
+            else:
+                time.sleep(delay_s)
+            delay_s = min(2 * delay_s, self.max_reconnect_backoff_s)
+        return False
+
+    def start_recording(self, path):
+        """ Records every command/response/latency to a binary trace at path, see transaction_trace """
+        if self.client is None:
+            logging.error(f"Cannot record {self._name}: No connection established.")
+            return None
+        with self._io_lock:
+            if isinstance(self.client, RecordingTransport):
+                self.client = self.client.stop()
+            self.client = RecordingTransport(self.client, path, clock = self.clock)
+        return path
+
+    def stop_recording(self):
+        with self._io_lock:
+            if isinstance(self.client, RecordingTransport):
+                path = self.client.writer.path
+                self.client = self.client.stop()
+                return path
+        return None
+
 #### this is a place holder method that is meant to be 
 ### replaced by child class read_data methods
     def read_data(self):
         return None
 ###############################
     def start_command_processor(self):
-        if not self.processing_commands:
-            self.processing_commands = True
-            self.__command_queue_thread__ = threading.Thread(target=self.__process_commands__, daemon=True)
-            self.__command_queue_thread__.start()
+        self.io.start()
         return self
 
     def stop_command_processor(self):
-        self.processing_commands = False
+        self.io.stop()
         return self
 
-    def __process_commands__(self):
-        while self.processing_commands:
-            # get item from queue
-            command = self.queue.get()
-            # execute command
-            if command[-1] == '?' or command[0] == '0':
-                try:
-                    self.response = self.client.query(command)
-                except VisaIOError as e:
-                    print("I/O error on query command:", command)
-            else:
-                try:
-                    self.client.query(command)
-                except VisaIOError as e:
-                    print("I/O error on write command:", command)
-            self.queue.task_done()
+    @property
+    def processing_commands(self):
+        return self.io.running
 
-        return 
+    def command_timeout(self, command):
+        """ Port timeout in seconds for command from timeout_profiles, None if no profile matches """
+        for pattern, timeout_s in self.timeout_profiles:
+            if fnmatchcase(command, pattern):
+                return timeout_s
+        return None
 
-    def write(self, command):
-        if self.client is not None:
-            self.queue.put(command)
-        else:
+    def __transact__(self, command):
+        ### only ever called from the io worker, the lock keeps start/stop_recording out
+        with self._io_lock:
+            if self.client is None: ### mid reconnect
+                raise VisaIOError(StatusCode.error_connection_lost)
+            timeout_s = self.command_timeout(command)
+            if timeout_s is not None:
+                timeout_ms = int(timeout_s * 1000)
+                if getattr(self.client, "timeout", None) != timeout_ms:
+                    self.client.timeout = timeout_ms
+            return self.client.query(command) ### the instrument answers every command, writes included
+
+    @contextmanager
+    def cancel_on(self, cancel_event):
+        """ Every query from this thread inside the block is cancelled once cancel_event is set """
+        previous = getattr(self._local, "cancel_event", None)
+        self._local.cancel_event = cancel_event
+        try:
+            yield self
+        finally:
+            self._local.cancel_event = previous
+
+    def write(self, command, priority = None):
+        """
+        Queues a command without waiting for it, returns a Future with the reply.
+        A newer write to the same parameter still in the queue replaces it.
+        """
+        if self.client is None:
             logging.error(f"Cannot write to {self._name}: No connection established.")
-        return self
+            return None
+        return self.io.submit(command, priority)
     
-    def query(self, command):
+    def query(self, command, priority = None, timeout_s = None, cancel_event = None):
+        """
+        Sends command through the io scheduler and waits for the reply.
+        priority: SAFETY, CONTROL or BACKGROUND, default the class set with
+        self.io.priority(...) on this thread, else CONTROL.
+        timeout_s: deadline for queueing + reply, None waits for the port timeout.
+        A read that misses it is dropped from the queue and None is returned.
+        cancel_event (default: the one from cancel_on): once set, a pending read is
+        dropped and QueryCancelled raised. Writes are never taken back: they still
+        go out, and SAFETY writes are waited for even when cancelled.
+        """
         if self.client is not None:
+            if cancel_event is None:
+                cancel_event = getattr(self._local, "cancel_event", None)
+            future = self.io.submit(command, priority)
+            write = is_write(command)
+            safety_write = write and (priority if priority is not None else self.io.current_priority()) == SAFETY
+            ### real time on purpose: port timeouts do not follow a virtual clock
+            deadline = None if timeout_s is None else time.monotonic() + timeout_s
             try:
-                with self._io_lock:
-                    response = self.client.query(command)
-                    return response
+                while True:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        if not write:
+                            future.cancel()
+                        logging.error(f"Deadline of {timeout_s} s missed on {self._name}: {command}")
+                        return None
+                    if cancel_event is not None and cancel_event.is_set() and not safety_write:
+                        if not write:
+                            future.cancel()
+                        raise QueryCancelled(command)
+                    ### slices so a cancel is seen within 50 ms even during a long read
+                    slice_s = 0.05 if cancel_event is not None else remaining
+                    if slice_s is not None and remaining is not None:
+                        slice_s = min(slice_s, remaining)
+                    try:
+                        return future.result(timeout = slice_s)
+                    except FutureTimeoutError:
+                        continue
             except VisaIOError as e:
                 logging.error(f"I/O error on query command: {command}")
                 return None
+            except CancelledError:
+                logging.error(f"Query cancelled, {self._name} I/O stopped: {command}")
+                return None
         else:
             logging.error(f"Cannot query {self._name}: No connection established.")
             return None
 
+    def query_batch(self, commands, priority = None):
+        """ Sends commands back to back with nothing in between, returns their replies or None on an I/O error """
+        if self.client is None:
+            logging.error(f"Cannot query {self._name}: No connection established.")
+            return None
+        try:
+            return self.io.submit_batch(commands, priority).result()
+        except VisaIOError:
+            logging.error(f"I/O error during a batch of {len(commands)} commands on {self._name}")
+            return None
+        except CancelledError:
+            logging.error(f"Batch cancelled, {self._name} I/O stopped")
+            return None
+
+    def attach_async(self, transport):
+        """
+        Gives the instrument an asyncio transport (async_transport.AsyncTCPTransport,
+        AsyncSerialTransport, InProcessAsyncTransport) for aquery and the a* methods.
+        Without one they run the blocking query in a worker thread.
+        """
+        self.aio = transport
+        return self
+
+    async def aquery(self, command, timeout_s = None):
+        """ query() for asyncio, None on timeout or I/O error like query """
+        if self.aio is None:
+            return await asyncio.to_thread(self.query, command, None, timeout_s)
+        try:
+            return await self.aio.query(command, timeout_s)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError) as e: ### incomplete read: peer closed
+            logging.error(f"I/O error on async query command: {command} ({e!r})")
+            return None
+
+    async def aprobe(self):
+        """ probe() for asyncio, the async transport reopens its stream on the query """
+        return True
+
+    async def aafter_reconnect(self):
+        """ after_reconnect() for asyncio """
+        return await asyncio.to_thread(self.after_reconnect)
+
+    async def areconnect_with_backoff(self, stop_event = None, max_attempts = None):
+        """
+        reconnect_with_backoff for asyncio, stop_event is an asyncio.Event (or None).
+        Without an async transport the blocking reconnect runs in a worker thread,
+        with one the transport reopens by itself and aprobe() tells when it answers.
+        """
+        delay_s = self.reconnect_backoff_s
+        attempt = 0
+        self.connected = False
+        while stop_event is None or not stop_event.is_set():
+            attempt += 1
+            if self.aio is None:
+                alive = await asyncio.to_thread(self.reconnect)
+            else:
+                try:
+                    alive = bool(await self.aprobe())
+                except Exception as e:
+                    logging.error(f"{self._name} did not answer after reconnecting: {e}")
+                    alive = False
+            if alive:
+                self.connected = True
+                self.reconnects += 1
+                logging.warning(f"Reconnected to {self._name} after {attempt} attempt(s)")
+                try:
+                    await self.aafter_reconnect()
+                except Exception as e:
+                    logging.error(f"Restoring {self._name} after the reconnect failed: {e}")
+                return True
+            if max_attempts is not None and attempt >= max_attempts:
+                break
+            logging.warning(f"Reconnect to {self._name} failed (attempt {attempt}), next try in {delay_s:.1f} s")
+            ### real time on purpose, as in reconnect_with_backoff
+            if stop_event is not None:
+                try:
+                    await asyncio.wait_for(stop_event.wait(), delay_s)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(delay_s)
+            delay_s = min(2 * delay_s, self.max_reconnect_backoff_s)
+        return False
+
 ############################################
 
     def kill_measurement(self):
@@ -120,7 +406,8 @@ class GenericInstrument:
         return self
     
     def get_measurement(self):
-        return np.array([self.measurement])
+        ### view with a leading channel axis, no copy
+        return np.asarray(self.measurement)[np.newaxis]
 
 ### THIS METHOD IS FOR INSTRUMENTS THAT DO NOT STORE AN INTERNAL
 ### ARRAY IN SOME INTERNAL BUFFER, SO WE MAKE ONE OURSELVES
@@ -132,24 +419,28 @@ class GenericInstrument:
         '''
         if not self.measuring:
             self.measuring = True
+            if not dataframe:
+                if self.store is not None:
+                    self.store.close()
+                self.store = SampleStore(n, accumulate = self.accumulate,
+                                         memory_cap = self.memory_cap, spill_path = self.spill_path)
+                self.measurement = self.store.view()
+
+            self.measurement_scheduler = DeadlineScheduler(clock_s, clock = self.clock)
+
             def data_thread():
-                data = np.zeros(n)
-                
+                self.measurement_scheduler.start()
                 while self.measuring:
                     if not dataframe:
-                        if self.accumulate:
-                            data = np.insert(data, -1, values = self.read_data() * self.scaling)
-                        else:
-                            data = np.roll(data, -1)
-                            data[-1] = self.read_data()
-
-                        self.measurement = data
+                        self.store.append(self.read_data() * self.scaling)
+                        self.measurement = self.store.view()
                         self.updated = True
             
                     else:
                         self.measurement = self.read_data(n)
 
-                    time.sleep(clock_s)
+                    ### deadline based, read_data time does not stretch the period
+                    self.measurement_scheduler.wait()
 
                 return self.measurement
 
@@ -158,7 +449,7 @@ class GenericInstrument:
         return 1 ### number of channels by default
     
     def get_local_system_time(self):
-        dt = datetime.now()
+        dt = self.clock.now()
         return dt.hour * 60 + dt.minute
     
 
@@ -170,6 +461,7 @@ class GenericInstrument:
     def general_close(self):
         if self.connected:
             logging.info(f"Disconnecting {self._name}")
+            self.io.stop()
             self.client.close()
             self.connected = False
             logging.info(f"{self._name} connection closed")
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from .clock import SYSTEM_CLOCK
+
+
+### priority classes, lower goes first
+SAFETY = 0      ### reads the abort checks depend on, safe state writes
+CONTROL = 1     ### setters, procedure steps (default)
+BACKGROUND = 2  ### logging polls, anything that can wait
+PRIORITY_NAMES = {SAFETY: "safety", CONTROL: "control", BACKGROUND: "background"}
+
+
+def is_write(command):
+    """ CTC100 style: queries end with '?', everything else sets something """
+    return not command.rstrip().endswith('?')
+
+
+def write_key(command):
+    """ Parameter a write sets, e.g. 'hpump.PID.Setpoint 40' -> 'hpump.PID.Setpoint' """
+    return command.strip().split(' ', 1)[0]
+
+
+class __Request__:
+    __slots__ = ("priority", "seq", "command", "futures", "key", "submitted")
+
+    def __init__(self, priority, seq, command, key, submitted):
+        self.priority = priority
+        self.seq = seq
+        self.command = command
+        self.futures = []
+        self.key = key
+        self.submitted = submitted
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class IOScheduler:
+    """
+    Single owner of an instrument port. Every command goes through one worker
+    thread that always sends the most urgent pending command first:
+        SAFETY > CONTROL > BACKGROUND, FIFO within a class.
+    So a burst of config writes or the logging poll never delays an abort check
+    by more than the one transaction already on the wire.
+
+    A write to a parameter that still has a write waiting, in any class, is
+    coalesced: the pending one is replaced by the newer command and all callers
+    get the result of the single transaction that is sent. If the newer write is
+    more urgent the pending one moves up to its class, so a stale CONTROL write
+    can never go out after a SAFETY write to the same parameter. A query for that
+    parameter pulls a pending write ahead of itself (up to its own class) and ends
+    the coalescing, so reads never see skipped values.
+
+    transact(command) does the actual I/O (under the instrument's lock). submit
+    returns a concurrent.futures.Future with its response or exception. The
+    worker starts on the first submit. After stop() submits get a cancelled
+    future, so nothing goes to a closed port, until start() is called again.
+
+        io = IOScheduler(instrument.__transact__)
+        value = io.submit("Tr.Value?", SAFETY).result()
+        with io.priority(SAFETY):   ### default class for submits from this thread
+            instrument.set_pid_off()
+    """
+
+    def __init__(self, transact, name = "io", clock = SYSTEM_CLOCK):
+        self.transact = transact
+        self.name = name
+        self.clock = clock
+        self._heap = []
+        self._pending_writes = {} ### parameter -> its queued write __Request__, whatever the class
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+        self._thread = None
+        self.running = False
+        self.stopped = False ### stop() was called, submits are refused until start()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.sent = {p: 0 for p in PRIORITY_NAMES}
+        self.coalesced = {p: 0 for p in PRIORITY_NAMES}
+        self.max_wait_s = {p: 0. for p in PRIORITY_NAMES}
+        return self
+
+    def start(self):
+        with self._cond:
+            self.stopped = False
+            if self.running:
+                return self
+            self.running = True
+        self._thread = threading.Thread(target = self.__worker__, name = f"{self.name} I/O", daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self, timeout = None):
+        """ Stops the worker, pending requests get CancelledError """
+        with self._cond:
+            self.running = False
+            self.stopped = True
+            pending, self._heap, self._pending_writes = self._heap, [], {}
+            self._cond.notify_all()
+        for request in pending:
+            for future in request.futures:
+                future.cancel()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        return self
+
+    def on_worker(self):
+        return self._thread is threading.current_thread()
+
+    @contextmanager
+    def priority(self, level):
+        """ Sets the default class of submits from the calling thread """
+        previous = getattr(self._local, "priority", CONTROL)
+        self._local.priority = level
+        try:
+            yield self
+        finally:
+            self._local.priority = previous
+
+    def current_priority(self):
+        return getattr(self._local, "priority", CONTROL)
+
+    def submit(self, command, priority = None):
+        if priority is None:
+            priority = self.current_priority()
+        future = Future()
+        if self.stopped: ### stopped on purpose, e.g. by close()
+            future.cancel()
+            return future
+        if not self.running:
+            self.start()
+
+        with self._cond:
+            key = write_key(command) if is_write(command) else None
+            if key is None:
+                ### a read of the parameter must see every write queued before it
+                request = self._pending_writes.pop(command.strip().rstrip('?'), None)
+                if request is not None:
+                    self.__promote__(request, priority)
+            else:
+                request = self._pending_writes.get(key)
+                if request is not None:
+                    request.command = command
+                    request.futures.append(future)
+                    self.__promote__(request, priority)
+                    self.coalesced[priority] += 1
+                    self._cond.notify()
+                    return future
+
+            request = __Request__(priority, next(self._counter), command, key, self.clock.monotonic())
+            request.futures.append(future)
+            heapq.heappush(self._heap, request)
+            if key is not None:
+                self._pending_writes[key] = request
+            self._cond.notify()
+        return future
+
+    def __promote__(self, request, priority):
+        """ Moves a queued request up to priority if that is more urgent, called with self._cond held """
+        if request.priority > priority:
+            request.priority = priority
+            request.seq = next(self._counter)
+            heapq.heapify(self._heap)
+        return
+
+    def submit_batch(self, commands, priority = None):
+        """
+        Sends commands back to back as one request, nothing else goes on the wire
+        in between (e.g. the lines of a macro upload). Never coalesced. The future
+        gets the list of replies, or the first exception (the rest is not sent).
+        """
+        if priority is None:
+            priority = self.current_priority()
+        future = Future()
+        if self.stopped: ### stopped on purpose, e.g. by close()
+            future.cancel()
+            return future
+        if not self.running:
+            self.start()
+        with self._cond:
+            request = __Request__(priority, next(self._counter), tuple(commands), None, self.clock.monotonic())
+            request.futures.append(future)
+            heapq.heappush(self._heap, request)
+            self._cond.notify()
+        return future
+
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+    def __worker__(self):
+        while True:
+            with self._cond:
+                while self.running and not self._heap:
+                    self._cond.wait()
+                if not self.running:
+                    return
+                request = heapq.heappop(self._heap)
+                if request.key is not None and self._pending_writes.get(request.key) is request:
+                    del self._pending_writes[request.key]
+                waited = self.clock.monotonic() - request.submitted
+                self.max_wait_s[request.priority] = max(self.max_wait_s[request.priority], waited)
+                self.sent[request.priority] += 1
+
+            futures = [future for future in request.futures if future.set_running_or_notify_cancel()]
+            if not futures:
+                continue
+            try:
+                if isinstance(request.command, tuple):
+                    response = [self.transact(command) for command in request.command]
+                else:
+                    response = self.transact(request.command)
+            except BaseException as e:
+                for future in futures:
+                    future.set_exception(e)
+            else:
+                for future in futures:
+                    future.set_result(response)
+
+    def stats(self):
+        return {PRIORITY_NAMES[p]: {"sent": self.sent[p], "coalesced": self.coalesced[p], "max_wait_s": self.max_wait_s[p]}
+                for p in PRIORITY_NAMES}
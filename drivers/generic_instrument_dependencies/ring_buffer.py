@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+import numpy as np
+
+
+class RingBuffer:
+    """
+    Preallocated circular buffer of (channels x length) samples plus a
+    timestamp per sample.
+
+    Every sample is written twice, at slot i and slot i + length, so the last
+    `length` samples always sit in one contiguous slice of the backing array.
+    Appending is O(1) whatever the length and readers get a time ordered
+    view without np.roll or a copy.
+
+    A view taken before an append stays valid, only its oldest column gets
+    overwritten by the newest sample, which is harmless for plotting. Copy
+    the view if you need it frozen.
+    """
+
+    def __init__(self, channels, length, dtype = float, fill = 0.):
+        self.channels = int(channels)
+        self.length = int(length)
+        self._buffer = np.full((self.channels, 2 * self.length), fill, dtype = dtype)
+        self._times = np.full(2 * self.length, np.nan)
+        ### monotonic number of samples ever appended, never wraps
+        self.write_index = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.write_index, self.length)
+
+    def append(self, values, timestamp = None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            i = self.write_index % self.length
+            self._buffer[:, i] = values
+            self._buffer[:, i + self.length] = values
+            self._times[i] = timestamp
+            self._times[i + self.length] = timestamp
+            self.write_index += 1
+        return self.write_index
+
+    def view(self):
+        """ Full (channels x length) window ordered oldest -> newest, unfilled slots keep the fill value """
+        start = self.write_index % self.length
+        return self._buffer[:, start:start + self.length]
+
+    def times(self):
+        """ Timestamps matching view(), NaN for unfilled slots """
+        start = self.write_index % self.length
+        return self._times[start:start + self.length]
+
+    def latest(self, n = None):
+        """ Last n filled samples (all filled samples by default) as a view """
+        filled = len(self)
+        n = filled if n is None else min(int(n), filled)
+        end = self.write_index % self.length + self.length
+        return self._buffer[:, end - n:end], self._times[end - n:end]
+
+    def last(self):
+        """ Newest sample and its timestamp, (None, None) when empty """
+        if self.write_index == 0:
+            return None, None
+        i = (self.write_index - 1) % self.length
+        return self._buffer[:, i], self._times[i]
+
+    def resize(self, length):
+        """ Changes the window length, keeping the newest samples (one off copy) """
+        with self._lock:
+            data, times = self.latest(length)
+            data, times = data.copy(), times.copy()
+            fill = self._buffer.dtype.type(0)
+            self.length = int(length)
+            self._buffer = np.full((self.channels, 2 * self.length), fill, dtype = self._buffer.dtype)
+            self._times = np.full(2 * self.length, np.nan)
+            n = data.shape[1]
+            self.write_index = n
+            self._buffer[:, :n] = data
+            self._buffer[:, self.length:self.length + n] = data
+            self._times[:n] = times
+            self._times[self.length:self.length + n] = times
+        return self
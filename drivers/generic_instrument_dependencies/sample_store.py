@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import os
+import threading
+import numpy as np
+
+from .ring_buffer import RingBuffer
+
+
+class SampleStore:
+    """
+    Sample store behind GenericInstrument.start_measurement.
+
+    accumulate = False: fixed window of the last n samples, backed by a
+    RingBuffer so appending never shifts the history.
+
+    accumulate = True: keeps every sample. The backing array grows by whole
+    chunks (at least doubling), so appends are amortised O(1) instead of
+    np.insert reallocating on every sample. If memory_cap samples are held in
+    RAM and a spill_path is given, the oldest half is appended to that file
+    as raw samples and only the newest half stays in memory.
+
+    view() is always a contiguous numpy view, no copy.
+    """
+
+    def __init__(self, n, accumulate = False, chunk_size = 4096, memory_cap = None,
+                 spill_path = None, dtype = float):
+        self.accumulate = accumulate
+        self.chunk_size = int(chunk_size)
+        self.memory_cap = memory_cap
+        self.spill_path = spill_path
+        self.dtype = np.dtype(dtype)
+        self.spilled = 0 ### number of samples moved to disk
+        self._spill_file = None
+        self._lock = threading.Lock()
+
+        if self.accumulate:
+            self._array = np.zeros(max(int(n), self.chunk_size), dtype = self.dtype)
+            self._count = 0
+            self._window = None
+        else:
+            self._array = None
+            self._window = RingBuffer(1, n, dtype = self.dtype)
+
+    def __len__(self):
+        if self.accumulate:
+            return self._count
+        return len(self._window)
+
+    @property
+    def total(self):
+        """ Samples ever appended, including the ones spilled to disk """
+        if self.accumulate:
+            return self.spilled + self._count
+        return self._window.write_index
+
+    def append(self, value):
+        if not self.accumulate:
+            self._window.append(value)
+            return self
+
+        with self._lock:
+            if self._count == self._array.shape[0]:
+                if self.memory_cap is not None and self.spill_path and self._count >= self.memory_cap:
+                    self.__spill__()
+                else:
+                    self.__grow__()
+            self._array[self._count] = value
+            self._count += 1
+        return self
+
+    def view(self):
+        if self.accumulate:
+            return self._array[:self._count]
+        return self._window.view()[0]
+
+    def __grow__(self):
+        new_size = max(2 * self._array.shape[0], self._array.shape[0] + self.chunk_size)
+        if self.memory_cap is not None and self.spill_path:
+            new_size = min(new_size, max(int(self.memory_cap), self._count + 1))
+        grown = np.zeros(new_size, dtype = self.dtype)
+        grown[:self._count] = self._array[:self._count]
+        self._array = grown
+        return
+
+    def __spill__(self):
+        keep = self._count // 2
+        spill = self._count - keep
+        if self._spill_file is None:
+            ### fresh file per store, so read_spilled can map it from offset 0
+            self._spill_file = open(self.spill_path, 'wb')
+        self._array[:spill].tofile(self._spill_file)
+        self._spill_file.flush()
+        self._array[:keep] = self._array[spill:self._count]
+        self._count = keep
+        self.spilled += spill
+        return
+
+    def read_spilled(self):
+        """ Memory-mapped view of everything spilled to disk so far, oldest first """
+        if not self.spill_path or self.spilled == 0 or not os.path.exists(self.spill_path):
+            return np.zeros(0, dtype = self.dtype)
+        return np.memmap(self.spill_path, dtype = self.dtype, mode = 'r', shape = (self.spilled,))
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        return
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+import threading
+
+
+def same_value(a, b):
+    """ '40', '40.0' and ' 40.000' are the same setting, 'On' and 'on' too """
+    if a is None or b is None:
+        return False
+    a, b = str(a).strip(), str(b).strip()
+    try:
+        return float(a) == float(b)
+    except ValueError:
+        return a.lower() == b.lower()
+
+
+def parse_readback(response):
+    """ 'hpump.PID.Setpoint = 40.0' -> '40.0', a bare value is returned as is """
+    if response is None:
+        return None
+    return response.split("=", 1)[1].strip() if "=" in response else response.strip()
+
+
+class ShadowRegisters:
+    """
+    Last known value of every parameter written to an instrument, keyed by
+    parameter name (e.g. 'hpump.PID.Setpoint').
+
+    Only values we wrote (or read back) are known. Anything that can change the
+    device behind our back (abort, a macro, a reconnect) should invalidate the
+    affected keys so the next config push sends them again.
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default = None):
+        with self._lock:
+            return self._values.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = str(value).strip()
+        return self
+
+    def matches(self, key, value):
+        with self._lock:
+            return same_value(self._values.get(key), value)
+
+    def invalidate(self, prefix = None, suffix = None, key = None):
+        """ Forgets every key (default), the ones starting with prefix / ending with suffix, or exactly key """
+        with self._lock:
+            if key is not None:
+                self._values.pop(key, None)
+                return self
+            for name in list(self._values):
+                if (prefix is None or name.startswith(prefix)) and (suffix is None or name.endswith(suffix)):
+                    del self._values[name]
+        return self
+
+    def clear(self):
+        return self.invalidate()
+
+    def items(self):
+        with self._lock:
+            return dict(self._values)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import os
+import secrets
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+
+class SharedFrameRing:
+    """
+    Ring of `slots` frames (float64 arrays of up to 4 dimensions) in a
+    multiprocessing.shared_memory segment, for handing plot data from one
+    process to another without pickling.
+
+    The writer copies each frame into the next slot and then bumps the
+    sequence counter in the header, which is the doorbell: a reader compares
+    it with the last sequence it saw and maps the newest slot as a numpy
+    view, no copy.
+
+        ring = SharedFrameRing.create()           ### writer process
+        ring.write(data)
+        ... pass ring.name to the other process ...
+        ring = SharedFrameRing.attach(name)       ### reader process
+        seq, frame = ring.latest()
+
+    A view stays valid until the writer laps the ring, `slots - 1` frames
+    later, after which it shows newer data. That is harmless for plotting,
+    copy the frame if you need it frozen.
+
+    A frame larger than the capacity moves the ring to a new segment of at
+    least double the size, readers follow the move on their next read. Only
+    the writer unlinks the segments, on close().
+    """
+
+    HEADER = 8 ### seq, moved to generation, slots, capacity, generation, spare
+    SLOT_HEADER = 6 ### seq, ndim, shape (up to 4 dimensions)
+    MAX_DIMS = 4
+
+    def __init__(self, shm, base, writer, retired = None):
+        self.shm = shm
+        self.base = base
+        self.writer = writer
+        self._retired = retired if retired is not None else [] ### older generations, closed on close()
+        self.__map__()
+
+    def __map__(self):
+        head = np.ndarray(self.HEADER, dtype = np.int64, buffer = self.shm.buf)
+        self.slots = int(head[2])
+        self.capacity = int(head[3])
+        self.generation = int(head[4])
+        meta = np.ndarray(self.HEADER + self.slots * self.SLOT_HEADER, dtype = np.int64, buffer = self.shm.buf)
+        self._header = meta[:self.HEADER]
+        self._slot_headers = meta[self.HEADER:].reshape(self.slots, self.SLOT_HEADER)
+        self._data = np.ndarray((self.slots, self.capacity), dtype = np.float64,
+                                buffer = self.shm.buf, offset = meta.nbytes)
+        return
+
+    @staticmethod
+    def segment_name(base, generation):
+        return base if generation == 0 else f"{base}_{generation}"
+
+    @classmethod
+    def __new_segment__(cls, base, generation, capacity, slots, seq = 0):
+        size = (cls.HEADER + slots * cls.SLOT_HEADER) * 8 + slots * capacity * 8
+        shm = shared_memory.SharedMemory(name = cls.segment_name(base, generation), create = True, size = size)
+        head = np.ndarray(cls.HEADER, dtype = np.int64, buffer = shm.buf)
+        head[:] = [seq, 0, slots, capacity, generation, 0, 0, 0]
+        return shm
+
+    @classmethod
+    def create(cls, capacity = 1 << 16, slots = 4, base = None):
+        """ Writer side, capacity in float64 values per frame """
+        base = base or f"lp{secrets.token_hex(5)}" ### short, macOS caps names at 31 chars
+        return cls(cls.__new_segment__(base, 0, int(capacity), int(slots)), base, writer = True)
+
+    @staticmethod
+    def __open__(name):
+        try:
+            return shared_memory.SharedMemory(name = name, track = False) ### python 3.13+
+        except TypeError:
+            pass
+        ### a forked reader shares the writer's resource tracker, where the segment is registered already
+        inherited = getattr(resource_tracker._resource_tracker, "_fd", None) is not None
+        shm = shared_memory.SharedMemory(name = name)
+        if os.name == "posix" and not inherited:
+            ### the reader does not own the segment, keep its own tracker from unlinking it on exit
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+    @classmethod
+    def attach(cls, name):
+        """ Reader side, name is the writer's ring.name """
+        return cls(cls.__open__(name), name, writer = False)
+
+    @property
+    def name(self):
+        return self.base
+
+    @property
+    def seq(self):
+        """ Number of frames written so far, 0 before the first one """
+        return int(self._header[0])
+
+    def write(self, frame):
+        """ Publishes a frame (anything np.asarray turns into numbers), returns its sequence number """
+        frame = np.asarray(frame, dtype = np.float64)
+        if frame.ndim > self.MAX_DIMS:
+            raise ValueError(f"frames have at most {self.MAX_DIMS} dimensions, got {frame.shape}")
+        if frame.size > self.capacity:
+            self.__grow__(frame.size)
+        seq = self.seq + 1
+        slot = seq % self.slots
+        meta = self._slot_headers[slot]
+        meta[0] = 0 ### slot being written
+        self._data[slot, :frame.size] = frame.ravel()
+        meta[1] = frame.ndim
+        meta[2:2 + frame.ndim] = frame.shape
+        meta[0] = seq
+        self._header[0] = seq ### doorbell, last
+        return seq
+
+    def __grow__(self, size):
+        capacity = max(2 * self.capacity, int(size))
+        generation = self.generation + 1
+        shm = self.__new_segment__(self.base, generation, capacity, self.slots, seq = self.seq)
+        self._retired.append(self.shm)
+        self._header[1] = generation ### readers move over on their next read
+        self.shm = shm
+        self.__map__()
+        return
+
+    def __follow__(self):
+        while not self.writer and self._header[1]:
+            shm = self.__open__(self.segment_name(self.base, int(self._header[1])))
+            self._retired.append(self.shm)
+            self.shm = shm
+            self.__map__()
+        return
+
+    def latest(self):
+        """ (seq, newest frame as a view), (seq, None) when nothing was written or the slot is mid-write """
+        self.__follow__()
+        seq = self.seq
+        if seq == 0:
+            return 0, None
+        slot = seq % self.slots
+        meta = self._slot_headers[slot]
+        ndim = int(meta[1])
+        shape = tuple(int(n) for n in meta[2:2 + ndim])
+        if int(meta[0]) != seq: ### the writer lapped the ring between the two reads
+            return seq, None
+        frame = self._data[slot, :int(np.prod(shape))].reshape(shape)
+        return seq, frame
+
+    def close(self):
+        """ Unmaps the ring, the writer also unlinks every segment it created """
+        self._header = self._slot_headers = self._data = None
+        for shm in self._retired + [self.shm]:
+            try:
+                shm.close()
+            except BufferError: ### a frame view is still alive somewhere, the mapping goes with it
+                pass
+            if self.writer:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:
+                    pass
+        self._retired = []
+        return
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import socket
+import threading
+import time
+
+from pyvisa import VisaIOError
+from pyvisa.constants import StatusCode
+
+
+def parse_tcp_address(address):
+    """ 'tcp://192.168.1.50:23' -> ('192.168.1.50', 23) """
+    if not address.lower().startswith("tcp://"):
+        raise ValueError(f"Not a tcp:// address: {address}")
+    host, _, port = address[len("tcp://"):].rstrip("/").rpartition(":")
+    if not host or not port:
+        raise ValueError(f"tcp address needs host and port, e.g. tcp://192.168.1.50:23, got {address}")
+    return host, int(port)
+
+
+class TCPTransport:
+    """
+    Line based text protocol over a TCP socket, a drop-in for the pyvisa
+    serial resource (query/write/read/close, timeout in ms).
+
+    The connection is opened lazily, kept alive with TCP keepalive probes and
+    reopened when it drops: a send on a dead socket reconnects and resends
+    once, a reply that times out closes the socket (the stream would be out of
+    step) so the next command starts on a fresh connection. Failures surface as
+    VisaIOError like on the serial line, so GenericInstrument handles both alike.
+    Reconnects back off from reconnect_backoff_s up to max_backoff_s.
+    """
+
+    def __init__(self, host, port, read_term = '\r\n', write_term = '\n', timeout = 2000,
+                 keepalive_idle_s = 10, reconnect_backoff_s = 0.5, max_backoff_s = 30.):
+        self.host = host
+        self.port = int(port)
+        self.read_term = read_term.encode('ascii')
+        self.write_term = write_term.encode('ascii')
+        self._timeout = timeout
+        self.keepalive_idle_s = keepalive_idle_s
+        self.reconnect_backoff_s = reconnect_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.baud_rate = None ### set by serial minded callers, meaningless here
+        self.reconnects = 0 ### connections opened after the first one
+        self.connections = 0
+        self._sock = None
+        self._rx = b""
+        self._next_attempt = 0.
+        self._backoff_s = reconnect_backoff_s
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_address(cls, address, **kwargs):
+        host, port = parse_tcp_address(address)
+        return cls(host, port, **kwargs)
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout_ms):
+        self._timeout = timeout_ms
+        if self._sock is not None:
+            try:
+                self._sock.settimeout(timeout_ms / 1000.)
+            except OSError: ### dead socket, reconnect on the next command
+                self.__drop__()
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def __connect__(self):
+        if self._sock is not None:
+            return self._sock
+        now = time.monotonic()
+        if now < self._next_attempt:
+            raise VisaIOError(StatusCode.error_connection_lost)
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout = self._timeout / 1000.)
+        except OSError:
+            self._next_attempt = now + self._backoff_s
+            self._backoff_s = min(2 * self._backoff_s, self.max_backoff_s)
+            raise VisaIOError(StatusCode.error_connection_lost)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) ### small commands, no Nagle delay
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in [("TCP_KEEPIDLE", self.keepalive_idle_s), ("TCP_KEEPINTVL", self.keepalive_idle_s), ("TCP_KEEPCNT", 3)]:
+            if hasattr(socket, option): ### not on every platform
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), int(value))
+        sock.settimeout(self._timeout / 1000.)
+        self._sock = sock
+        self._rx = b""
+        self._backoff_s = self.reconnect_backoff_s
+        self.reconnects += self.connections > 0
+        self.connections += 1
+        return sock
+
+    def __drop__(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._rx = b""
+        return
+
+    def __send__(self, command):
+        data = command.encode('ascii') + self.write_term
+        for attempt in range(2):
+            sock = self.__connect__()
+            try:
+                sock.sendall(data)
+                return
+            except OSError:
+                self.__drop__()
+        raise VisaIOError(StatusCode.error_connection_lost)
+
+    def __read_line__(self):
+        while self.read_term not in self._rx:
+            try:
+                chunk = self._sock.recv(4096)
+            except socket.timeout:
+                self.__drop__()
+                raise VisaIOError(StatusCode.error_timeout)
+            except OSError:
+                self.__drop__()
+                raise VisaIOError(StatusCode.error_connection_lost)
+            if not chunk: ### peer closed
+                self.__drop__()
+                raise VisaIOError(StatusCode.error_connection_lost)
+            self._rx += chunk
+        line, _, self._rx = self._rx.partition(self.read_term)
+        return line.decode('ascii', errors = 'replace')
+
+    def query(self, command):
+        with self._lock:
+            self.__send__(command)
+            return self.__read_line__()
+
+    def write(self, command):
+        with self._lock:
+            self.__send__(command)
+        return len(command)
+
+    def read(self):
+        with self._lock:
+            self.__connect__()
+            return self.__read_line__()
+
+    def close(self):
+        with self._lock:
+            self.__drop__()
+        return
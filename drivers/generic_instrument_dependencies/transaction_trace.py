@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import struct
+import threading
+from collections import namedtuple
+
+import numpy as np
+from pyvisa import VisaIOError
+
+from .clock import SYSTEM_CLOCK
+
+
+### file = MAGIC + VERSION, then one record per transaction:
+###     timestamp (f8, unix s at send), latency (f4, s), flags (u1), command length (u2),
+###     response length (u4), command bytes, response bytes (both utf-8)
+MAGIC = b"CTRC"
+VERSION = 1
+HEADER = struct.Struct("<4sH")
+RECORD = struct.Struct("<dfBHI")
+FLAG_ERROR = 1 ### response holds the error (VisaIOError code or message) instead of an answer
+FLAG_WRITE = 2 ### write() without a response
+
+Transaction = namedtuple("Transaction", ["timestamp", "latency_s", "command", "response", "error", "write"])
+
+
+class TraceExhausted(EOFError):
+    pass
+
+
+class ReplayMismatch(ValueError):
+    pass
+
+
+class TraceWriter:
+    """ Appends transactions to a binary trace file, safe to share between threads """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def write(self, timestamp, latency_s, command, response = None, error = False, write = False):
+        command = command.encode('utf-8')
+        response = ("" if response is None else str(response)).encode('utf-8')
+        flags = (FLAG_ERROR if error else 0) | (FLAG_WRITE if write else 0)
+        with self._lock:
+            self._file.write(RECORD.pack(timestamp, latency_s, flags, len(command), len(response)))
+            self._file.write(command)
+            self._file.write(response)
+            self.count += 1
+        return
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+        return self
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+        return
+
+
+def read_trace(path):
+    """ Yields every Transaction of a trace file in recording order """
+    with open(path, 'rb') as f:
+        magic, version = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a transaction trace")
+        if version != VERSION:
+            raise ValueError(f"Unsupported trace version {version} in {path}")
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size: ### end of file, or a record cut short by a crash
+                return
+            timestamp, latency_s, flags, command_len, response_len = RECORD.unpack(head)
+            body = f.read(command_len + response_len)
+            if len(body) < command_len + response_len:
+                return
+            yield Transaction(timestamp, latency_s,
+                              body[:command_len].decode('utf-8'), body[command_len:].decode('utf-8'),
+                              bool(flags & FLAG_ERROR), bool(flags & FLAG_WRITE))
+
+
+def summarize_trace(path):
+    """ {command: {"count", "errors", "mean_s", "p50_s", "p99_s", "max_s"}} of the query latencies in a trace """
+    latencies, errors = {}, {}
+    for transaction in read_trace(path):
+        latencies.setdefault(transaction.command, []).append(transaction.latency_s)
+        errors[transaction.command] = errors.get(transaction.command, 0) + transaction.error
+    summary = {}
+    for command, values in latencies.items():
+        values = np.asarray(values)
+        summary[command] = {"count": len(values), "errors": errors[command],
+                            "mean_s": float(values.mean()), "p50_s": float(np.percentile(values, 50)),
+                            "p99_s": float(np.percentile(values, 99)), "max_s": float(values.max())}
+    return summary
+
+
+class RecordingTransport:
+    """
+    Wraps an open client (pyvisa resource or any transport) and records every
+    query/write with its response, send time and latency to a trace file.
+    Errors are recorded and re-raised, so the instrument sees the same failures.
+    Attributes that are not part of the wrapper (baud_rate, timeout, ...) go to
+    the wrapped client.
+    """
+
+    _own = ("client", "writer", "clock")
+
+    def __init__(self, client, path, clock = SYSTEM_CLOCK):
+        object.__setattr__(self, "client", client)
+        object.__setattr__(self, "writer", TraceWriter(path))
+        object.__setattr__(self, "clock", clock)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def __setattr__(self, name, value):
+        if name in self._own:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.client, name, value)
+
+    def __transact__(self, method, command, write):
+        timestamp = self.clock.time()
+        t0 = self.clock.monotonic()
+        try:
+            response = method(command)
+        except VisaIOError as e:
+            self.writer.write(timestamp, self.clock.monotonic() - t0, command, e.error_code, error = True, write = write)
+            raise
+        except Exception as e:
+            self.writer.write(timestamp, self.clock.monotonic() - t0, command, repr(e), error = True, write = write)
+            raise
+        self.writer.write(timestamp, self.clock.monotonic() - t0, command, None if write else response, write = write)
+        return response
+
+    def query(self, command):
+        return self.__transact__(self.client.query, command, write = False)
+
+    def write(self, command):
+        return self.__transact__(self.client.write, command, write = True)
+
+    def stop(self):
+        """ Closes the trace and returns the wrapped client """
+        self.writer.close()
+        return self.client
+
+    def close(self):
+        self.writer.close()
+        return self.client.close()
+
+
+class ReplayTransport:
+    """
+    Serves a recorded trace back as a transport (see GenericInstrument(transport = ...)).
+
+    realtime = False answers as fast as possible; realtime = True sleeps on clock so
+    every response comes back at the same offset from the first query as when it
+    was recorded (a VirtualClock makes that instantaneous but still time-stamped).
+    strict = True raises ReplayMismatch when the code sends a different command than
+    the trace has next; strict = False skips forward to the next matching one
+    (counted in mismatches). Recorded errors are raised again, VisaIOError with the
+    original code where there was one. TraceExhausted is raised at the end.
+    """
+
+    def __init__(self, path, realtime = False, strict = True, clock = SYSTEM_CLOCK):
+        self.path = path
+        self.transactions = list(read_trace(path))
+        self.realtime = realtime
+        self.strict = strict
+        self.clock = clock
+        self.position = 0
+        self.mismatches = 0
+        self.baud_rate = 9600
+        self.timeout = 2000
+        self._t0 = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.transactions)
+
+    def __next_transaction__(self, command):
+        with self._lock:
+            for i in range(self.position, len(self.transactions)):
+                if self.transactions[i].command == command:
+                    self.mismatches += i - self.position
+                    self.position = i + 1
+                    return self.transactions[i]
+                if self.strict:
+                    raise ReplayMismatch(f"Trace has '{self.transactions[i].command}' at {i}, got '{command}'")
+            raise TraceExhausted(f"No more '{command}' in {self.path} (position {self.position})")
+
+    def __pace__(self, transaction):
+        if self._t0 is None:
+            self._t0 = self.clock.monotonic() - (transaction.timestamp - self.transactions[0].timestamp)
+        due = self._t0 + (transaction.timestamp - self.transactions[0].timestamp) + transaction.latency_s
+        self.clock.sleep(due - self.clock.monotonic())
+        return
+
+    def query(self, command):
+        transaction = self.__next_transaction__(command)
+        if self.realtime:
+            self.__pace__(transaction)
+        if transaction.error:
+            try:
+                code = int(transaction.response)
+            except ValueError:
+                raise IOError(f"Recorded error on '{command}': {transaction.response}")
+            raise VisaIOError(code)
+        return transaction.response
+
+    def write(self, command):
+        self.query(command)
+        return len(command)
+
+    def rewind(self):
+        with self._lock:
+            self.position = 0
+            self.mismatches = 0
+            self._t0 = None
+        return self
+
+    def stats(self):
+        return {"transactions": len(self.transactions), "served": self.position, "mismatches": self.mismatches}
+
+    def close(self):
+        return
@@ -12,6 +12,8 @@ import multiprocess as mp, queue
 from queue import Empty
 import operator
 
+from generic_instrument_dependencies.shared_frames import SharedFrameRing
+
 
 '''
 General threadsafe subprocessed live plotter using pyqtgraph 
@@ -23,15 +25,17 @@ workerbee, liveplotterwindow, livemultwindow, LiveWindowLike set up
 the plot styling and update system
 
 liveplotprocess, liveplotagent, __Qapp_liveplot__ set up the data transfer
-ecosystem based on multiprocessing task/data queues
+ecosystem: commands and window states go over multiprocessing queues, plot
+data goes through one shared memory frame ring per window key (SharedFrameRing),
+written by the agent and read in place by the plot process
 
 USER ACCESSED FUNCTIONS AT BOTTOM OF SCRIPT
 '''
 
 class __WorkerBee__(QtCore.QThread): 
     """
-    WorkerBee is a QThread object that emits a signal every
-                                                    refresh_interval seconds.
+    WorkerBee is a QThread object that polls its window's data channel every
+    refresh_interval seconds and emits a signal when there is a new frame.
     The signal is connected to a slot in the LivePlotterWindow object that
                                                             updates the plot.
     """
@@ -51,7 +55,8 @@ class __WorkerBee__(QtCore.QThread):
 
         while not self.isHidden():
             data = self.data_func()
-            self.signal1.emit(data)
+            if data is not None: ### None: nothing new since the last refresh, keep what is drawn
+                self.signal1.emit(data)
             time.sleep(self.refresh_interval)
         self.quit()
         print("WorkerBee vi saluta")
@@ -289,11 +294,36 @@ class __LiveHeatMap__(__LiveWindowLike__):
 ###################################################################################
 ###################################################################################
 ###################################################################################
-def __Qapp_liveplot__(task_q, state_q, data_q, clock, verbose):
+class __PlotChannel__:
+    """
+    One window's read end of its key's frame ring, with latest value
+    semantics: poll() gives the newest frame if this window has not drawn it
+    yet and None otherwise. Every window has its own channel, so none of them
+    takes frames away from another, and a slow window skips straight to the
+    newest frame instead of working through a backlog.
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.seq = 0 ### sequence number of the last frame handed out
+        self.frames = 0
+        self.skipped = 0 ### frames published between two polls, never drawn
+
+    def poll(self):
+        seq, frame = self.ring.latest()
+        if frame is None or seq == self.seq:
+            return None
+        if self.seq:
+            self.skipped += max(seq - self.seq - 1, 0)
+        self.seq = seq
+        self.frames += 1
+        return frame
+###################################################################################
+def __Qapp_liveplot__(task_q, state_q, clock, verbose):
     app = QApplication([])
     try:
         liveplot_instance = __LivePlotProcess__(
-            task_q, state_q, data_q, clock, app, verbose
+            task_q, state_q, clock, app, verbose
         )
     except Exception as e:
         raise e
@@ -301,7 +331,7 @@ def __Qapp_liveplot__(task_q, state_q, data_q, clock, verbose):
 ###################################################################################
 
 class __LivePlotProcess__:
-    def __init__(self, task_q, state_q, data_q, clock, app, verbose):
+    def __init__(self, task_q, state_q, clock, app, verbose):
         self.app = app
         self.verbose = verbose
         self.windows = {}
@@ -309,7 +339,8 @@ class __LivePlotProcess__:
         self.clock_interval = clock
         self.task_q = task_q
         self.state_q = state_q
-        self.data_q = data_q
+        self.rings = {} ### window key -> SharedFrameRing mapped from the agent
+        self.channels = {} ### window key -> __PlotChannel__ of the window showing it
         self.isalive = True
         self.window_states = {}
         self.main_loop()
@@ -329,21 +360,25 @@ class __LivePlotProcess__:
                 if new_task[0] == "new_live_plot":
                     ### task[1] should be window identifier key (any str)
                     ### task[2] should be plotter kwargs
+                    ### task[3] should be the name of the key's shared frame ring
                     if self.verbose:
                         print("command received!!")
                         print(new_task)
+                    self.__attach__(new_task[1], new_task[3])
                     self.new_window(new_task[1], **new_task[2])
 
                 elif new_task[0] == "new_multi_plot":
                     if self.verbose:
                         print("command received!!")
                         print(new_task)
+                    self.__attach__(new_task[1], new_task[3])
                     self.new_multiwindow(new_task[1], **new_task[2])
 
                 elif new_task[0] == "new_heatmap":
                     if self.verbose:
                         print("command received!!")
                         print(new_task)
+                    self.__attach__(new_task[1], new_task[3])
                     self.new_liveplot_heatmap(new_task[1], **new_task[2])
 
                 elif new_task[0] == "break":
@@ -363,23 +398,42 @@ class __LivePlotProcess__:
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
+        self.channels = {}
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
         if self.verbose:
             print("LivePlotProcess exiting ciao bella ciao")
         return
 
-    def __internal_data_func__(self, key):
+    def __attach__(self, key, ring_name):
+        ### a reused window key keeps its ring, so only map it once
+        ring = self.rings.get(str(key))
+        if ring is None or ring.name != ring_name:
+            if ring is not None:
+                ring.close()
+            self.rings[str(key)] = SharedFrameRing.attach(ring_name)
+        return self
+
+    def __channel__(self, key):
+        ### a fresh channel per window, so a window reusing a key draws the newest frame straight away
         try:
-            dict = self.data_q.get_nowait()
-            return dict[str(key)]
-        except Empty:
-            return np.array([])
+            self.channels[str(key)] = __PlotChannel__(self.rings[str(key)])
         except KeyError:
             if self.verbose:
-                print("Keyerror, buffering")
-            return np.array([])
+                print("Keyerror, no frame ring for this window")
+            self.channels.pop(str(key), None)
+        return self.channels.get(str(key))
+
+    def __internal_data_func__(self, channel):
+        ### newest frame of this window's ring read in place, None when there is nothing new
+        if channel is None:
+            return None
+        try:
+            return channel.poll()
         except Exception as e:
             print(e)
-            return np.array([])
+            return None
 
     def new_window(self, key, **plot_kwargs):
         ### we can pass a self function because it has no direct
@@ -393,7 +447,7 @@ class __LivePlotProcess__:
             print(f"Refreshing plot at {refresh_interval}s")
 
         self.windows[str(key)] = __LivePlotterWindow__(
-            data_func = partial(self.__internal_data_func__, str(key)),
+            data_func = partial(self.__internal_data_func__, self.__channel__(key)),
             **plot_kwargs,
             verbose = self.verbose,
         )
@@ -412,7 +466,7 @@ class __LivePlotProcess__:
             print(f"Refreshing plot at {refresh_interval}s")
 
         self.windows[str(key)] = __LiveMultiWindow__(
-            data_func = partial(self.__internal_data_func__, str(key)),
+            data_func = partial(self.__internal_data_func__, self.__channel__(key)),
             **plot_kwargs,
             verbose = self.verbose,
         )
@@ -428,7 +482,7 @@ class __LivePlotProcess__:
             print(f"Refreshing plot at {refresh_interval}s")
 
         self.windows[str(key)] = __LiveHeatMap__(
-            data_func = partial(self.__internal_data_func__, str(key)),
+            data_func = partial(self.__internal_data_func__, self.__channel__(key)),
             **plot_kwargs,
             verbose = self.verbose,
         )
@@ -445,8 +499,9 @@ class LivePlotAgent:
     Sub-threading method (plot_live_plot) works with spyder, not with anything else.
     To be console-agnostic, we try sub-processing, mediated by ProcessManager class.
 
-    LivePlotAgent class hosts the Queue method which lets us pipe commands and data into
-    the live plotting subprocess.
+    LivePlotAgent class hosts the Queue method which lets us pipe commands into
+    the live plotting subprocess. Data for each window goes into its own shared
+    memory frame ring, which the subprocess maps, so frames are never pickled.
     """
 
     def __init__(self, clock=0.1, verbose=False):
@@ -458,13 +513,11 @@ class LivePlotAgent:
         self.verbose = verbose
         self.task_q = mp.Queue()
         self.state_q = mp.Queue()
-        self.data_q = mp.Queue(maxsize=50)  ##need to play with buffer size
         self.process = mp.Process(
             target=__Qapp_liveplot__,
             args=(
                 self.task_q,
                 self.state_q,
-                self.data_q,
                 self.clock_interval,
                 self.verbose,
             ),
@@ -473,12 +526,9 @@ class LivePlotAgent:
         self.process.start()
         self.window_no = 0
         self.available_window_keys = []
-        self.data = {}
+        self.channels = {} ### window key -> SharedFrameRing, written by the FetchData threads
         self.states = {}
         self.active = True
-        threading.Thread(
-            target=self.__transmit_data__, daemon=True, name="Data broadcast thread"
-        ).start()
         threading.Thread(
             target=self.__check_states__,
             daemon=True,
@@ -498,6 +548,9 @@ class LivePlotAgent:
         time.sleep(1)
         self.__flush_queues__()
         self.process.terminate()
+        for channel in self.channels.values():
+            channel.close()
+        self.channels = {}
         return self
 
     def __flush_queues__(self):
@@ -513,13 +566,10 @@ class LivePlotAgent:
             print("flushing memory queues")
         # self.task_q.close()
         # self.state_q.close()
-        # self.data_q.close()
         while not self.task_q.empty():
             __internal_flush__(self, self.task_q)
         while not self.state_q.empty():
             __internal_flush__(self, self.state_q)
-        while not self.data_q.empty():
-            __internal_flush__(self, self.data_q)
         return self
 
     def __fetch_data__(self, data_func, key, kill_func):
@@ -527,14 +577,14 @@ class LivePlotAgent:
         start = time.time()
 
         while time.time() - start < 5:
-            self.data[str(key)] = data_func()
+            self.__publish__(key, data_func())
             time.sleep(self.clock_interval)
 
         while alive:
             try:
                 window_isopen = self.states[str(key)]
                 if window_isopen:
-                    self.data[str(key)] = data_func()
+                    self.__publish__(key, data_func())
                     time.sleep(self.clock_interval)
                 else:
                     if kill_func:
@@ -547,13 +597,15 @@ class LivePlotAgent:
             print("thread exiting!!!!!!!!!!!")
         return
 
-    def __transmit_data__(self):
-        if self.verbose:
-            print("starting transmission data thread")
-        while self.active:
-            if True in self.states.values():
-                self.data_q.put(self.data)
-            time.sleep(1e-20)
+    def __publish__(self, key, data):
+        ### one copy into the key's shared ring, the plot process picks it up from there
+        if not self.active: ### rings are closed on exit
+            return
+        try:
+            self.channels[str(key)].write(data)
+        except (ValueError, TypeError) as e:
+            print(f"Live plot {key}: frame skipped, data must be a numeric array: {e}")
+        return
 
     def __check_states__(self):
         while self.active:
@@ -579,7 +631,8 @@ class LivePlotAgent:
             if not self.states[key] and key not in self.available_window_keys:
                 if self.verbose:
                     print(f"Cleaning data for key:{key}")
-                self.data[key] = np.array([])
+                if key in self.channels:
+                    self.__publish__(key, np.array([]))
 
     def __new_plot_prep__(self, data_func=None, kill_func=None):
         avail_win = None
@@ -600,7 +653,9 @@ class LivePlotAgent:
                 [[np.linspace(0, 1, 1000), np.random.rand(1000)]]
             )
 
-        self.data[key] = data_func()
+        if key not in self.channels:
+            self.channels[key] = SharedFrameRing.create()
+        self.__publish__(key, data_func())
         self.states[key] = True
 
         threading.Thread(
@@ -618,21 +673,21 @@ class LivePlotAgent:
 
     def new_liveplot_heatmap(self, data_func=None, kill_func=None, **plot_settings):
         key = self.__new_plot_prep__(data_func, kill_func)
-        self.task_q.put(["new_heatmap", key, plot_settings])
+        self.task_q.put(["new_heatmap", key, plot_settings, self.channels[key].name])
         if self.verbose:
             print("command sent!")
         return self
 
     def new_liveplot_multi(self, data_func=None, kill_func=None, **plot_settings):
         key = self.__new_plot_prep__(data_func, kill_func)
-        self.task_q.put(["new_multi_plot", key, plot_settings])
+        self.task_q.put(["new_multi_plot", key, plot_settings, self.channels[key].name])
         if self.verbose:
             print("command sent!")
         return self
 
     def new_liveplot(self, data_func=None, kill_func=None, **plot_settings):
         key = self.__new_plot_prep__(data_func, kill_func)
-        self.task_q.put(["new_live_plot", key, plot_settings])
+        self.task_q.put(["new_live_plot", key, plot_settings, self.channels[key].name])
         # self.task_q.put(['dummy', key, plot_settings])
         if self.verbose:
             print("command sent!")
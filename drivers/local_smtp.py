@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import time
+import threading
+import socketserver
+from email import message_from_bytes
+
+
+class LocalSMTPServer:
+    """
+    Minimal SMTP stand-in on localhost for tests of the mail sink, no relay and
+    no auth: it accepts HELO/EHLO, MAIL, RCPT, DATA, RSET, NOOP and QUIT and keeps
+    every message it gets.
+
+        with LocalSMTPServer() as smtp:
+            sink = SMTPSink("email", host = smtp.host, port = smtp.port, recipients = ["oncall@lab"])
+            ...
+            smtp.wait_for(1)
+            smtp.received      ### [(sender, [recipients], email.message.Message, unix time)]
+
+    fail_next(n) answers the next n DATA commands with a 451 (temporary failure).
+    """
+
+    def __init__(self, host = "127.0.0.1", port = 0, delay_s = 0.):
+        self.delay_s = delay_s
+        self.received = []
+        self._failures = 0
+        self._cond = threading.Condition()
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write((line + "\r\n").encode('ascii'))
+
+            def handle(self):
+                self.reply("220 localhost stand-in SMTP")
+                sender, recipients = None, []
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode('ascii', errors = 'replace').strip()
+                    verb = command[:4].upper()
+                    if verb in ["HELO", "EHLO"]:
+                        self.reply("250 localhost")
+                    elif verb == "MAIL":
+                        sender, recipients = command.split(":", 1)[1].strip(), []
+                        self.reply("250 OK")
+                    elif verb == "RCPT":
+                        recipients.append(command.split(":", 1)[1].strip())
+                        self.reply("250 OK")
+                    elif verb == "DATA":
+                        self.reply("354 End data with <CR><LF>.<CR><LF>")
+                        data = []
+                        while True:
+                            line = self.rfile.readline()
+                            if not line or line in [b".\r\n", b".\n"]:
+                                break
+                            data.append(line[1:] if line.startswith(b"..") else line)
+                        self.reply(server.__accept__(sender, recipients, b"".join(data)))
+                    elif verb in ["RSET", "NOOP"]:
+                        self.reply("250 OK")
+                    elif verb == "QUIT":
+                        self.reply("221 Bye")
+                        return
+                    else:
+                        self.reply("502 Command not implemented")
+
+        self.tcp = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.tcp.daemon_threads = True
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return
+
+    @property
+    def host(self):
+        return self.tcp.server_address[0]
+
+    @property
+    def port(self):
+        return self.tcp.server_address[1]
+
+    def __accept__(self, sender, recipients, data):
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        with self._cond:
+            if self._failures:
+                self._failures -= 1
+                return "451 Temporary failure, try again"
+            self.received.append((sender, list(recipients), message_from_bytes(data), time.time()))
+            self._cond.notify_all()
+        return "250 OK queued"
+
+    def fail_next(self, n = 1):
+        with self._cond:
+            self._failures += n
+        return self
+
+    def wait_for(self, n, timeout_s = 5.):
+        """ Waits until n messages were received, True if they were """
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self.received) >= n, timeout_s)
+
+    def start(self):
+        self._thread = threading.Thread(target = self.tcp.serve_forever, name = "local smtp", daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.tcp.shutdown()
+        self.tcp.server_close()
+        return
+
+
+if __name__ == '__main__':
+    ### python drivers/local_smtp.py, then point an smtp sink at localhost:8025
+    smtp = LocalSMTPServer(port = 8025).start()
+    print(f"SMTP stand-in listening on {smtp.host}:{smtp.port}, ctrl-c to stop")
+    try:
+        seen = 0
+        while True:
+            smtp.wait_for(seen + 1, timeout_s = 1.)
+            for sender, recipients, message, t in smtp.received[seen:]:
+                print(f"{time.strftime('%H:%M:%S', time.localtime(t))} {sender} -> {recipients}: {message['Subject']}")
+            seen = len(smtp.received)
+    except KeyboardInterrupt:
+        smtp.stop()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LocalWebhookServer:
+    """
+    Stand-in for a Slack incoming webhook on localhost, for tests of the alert
+    path without a network or a real channel:
+
+        with LocalWebhookServer() as hook:
+            slack_config = {"slack_url": hook.url, "error_code_messages": {...}}
+            ...
+            hook.wait_for(1)       ### blocks until one message arrived
+            hook.received          ### [(path, json payload, unix time)]
+
+    Faults to exercise retries: fail_next(n, status) answers the next n posts
+    with status (500, 429, ...), delay_s holds every answer that long.
+    """
+
+    def __init__(self, host = "127.0.0.1", port = 0, delay_s = 0.):
+        self.delay_s = delay_s
+        self.received = []
+        self.attempts = 0
+        self._failures = [] ### statuses to answer the next posts with
+        self._cond = threading.Condition()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1" ### keep-alive, so pooled connections get reused
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                status = server.__answer__(self.path, body)
+                reply = b"ok" if status == 200 else b"error"
+                self.send_response(status)
+                if status == 429:
+                    self.send_header("Retry-After", "0")
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                return
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/services/local"
+
+    def __answer__(self, path, body):
+        if self.delay_s:
+            time.sleep(self.delay_s)
+        with self._cond:
+            self.attempts += 1
+            if self._failures:
+                return self._failures.pop(0)
+            try:
+                payload = json.loads(body.decode('utf-8'))
+            except ValueError:
+                return 400
+            self.received.append((path, payload, time.time()))
+            self._cond.notify_all()
+        return 200
+
+    def fail_next(self, n = 1, status = 500):
+        with self._cond:
+            self._failures.extend([status] * n)
+        return self
+
+    def wait_for(self, n, timeout_s = 5.):
+        """ Waits until n messages were received, True if they were """
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self.received) >= n, timeout_s)
+
+    def start(self):
+        self._thread = threading.Thread(target = self.httpd.serve_forever, name = "local webhook", daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        return
+
+
+if __name__ == '__main__':
+    ### python drivers/local_webhook.py, then point slack_url at the printed url
+    hook = LocalWebhookServer(port = 8765).start()
+    print(f"Webhook stand-in listening on {hook.url}, ctrl-c to stop")
+    try:
+        seen = 0
+        while True:
+            hook.wait_for(seen + 1, timeout_s = 1.)
+            for path, payload, t in hook.received[seen:]:
+                print(f"{time.strftime('%H:%M:%S', time.localtime(t))} {path}: {payload}")
+            seen = len(hook.received)
+    except KeyboardInterrupt:
+        hook.stop()
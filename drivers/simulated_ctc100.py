@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+import re
+import time
+import asyncio
+import threading
+import socket
+import socketserver
+from datetime import datetime
+
+import numpy as np
+
+from tempcontroller_ctc100 import TempControl_CTC100
+from ctc100_macros import MACRO_DEFINE, MACRO_END, MACRO_RUN, MACRO_KILL, MACRO_STATUS
+
+
+class VirtualClock:
+    """
+    Drop-in replacement for clock.SystemClock with a time that does not follow the wall.
+
+    rate = None (step mode): sleep() and timed wait() return immediately and move the
+        clock forward by the requested time, so a 9 h evaporation abort path runs as
+        fast as the code around it. Deterministic, but only meant for one thread
+        driving the time (e.g. calling run_evaporation directly, without start_logging,
+        whose loop would advance the clock too).
+    rate = k: virtual time runs k times faster than real time, every sleep/wait is
+        shortened by k. Works with any number of threads (logging loop, auto cycle,
+        threshold triggers), e.g. rate = 1000 runs a day in ~90 s.
+
+    start is the unix time the clock starts at (default: now), so the daily schedule
+    of the auto cycle can be started at any time of day.
+    """
+
+    def __init__(self, start = None, rate = None):
+        self.start = time.time() if start is None else float(start)
+        self.rate = rate
+        self._offset = 0.
+        self._real_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def monotonic(self):
+        with self._lock:
+            if self.rate:
+                return self._offset + (time.monotonic() - self._real_start) * self.rate
+            return self._offset
+
+    def time(self):
+        return self.start + self.monotonic()
+
+    def now(self):
+        return datetime.fromtimestamp(self.time())
+
+    def advance(self, seconds):
+        """ Jumps the clock forward by seconds (in both modes) """
+        with self._lock:
+            self._offset += max(seconds, 0.)
+        return self
+
+    def sleep(self, seconds):
+        seconds = max(seconds, 0.)
+        if self.rate:
+            time.sleep(seconds / self.rate)
+        else:
+            self.advance(seconds)
+        return
+
+    def wait(self, event, seconds = None):
+        """ event.wait(seconds) in virtual time, True if the event got set """
+        if event.is_set():
+            return True
+        if seconds is None: ### nothing to advance to, only another thread can set it
+            return event.wait()
+        seconds = max(seconds, 0.)
+        if self.rate:
+            return event.wait(seconds / self.rate)
+        self.advance(seconds)
+        return event.is_set()
+
+    async def await_event(self, event, seconds = None):
+        """ asyncio flavour of wait() for an asyncio.Event, step mode yields to the loop once """
+        if event.is_set():
+            return True
+        if seconds is None:
+            await event.wait()
+            return True
+        seconds = max(seconds, 0.)
+        if self.rate:
+            try:
+                await asyncio.wait_for(event.wait(), seconds / self.rate)
+                return True
+            except asyncio.TimeoutError:
+                return event.is_set()
+        self.advance(seconds)
+        await asyncio.sleep(0)
+        return event.is_set()
+
+
+class SimulatedCTC100:
+    """
+    In-process stand-in for the CTC100 serial resource, passed as transport to
+    TempControl_CTC100 (or any GenericInstrument) instead of a pyvisa resource.
+
+    Answers getOutputNames?, getOutput?, <ch>.Value?, the PID/alarm/input/output
+    setters (stored as registers, read back with <ch>.<param>?), outputEnable,
+    <ch>.Off, waitForSample, abort and kill.all.
+
+    Macros (see ctc100_macros) are stored when uploaded and report as running
+    for macro_runtime_s after macro.run. Their code is not executed, so
+    a macro run only exercises the host side.
+
+    The temperatures come from a lumped model of a He-3 sorption fridge, integrated
+    lazily on the clock every time something is asked:
+        hpump PID on        -> Tp relaxes to the hpump setpoint (capped at pump_max_K),
+                               above condense_Tp_K the helium recondenses in condense_time_s
+        switch PID on       -> Tsw relaxes to the switch setpoint (capped at switch_max_K)
+        switch closed (Tsw > switch_closed_K) and pump off
+                            -> Tp cools to bath_K, once Tp < pumping_Tp_K the pump pumps on
+                               the helium: Tr relaxes to Tr_base_K and the helium lasts
+                               hold_time_s, after that Tr relaxes to Tr_runout_K
+        otherwise           -> Tr relaxes to Tr_warm_K
+
+    Every knob is a plain attribute and can be changed mid-run to inject a fault, e.g.
+    pump_max_K = 30 (broken pump heater, evaporation precheck and condensation fail),
+    switch_max_K = 10 (broken heat switch, evaporation never cools), Tr_warm_K = 12
+    (heat load, Tr abort).
+    """
+
+    NAMES = ["Tp", "Tr", "T1s", "Tsw", "hpump", "switch"]
+
+    def __init__(self, clock = None, helium = 1.0, Tp = 40., Tr = 3.5, Tsw = 4.5,
+                 bath_K = 4.2, T1s_K = 3.2, Tr_base_K = 0.35, Tr_warm_K = 3.5, Tr_runout_K = 3.6,
+                 pump_max_K = 60., switch_max_K = 40., switch_closed_K = 15., pumping_Tp_K = 10.,
+                 condense_Tp_K = 30., condense_time_s = 3600., hold_time_s = 20 * 3600.,
+                 pump_tau_s = 600., switch_tau_s = 120., fridge_tau_s = 300., sample_s = 0.1, step_s = 10.,
+                 macro_runtime_s = 60.):
+        self.clock = clock if clock is not None else VirtualClock()
+        self.helium = float(helium) ### fraction of a full charge of condensed helium
+        self.T = {"Tp": float(Tp), "Tr": float(Tr), "T1s": float(T1s_K), "Tsw": float(Tsw)}
+
+        self.bath_K = bath_K
+        self.T1s_K = T1s_K
+        self.Tr_base_K = Tr_base_K
+        self.Tr_warm_K = Tr_warm_K
+        self.Tr_runout_K = Tr_runout_K
+        self.pump_max_K = pump_max_K
+        self.switch_max_K = switch_max_K
+        self.switch_closed_K = switch_closed_K
+        self.pumping_Tp_K = pumping_Tp_K
+        self.condense_Tp_K = condense_Tp_K
+        self.condense_time_s = condense_time_s
+        self.hold_time_s = hold_time_s
+        self.pump_tau_s = pump_tau_s
+        self.switch_tau_s = switch_tau_s
+        self.fridge_tau_s = fridge_tau_s
+        self.sample_s = sample_s
+        self.step_s = step_s
+        self.macro_runtime_s = macro_runtime_s
+
+        self.baud_rate = 9600
+        self.timeout = 2000
+        self.output_enabled = False
+        self.registers = {
+            "hpump.PID.Mode": "Off", "hpump.PID.Setpoint": "40.0", "hpump.HiLmt": "30.0", "hpump.LowLmt": "0",
+            "switch.PID.Mode": "Off", "switch.PID.Setpoint": "20.0", "switch.HiLmt": "5.0", "switch.LowLmt": "0",
+        }
+        self.log = [] ### every command received, for assertions
+        self.macros = {} ### name -> uploaded lines
+        self._defining = None ### (name, lines) while an upload is in progress
+        self._running_macro = None ### (name, virtual end time)
+        self._last = self.clock.monotonic()
+        self._lock = threading.Lock()
+
+    ### model
+
+    def pid_on(self, channel):
+        return self.output_enabled and self.registers.get(f"{channel}.PID.Mode", "Off").lower() == "on"
+
+    def __setpoint__(self, channel, default):
+        try:
+            return float(self.registers.get(f"{channel}.PID.Setpoint", default))
+        except ValueError:
+            return default
+
+    def __relax__(self, name, target, tau_s, dt):
+        self.T[name] = float(target + (self.T[name] - target) * np.exp(-dt / tau_s))
+        return
+
+    def __step__(self, dt):
+        pump_on = self.pid_on("hpump")
+        if pump_on:
+            self.__relax__("Tp", min(self.__setpoint__("hpump", 40.), self.pump_max_K), self.pump_tau_s, dt)
+        elif self.T["Tsw"] > self.switch_closed_K:
+            self.__relax__("Tp", self.bath_K, self.pump_tau_s / 2, dt)
+        else:
+            self.__relax__("Tp", self.pumping_Tp_K + 5., 6 * self.pump_tau_s, dt) ### pump floats, slowly warming up
+
+        if self.pid_on("switch"):
+            self.__relax__("Tsw", min(self.__setpoint__("switch", 20.), self.switch_max_K), self.switch_tau_s, dt)
+        else:
+            self.__relax__("Tsw", self.bath_K, self.switch_tau_s, dt)
+
+        pumping = (not pump_on) and self.T["Tsw"] > self.switch_closed_K and self.T["Tp"] < self.pumping_Tp_K
+        if pumping and self.helium > 0:
+            self.helium = max(self.helium - dt / self.hold_time_s, 0.)
+            self.__relax__("Tr", self.Tr_base_K, self.fridge_tau_s, dt)
+        elif pumping:
+            self.__relax__("Tr", self.Tr_runout_K, self.fridge_tau_s, dt)
+        else:
+            self.__relax__("Tr", self.Tr_warm_K, 2 * self.fridge_tau_s, dt)
+
+        if self.T["Tp"] > self.condense_Tp_K:
+            self.helium = min(self.helium + dt / self.condense_time_s, 1.)
+        self.__relax__("T1s", self.T1s_K, self.fridge_tau_s, dt)
+        return
+
+    def update(self):
+        """ Integrates the model up to the current clock time """
+        with self._lock:
+            now = self.clock.monotonic()
+            remaining = now - self._last
+            self._last = now
+            while remaining > 0:
+                dt = min(remaining, self.step_s)
+                self.__step__(dt)
+                remaining -= dt
+        return self
+
+    def output_value(self, channel):
+        if not self.pid_on(channel):
+            return 0.
+        error = self.__setpoint__(channel, 0.) - self.T["Tp" if channel == "hpump" else "Tsw"]
+        high = float(self.registers.get(f"{channel}.HiLmt", 5.))
+        return float(np.clip(error, 0., high))
+
+    def values(self):
+        self.update()
+        return [self.T["Tp"], self.T["Tr"], self.T["T1s"], self.T["Tsw"], self.output_value("hpump"), self.output_value("switch")]
+
+    ### transport
+
+    @staticmethod
+    def __macro_name__(template, command):
+        """ 'macro.run "aaa_condense"' against MACRO_RUN -> 'aaa_condense', None if it does not match """
+        prefix, suffix = template.split("{name}")
+        if command.startswith(prefix) and command.endswith(suffix) and len(command) > len(prefix) + len(suffix):
+            return command[len(prefix):len(command) - len(suffix)]
+        return None
+
+    def running_macro(self):
+        if self._running_macro is not None and self.clock.monotonic() >= self._running_macro[1]:
+            self._running_macro = None
+        return self._running_macro[0] if self._running_macro is not None else None
+
+    def __macro_command__(self, command):
+        """ Reply to a macro command, None if command is not one """
+        if self._defining is not None:
+            if command == MACRO_END:
+                name, lines = self._defining
+                self.macros[name] = lines
+                self._defining = None
+            else:
+                self._defining[1].append(command)
+            return command
+        if command == MACRO_STATUS:
+            return f"{MACRO_STATUS[:-1]} = {self.running_macro() or 'idle'}"
+        name = self.__macro_name__(MACRO_DEFINE, command)
+        if name is not None:
+            self._defining = (name, [])
+            return command
+        name = self.__macro_name__(MACRO_RUN, command)
+        if name is not None:
+            if name not in self.macros:
+                return f"Unknown macro {name}"
+            self._running_macro = (name, self.clock.monotonic() + self.macro_runtime_s)
+            return command
+        name = self.__macro_name__(MACRO_KILL, command)
+        if name is not None:
+            if self.running_macro() == name: ### abortMacro handler: outputs off
+                self._running_macro = None
+                self.update()
+                for channel in ["hpump", "switch"]:
+                    self.registers[f"{channel}.PID.Mode"] = "Off"
+            return command
+        return None
+
+    def query(self, command):
+        command = command.strip()
+        self.log.append(command)
+
+        reply = self.__macro_command__(command)
+        if reply is not None:
+            return reply
+
+        if command == "getOutputNames?":
+            return ", ".join(self.NAMES)
+        if command == "getOutput?":
+            return ", ".join(f"{value:.6g}" for value in self.values())
+        if command == "waitForSample":
+            self.clock.sleep(self.sample_s)
+            return "waitForSample"
+        if command in ["abort", "kill.all"]:
+            for channel in ["hpump", "switch"]:
+                self.registers[f"{channel}.PID.Mode"] = "Off"
+            return command
+
+        match = re.fullmatch(r"outputEnable\s+(\S+)", command, re.IGNORECASE)
+        if match:
+            self.update()
+            self.output_enabled = match.group(1).lower() == "on"
+            return f"outputEnable = {match.group(1)}"
+
+        if command.endswith(".Value?"):
+            channel = command[:-len(".Value?")]
+            if channel not in self.NAMES:
+                return f"Unknown channel {channel}"
+            return f"{channel} = {self.values()[self.NAMES.index(channel)]:.6g}"
+
+        if command.endswith(".Off"):
+            channel = command[:-len(".Off")]
+            self.update()
+            self.registers[f"{channel}.PID.Mode"] = "Off"
+            return f"{channel}.Off"
+
+        if command.endswith("?"):
+            parameter = command[:-1]
+            return f"{parameter} = {self.registers.get(parameter, '0')}"
+
+        parameter, _, value = command.partition(" ")
+        self.update() ### integrate up to the change before it takes effect
+        self.registers[parameter] = value.strip()
+        return f"{parameter} = {value.strip()}"
+
+    def write(self, command):
+        self.query(command)
+        return len(command)
+
+    def read(self):
+        return ""
+
+    def close(self):
+        return
+
+
+def simulated_tempcontroller(clock = None, name = "CTC100 (simulated)", **model_kwargs):
+    """ TempControl_CTC100 wired to a SimulatedCTC100 and its clock (VirtualClock() by default) """
+    clock = clock if clock is not None else VirtualClock()
+    transport = SimulatedCTC100(clock = clock, **model_kwargs)
+    return TempControl_CTC100("SIM", name = name, transport = transport, clock = clock)
+
+
+class SimulatedCTC100Server:
+    """
+    Local TCP stand-in for the CTC100 network interface: serves a SimulatedCTC100
+    (shared by every connection) with the same line protocol, commands end in
+    '\n', replies in '\r\n'. port = 0 picks a free port, see address.
+
+        server = SimulatedCTC100Server().start()
+        tc = TempControl_CTC100(server.address, name = "CTC100 over tcp")
+        ...
+        server.stop()
+    """
+
+    def __init__(self, simulator = None, host = "127.0.0.1", port = 0):
+        self.simulator = simulator if simulator is not None else SimulatedCTC100(clock = VirtualClock(rate = 1))
+        simulator = self.simulator
+        connections = self.connections = set()
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                connections.add(self.connection)
+                try:
+                    for line in self.rfile:
+                        command = line.decode('ascii', errors = 'replace').strip()
+                        if command:
+                            self.wfile.write((simulator.query(command) + "\r\n").encode('ascii'))
+                except OSError: ### dropped by stop() or the client
+                    pass
+                finally:
+                    connections.discard(self.connection)
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler, bind_and_activate = False)
+        self._server.allow_reuse_address = True
+        self._server.daemon_threads = True
+        self._server.server_bind()
+        self._server.server_activate()
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self._server.server_address[:2]
+        return f"tcp://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target = self._server.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops listening and drops every open connection, like the controller going away """
+        self._server.shutdown()
+        self._server.server_close()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return
+
+
+if __name__ == '__main__':
+    server = SimulatedCTC100Server(port = 5025).start()
+    print(f"\n>>>> SIMULATED CTC100 SERVING ON {server.address}, SIMULATOR AS sim <<<<\n")
+    sim = server.simulator
+    import code; code.interact(local=locals())
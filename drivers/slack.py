@@ -5,20 +5,364 @@ import threading
 import time
 from queue import Queue
 from datetime import datetime, timezone
+from collections import deque
 import json
-import matplotlib.pyplot as plt 
+import matplotlib.pyplot as plt
 import requests
+from requests.adapters import HTTPAdapter
 import os
+import uuid
+import smtplib
+from email.message import EmailMessage
 
 
 
 
-class Slack:
-    
-    
-    def __init__(self, config_dir: str):
+class AlertDispatcher:
+    """
+    Delivers webhook posts from a background thread so the caller (the auto
+    cycle) never waits on the network and never sees an HTTP error.
+
+    Pending posts are kept in order in a bounded queue, mirrored to queue_path
+    (json, atomic rewrite) when given, so alerts survive a restart of the host.
+    When max_pending is reached the oldest post is dropped (counted in stats).
+    A failed post is retried with exponential backoff from retry_s up to
+    max_backoff_s, 429 answers wait for their Retry-After. Other 4xx answers
+    (bad url or payload) are not retried. Connections are pooled in one
+    requests.Session, created only for webhook posts (deliver = None).
+
+    stats() reports the delivery latency, from enqueue to the 2xx answer.
+
+    deliver(payload) replaces the HTTP post for other transports (SMTP, a log
+    file): it raises to have the payload retried. Urgent payloads jump the queue.
+    """
+
+    def __init__(self, queue_path = None, max_pending = 500, timeout_s = 5., retry_s = 1., max_backoff_s = 300.,
+                 deliver = None, name = "alert dispatcher"):
+        self.queue_path = queue_path
+        self.deliver = deliver
+        self.name = name
+        self.max_pending = max_pending
+        self.timeout_s = timeout_s
+        self.retry_s = retry_s
+        self.max_backoff_s = max_backoff_s
+
+        self.session = None
+        if deliver is None: ### webhook posts, other transports bring their own connection
+            self.session = requests.Session()
+            self.session.mount("https://", HTTPAdapter(pool_connections = 4, pool_maxsize = 4))
+            self.session.mount("http://", HTTPAdapter(pool_connections = 4, pool_maxsize = 4))
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self.delivered = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failed_attempts = 0
+        self.latencies_s = deque(maxlen = 1000) ### enqueue -> delivered, most recent posts
+        self.__load__()
+
+    def __load__(self):
+        if self.queue_path is None or not os.path.exists(self.queue_path):
+            return
+        try:
+            with open(self.queue_path, 'r') as f:
+                self._pending.extend(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Could not read the alert queue {self.queue_path}: {e}")
+            return
+        if self._pending:
+            print(f"{len(self._pending)} undelivered alert(s) from {self.queue_path}, sending them")
+            self.start()
+        return
+
+    def __save__(self):
+        """ Called with self._cond held """
+        if self.queue_path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.queue_path)), exist_ok = True)
+            tmp_path = self.queue_path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(list(self._pending), f)
+            os.replace(tmp_path, self.queue_path)
+        except OSError as e:
+            print(f"Could not save the alert queue {self.queue_path}: {e}")
+        return
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return self
+            self._stop.clear()
+            self._thread = threading.Thread(target = self.__worker__, name = self.name, daemon = True)
+            self._thread.start()
+        return self
+
+    def post(self, url, payload, urgent = False):
+        """ Queues payload for url (None with deliver), returns at once. False if it could not be queued """
+        if not url and self.deliver is None:
+            print("No webhook url configured, alert not sent")
+            return False
+        item = {"id": uuid.uuid4().hex, "url": url, "payload": payload, "queued_at": time.time(), "attempts": 0}
+        with self._cond:
+            while len(self._pending) >= self.max_pending:
+                old = self._pending.pop() if urgent else self._pending.popleft()
+                self.dropped += 1
+                print(f"Alert queue full, dropped an alert ({old['payload']})")
+            if urgent: ### ahead of everything, also of a post waiting out its backoff
+                self._pending.appendleft(item)
+            else:
+                self._pending.append(item)
+            self.__save__()
+            self._cond.notify_all()
+        self.start()
+        return True
+
+    def pending(self):
+        with self._cond:
+            return len(self._pending)
+
+    def __send__(self, item):
+        """ None when delivered, else the seconds to wait before the next attempt (0 = give up) """
+        if self.deliver is not None:
+            try:
+                self.deliver(item["payload"])
+                return None
+            except Exception as e:
+                logging.warning(f"{self.name} failed: {e!r}")
+                return -1.
+        try:
+            response = self.session.post(item["url"], json = item["payload"], timeout = self.timeout_s)
+        except requests.RequestException as e:
+            logging.warning(f"Alert post failed: {e!r}")
+            return -1.
+        if response.status_code < 300:
+            return None
+        if response.status_code == 429:
+            try:
+                return max(float(response.headers.get("Retry-After", self.retry_s)), 0.01)
+            except ValueError:
+                return -1.
+        if 400 <= response.status_code < 500:
+            logging.error(f"Alert rejected with {response.status_code}: {response.text[:200]}")
+            return 0.
+        logging.warning(f"Alert post answered {response.status_code}, retrying")
+        return -1.
+
+    def __worker__(self):
+        backoff_s = self.retry_s
+        while not self._stop.is_set():
+            with self._cond:
+                while not self._pending and not self._stop.is_set():
+                    self._cond.wait()
+                if self._stop.is_set():
+                    return
+                item = self._pending[0]
+                item["attempts"] += 1
+
+            retry = self.__send__(item)
+            with self._cond:
+                if retry is None or retry == 0.:
+                    if item in self._pending:
+                        self._pending.remove(item)
+                    if retry is None:
+                        self.delivered += 1
+                        self.latencies_s.append(time.time() - item["queued_at"])
+                    else:
+                        self.rejected += 1
+                    self.__save__()
+                    self._cond.notify_all()
+                    backoff_s = self.retry_s
+                    continue
+                self.failed_attempts += 1
+            if retry < 0: ### no hint from the server, back off
+                retry, backoff_s = backoff_s, min(2 * backoff_s, self.max_backoff_s)
+            with self._cond: ### an urgent post arriving meanwhile goes out straight away
+                if self._cond.wait_for(lambda: self._stop.is_set() or (self._pending and self._pending[0] is not item), retry):
+                    backoff_s = self.retry_s
+        return
+
+    def flush(self, timeout_s = None):
+        """ Waits until the queue is empty, True if it is """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending, timeout_s)
+
+    def close(self, timeout_s = 2.):
+        """ Gives pending posts timeout_s to go out, the rest stays in queue_path for the next start """
+        self.flush(timeout_s)
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout_s)
+        if self.session is not None:
+            self.session.close()
+        return
+
+    def stats(self):
+        latencies = sorted(self.latencies_s)
+        def percentile(q):
+            return latencies[min(int(q * len(latencies)), len(latencies) - 1)] if latencies else None
+        with self._cond:
+            pending = len(self._pending)
+        return {"pending": pending, "delivered": self.delivered, "dropped": self.dropped, "rejected": self.rejected,
+                "failed_attempts": self.failed_attempts,
+                "latency_s": {"last": self.latencies_s[-1] if self.latencies_s else None,
+                              "p50": percentile(0.5), "p95": percentile(0.95), "max": latencies[-1] if latencies else None}}
+
+
+### severity of every cycle code, overridden by the "severity" table of the notification config
+DEFAULT_SEVERITY = {"0": "info", "1": "info", "2": "warning", "3": "warning", "4": "critical", "5": "critical", "6": "critical",
+                    "7": "critical"}
+SEVERITIES = ["info", "warning", "critical"]
+
+
+def sink_queue_path(queue_path, name):
+    """ log/slack_queue.json -> log/slack_queue.email.json, the legacy "slack" sink keeps the plain name """
+    if queue_path is None or name == "slack":
+        return queue_path
+    root, ext = os.path.splitext(queue_path)
+    return f"{root}.{name}{ext}"
+
+
+class WebhookSink:
+    """ Slack (or any) incoming webhook: {"type": "webhook", "url": "https://hooks.slack.com/..."} """
+
+    def __init__(self, name, url, queue_path = None, **dispatcher_kwargs):
+        self.name = name
+        self.url = url
+        self.dispatcher = AlertDispatcher(queue_path = queue_path, name = f"{name} sink", **dispatcher_kwargs)
+
+    def send(self, alert):
+        return self.dispatcher.post(self.url, {"text": alert["text"]}, urgent = alert["severity"] == "critical")
+
+    def close(self, timeout_s = 2.):
+        self.dispatcher.close(timeout_s)
+        return
+
+    def stats(self):
+        return self.dispatcher.stats()
+
+
+class SMTPSink:
+    """
+    Mail through an SMTP relay:
+        {"type": "smtp", "host": "smtp.lab.org", "port": 587, "starttls": true,
+         "username": "...", "password": "...", "sender": "cryocycle@lab.org", "recipients": ["oncall@lab.org"]}
+    """
+
+    def __init__(self, name, host, recipients, sender = "cryocycle@localhost", port = 25, starttls = False,
+                 username = None, password = None, subject_prefix = "[cryocycle]", timeout_s = 10., queue_path = None,
+                 **dispatcher_kwargs):
+        self.name = name
+        self.host = host
+        self.port = int(port)
+        self.recipients = [recipients] if isinstance(recipients, str) else list(recipients)
+        self.sender = sender
+        self.starttls = starttls
+        self.username = username
+        self.password = password
+        self.subject_prefix = subject_prefix
+        self.timeout_s = timeout_s
+        self.dispatcher = AlertDispatcher(queue_path = queue_path, name = f"{name} sink", deliver = self.__deliver__,
+                                          **dispatcher_kwargs)
+
+    def __deliver__(self, payload):
+        message = EmailMessage()
+        message["Subject"] = payload["subject"]
+        message["From"] = self.sender
+        message["To"] = ", ".join(self.recipients)
+        message.set_content(payload["text"])
+        with smtplib.SMTP(self.host, self.port, timeout = self.timeout_s) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(message)
+        return
+
+    def send(self, alert):
+        subject = f"{self.subject_prefix} {alert['severity'].upper()}: {alert['text'].splitlines()[0][:80]}"
+        return self.dispatcher.post(None, {"subject": subject, "text": f"{alert['text']}\n\n{alert['time']}"},
+                                    urgent = alert["severity"] == "critical")
+
+    def close(self, timeout_s = 2.):
+        self.dispatcher.close(timeout_s)
+        return
+
+    def stats(self):
+        return self.dispatcher.stats()
+
+
+class LogFileSink:
+    """
+    One line per alert appended to a local file: {"type": "logfile", "path": "alerts.log"}.
+    Notifier resolves a relative path under the logging folder of the cycler that sends.
+    """
+
+    def __init__(self, name, path, **dispatcher_kwargs):
+        self.name = name
+        self.path = path
+        self.dispatcher = AlertDispatcher(name = f"{name} sink", deliver = self.__deliver__, **dispatcher_kwargs)
+
+    def __deliver__(self, payload):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok = True)
+        with open(self.path, 'a') as f:
+            f.write(payload["line"] + "\n")
+        return
+
+    def send(self, alert):
+        text = alert["text"].replace("\n", " | ")
+        return self.dispatcher.post(None, {"line": f"{alert['time']} {alert['severity']:<8} code {alert['code']}: {text}"},
+                                    urgent = alert["severity"] == "critical")
+
+    def close(self, timeout_s = 2.):
+        self.dispatcher.close(timeout_s)
+        return
+
+    def stats(self):
+        return self.dispatcher.stats()
+
+
+SINK_TYPES = {"webhook": WebhookSink, "smtp": SMTPSink, "logfile": LogFileSink}
+
+
+class Notifier:
+    """
+    Sends the alerts of the cycle to every sink their code is routed to. Each sink
+    delivers from its own queue and thread, so the fan-out is parallel and a slow
+    mail relay does not hold up the webhook. Nothing here blocks or raises into the
+    caller.
+
+    Notification config (e.g. config/ctc100/matterhorn/slack_integration.json):
+        {"error_code_messages": {"4": "Evaporation hard aborted", ...},
+         "severity": {"4": "critical", ...},             ### DEFAULT_SEVERITY when left out
+         "sinks": {"oncall": {"type": "webhook", "url": "..."},
+                   "email": {"type": "smtp", "host": "...", "recipients": [...]},
+                   "log": {"type": "logfile", "path": "alerts.log"}},   ### relative: in the cycler's log_dir
+         "routes": {"info": ["slack", "log"], "warning": ["slack", "log"],
+                    "critical": ["slack", "oncall", "email", "log"],
+                    "codes": {"2": ["log"]}}}            ### per code, wins over the severity route
+    slack_url, as in the old single webhook config, is the webhook sink "slack".
+    Without routes every sink gets every alert. Critical alerts jump the queue of
+    every sink. A sink without a url / recipients is left out. notify(log_dir = ...)
+    puts relative logfile paths in that folder (default: the folder of queue_path),
+    so each cryostat sharing a Notifier writes its own file.
+    A code mapped to null in error_code_messages is never sent. A missing or empty
+    ("") message sends "Cryo cycle reported code N" instead, except that an empty
+    message keeps info codes (e.g. 0, success) quiet.
+    """
+
+    def __init__(self, config_dir: str, queue_path = None):
+        """ queue_path: where undelivered messages are kept across restarts, None keeps them in memory only """
         self.config_dir = config_dir
         self.config = None
+        self.queue_path = queue_path
+        self._sinks = {} ### (name, spec) -> sink, built on first use
+        self._lock = threading.Lock()
 
 
     def load_config(self, config_name=False):
@@ -26,28 +370,124 @@ class Slack:
         with open(config_path, 'r') as f:
             self.config = json.load(f)
         return self.config
-    
+
+    def severity(self, error_code, json_config = None):
+        table = dict(DEFAULT_SEVERITY)
+        table.update((json_config or {}).get("severity", {}))
+        return table.get(str(error_code), "warning")
+
+    def sink_specs(self, json_config):
+        specs = dict(json_config.get("sinks", {}))
+        if json_config.get("slack_url") and "slack" not in specs:
+            specs["slack"] = {"type": "webhook", "url": json_config["slack_url"]}
+        return specs
+
+    def route(self, error_code, json_config):
+        """ Names of the sinks error_code goes to """
+        specs = self.sink_specs(json_config)
+        routes = json_config.get("routes")
+        if routes is None:
+            return list(specs)
+        names = routes.get("codes", {}).get(str(error_code))
+        if names is None:
+            names = routes.get(self.severity(error_code, json_config), [])
+        return [name for name in names if name in specs]
+
+    def __sink__(self, name, spec, log_dir = None):
+        if spec.get("type") == "logfile" and spec.get("path") and not os.path.isabs(spec["path"]):
+            if log_dir is None and self.queue_path is not None:
+                log_dir = os.path.dirname(self.queue_path)
+            if log_dir:
+                spec = dict(spec, path = os.path.join(log_dir, spec["path"]))
+        key = (name, json.dumps(spec, sort_keys = True))
+        with self._lock:
+            if key not in self._sinks:
+                spec = dict(spec)
+                kind = spec.pop("type", "webhook")
+                if kind not in SINK_TYPES:
+                    print(f"Unknown sink type {kind} for {name}, must be one of {list(SINK_TYPES)}")
+                    return None
+                if not (spec.get("url") or spec.get("recipients") or spec.get("path")):
+                    return None ### not configured
+                if kind != "logfile":
+                    spec.setdefault("queue_path", sink_queue_path(self.queue_path, name))
+                try:
+                    self._sinks[key] = SINK_TYPES[kind](name, **spec)
+                except TypeError as e:
+                    print(f"Bad config for sink {name}: {e}")
+                    return None
+            return self._sinks[key]
+
+    def message(self, error_code, json_config):
+        """ Text of error_code's alert, None if it is not to be sent (see the class docstring) """
+        code = str(error_code)
+        messages = json_config.get("error_code_messages", {})
+        if code in messages and messages[code] is None: ### explicitly silenced
+            return None
+        text = messages.get(code)
+        if text:
+            return text
+        if text == "" and self.severity(code, json_config) == "info":
+            return None
+        return f"Cryo cycle reported code {error_code}"
+
+    def notify(self, error_code, json_config, text = None, source = None, log_dir = None):
+        """
+        Fans the alert of error_code (text: instead of its error_code_messages entry)
+        out to its route. Returns the names of the sinks it was queued on.
+        log_dir: logging folder of the sender, for relative logfile sink paths.
+        """
+        code = str(error_code)
+        if text is None:
+            text = self.message(code, json_config)
+        if not text:
+            return []
+        severity = self.severity(code, json_config)
+        alert = {"code": code, "severity": severity, "text": f"[{source}] {text}" if source else text,
+                 "source": source, "time": datetime.now().isoformat(timespec = "seconds")}
+        sent = []
+        specs = self.sink_specs(json_config)
+        for name in self.route(code, json_config):
+            sink = self.__sink__(name, specs[name], log_dir)
+            if sink is None:
+                continue
+            try:
+                if sink.send(alert):
+                    sent.append(name)
+            except Exception as e:
+                print(f"Could not queue the alert on sink {name}: {e}")
+        return sent
 
     def send_message_to_slack(self, error_code: int, json_slack= False):
-        
+        """ Queues the message of error_code on every sink it is routed to and returns at once, never raises """
+
         if not json_slack:
             print("Please provide a valid json congif file")
-            return 
-        
+            return
+
         if error_code is None:
             print("Please provide an error code")
             return
-        
-        cfg = json_slack
-        
-        
-        
-        url = cfg["slack_url"]
-
-        message = cfg["error_code_messages"][str(error_code)]
-        
-        r = requests.post(url, json={"text": message}, timeout=5)
-        r.raise_for_status()
-        return
-    
-    
\ No newline at end of file
+
+        return self.notify(error_code, json_slack)
+
+    def stats(self):
+        with self._lock:
+            sinks = list(self._sinks.values())
+        return {sink.name: sink.stats() for sink in sinks}
+
+    def close(self, timeout_s = 2.):
+        """ Every sink gets timeout_s (in parallel) to deliver what is queued """
+        with self._lock:
+            sinks = list(self._sinks.values())
+        threads = [threading.Thread(target = sink.close, args = (timeout_s,), daemon = True) for sink in sinks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout_s + 1)
+        return
+
+
+class Slack(Notifier):
+    """ The name the cycle code knows the notifier by """
+    pass
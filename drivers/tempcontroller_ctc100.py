@@ -2,11 +2,18 @@
 import os
 import json
 import sys
+import asyncio
 import threading
 import numpy as np
 import time
+from types import SimpleNamespace
 
-from generic_instrument_dependencies.generic_instrument import GenericInstrument
+from generic_instrument_dependencies.generic_instrument import GenericInstrument, QueryCancelled, LinkLost
+from generic_instrument_dependencies.ring_buffer import RingBuffer
+from generic_instrument_dependencies.deadline_scheduler import DeadlineScheduler
+from generic_instrument_dependencies.io_scheduler import SAFETY, BACKGROUND
+from generic_instrument_dependencies.async_transport import blocking, run_blocking
+from generic_instrument_dependencies.shadow_registers import ShadowRegisters, same_value, parse_readback
 
 here = os.path.dirname(os.path.abspath(__file__))     # .../Cryocycle/drivers
 root = os.path.dirname(here)                          # .../Cryocycle
@@ -17,34 +24,83 @@ json_path = os.path.join(root, "config", "ctc100", "initial_config_matterhorn.js
 #%%
 
 class TempControl_CTC100(GenericInstrument):
-    def __init__(self, address, name, baud_rate = 9600):
+    def __init__(self, address, name, baud_rate = 9600, snapshot_ttl_s = 2.0, transport = None, clock = None):
         self.write_term = '\n'
         self.read_term = '\r\n'
         super().__init__(address, name = name,
                         write_term = self.write_term, 
-                        read_term = self.read_term)
+                        read_term = self.read_term,
+                        transport = transport, clock = clock)
         
         self.baud_rate = baud_rate
         self.client.baud_rate = self.baud_rate
+        ### waitForSample blocks until the next measurement, plain reads answer within a few 10 ms
+        self.timeout_profiles = [("waitForSample", 30.), ("*.Value?", 1.), ("getOutput*", 2.), ("*", 2.)]
 
         self.data_length = 100
         self.data_names = self.get_data("names")
-        self.data = np.zeros((len(self.data_names), self.data_length))
+        ### name -> row index of a getOutput? frame, lower case so Tp/tp/TP all hit
+        self.data_index = {name.lower(): i for i, name in enumerate(self.data_names)}
+        ### circular buffer, self.data is an ordered zero-copy view into it
+        self.buffer = RingBuffer(len(self.data_names), self.data_length)
+
+        ### latest full frame of every channel, shared by the logging loop and the cycle logic
+        self.snapshot_ttl_s = snapshot_ttl_s
+        self._snapshot = None
+        self._snapshot_time = None
+        self._snapshot_lock = threading.Lock()
         self._auto_cycle_stop = None
         self._auto_cycle_thread = None
         self.is_monitoring = False
+        self.is_alogging = False ### alogging_loop is running
+        self.monitoring_thread = None
+        self._monitoring_stop = threading.Event()
+        self.loop_scheduler = None ### DeadlineScheduler of the running __data_loop__, see loop_stats()
+        ### callables f(timestamp, values) run on every new frame of __data_loop__
+        self.frame_listeners = []
+        ### last value written to every parameter, lets set_initial_*_config skip what is already set
+        self.shadow = ShadowRegisters()
+        self.config_diff = [] ### [(key, old, new)] of the last config push that completed
+        ### link loss: the logging loop reconnects after this many failed polls in a row,
+        ### snapshot reads wait up to outage_wait_s for it instead of failing straight away
+        self.reconnect_after_failures = 2
+        self.outage_wait_s = 600.
+        self.gaps = 0 ### NaN gap frames written into the data
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         return
+
+    def handshake(self):
+        client = super().handshake()
+        ### a reopened serial port comes back at the default rate
+        if client is not None and getattr(self, "baud_rate", None) is not None:
+            client.baud_rate = self.baud_rate
+        return client
+
+    @property
+    def data(self):
+        """ (channels x data_length) window ordered oldest -> newest, no copy """
+        return self.buffer.view()
+
+    @property
+    def data_times(self):
+        """ Unix timestamps matching the columns of self.data """
+        return self.buffer.times()
+
+    def set_data_length(self, data_length):
+        self.data_length = int(data_length)
+        self.buffer.resize(self.data_length)
+        return self
     
-    def close(self):
-        self.stop_logging()
-        time.sleep(2)
-        self.client.close()
-        self.client = None
+    def close(self, timeout_s = 5.):
+        self.stop_logging(timeout_s = timeout_s)
+        self.io.stop(timeout = timeout_s) ### drops queued reads, waits at most timeout_s for the one on the wire
+        if self.client is not None: ### None after a failed handshake
+            self.client.close()
+            self.client = None
         self.__exit__(None, None, None)
         return
     
@@ -56,6 +112,99 @@ class TempControl_CTC100(GenericInstrument):
     
     
     
+    def _set_param(self, channel, param, value):
+        """
+        Writes channel.param value and records it in the shadow registers.
+        Inside a config push (set_initial_*_config) a value the shadow already
+        holds is not sent again, the rest is queued without waiting (the push
+        waits for all of them at the end) and lands in that push's diff.
+        """
+        key = f"{channel}.{param}"
+        value = str(value)
+        old = self.shadow.get(key)
+        push = getattr(self._local, "config_push", None)
+        if push is not None:
+            if same_value(old, value):
+                return None
+            diff, futures = push
+            diff.append((key, old, value))
+            future = self.write(f"{key} {value}")
+            futures.append((key, value, future))
+            return future
+        response = self.query(f"{key} {value}")
+        if response is not None:
+            self.shadow.set(key, value)
+        else:
+            self.shadow.invalidate(key = key) ### unknown whether it got through
+        return response
+
+    def __config_push__(self, push):
+        """
+        Runs push() with no-op writes skipped, returns the [(key, old, new)] that were sent.
+        The diff and the write futures belong to this call (pushes can run on the logging
+        and the cycle thread at once), config_diff is only set once the push completed.
+        """
+        diff, futures = [], []
+        previous = getattr(self._local, "config_push", None)
+        self._local.config_push = (diff, futures)
+        try:
+            push()
+        finally:
+            self._local.config_push = previous
+        for key, value, future in futures:
+            try:
+                future.result()
+                self.shadow.set(key, value)
+            except Exception as e:
+                print(f"Config write {key} {value} failed: {e}")
+                self.shadow.invalidate(key = key)
+        self.config_diff = list(diff)
+        return diff
+
+    def __report_push__(self, label, diff):
+        changed = [(k, o, n) for k, o, n in diff if o is not None]
+        print(f"{label} config: {len(diff)} parameter(s) written, {len(changed)} changed from a known value"
+              + "".join(f"\n  {k}: {o} -> {n}" for k, o, n in changed))
+        return
+
+    def probe(self):
+        return self.query("getOutputNames?", priority = SAFETY, timeout_s = 5.) is not None
+
+    def after_reconnect(self):
+        """ The controller may have power cycled while away: every shadowed parameter is written again """
+        with self._snapshot_lock:
+            self._snapshot = None
+        wanted = self.shadow.items()
+        self.shadow.clear()
+        def push():
+            for key, value in wanted.items():
+                channel, param = key.split(".", 1)
+                self._set_param(channel, param, value)
+        with self.io.priority(SAFETY): ### ahead of the reads that piled up during the outage
+            self.__report_push__("Reconnect", self.__config_push__(push))
+        return
+
+    def verify_shadow(self, keys = None):
+        """
+        Reads back every shadowed parameter (or keys) in one pipelined burst and
+        returns {key: (shadow, device)} for the ones that differ. Those are
+        dropped from the shadow, so the next config push writes them again.
+        """
+        keys = list(self.shadow.items()) if keys is None else list(keys)
+        futures = {key: self.write(f"{key}?") for key in keys}
+        mismatches = {}
+        for key, future in futures.items():
+            try:
+                device = parse_readback(future.result())
+            except Exception as e:
+                print(f"Could not read back {key}: {e}")
+                device = None
+            expected = self.shadow.get(key)
+            if not same_value(expected, device):
+                mismatches[key] = (expected, device)
+                self.shadow.invalidate(key = key)
+        return mismatches
+
     """ PID/Output related functions"""
     
     def get_pid_status(self, channel = False):
@@ -98,7 +247,7 @@ class TempControl_CTC100(GenericInstrument):
                 print(f"Invalid status: {status}. Must be 'On' or 'Off'.")
                 return None
 
-        return self.query(f"{channel}.PID.Mode {status}")
+        return self._set_param(channel, "PID.Mode", status)
     
     
     def set_output_unit(self, units = False, channel = False): # Unit can be "V", "W", "A"
@@ -126,7 +275,7 @@ class TempControl_CTC100(GenericInstrument):
                 print(f"Invalid units: {units}. Must be 'V', 'A', or 'W'.")
                 return None
         
-        return self.query(f"{channel}.Units {units}")
+        return self._set_param(channel, "Units", units)
     
     
     
@@ -153,7 +302,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Range not specified. Please provide a valid range.")
             return None
         
-        return self.query(f"{channel}.Range {range}")
+        return self._set_param(channel, "Range", range)
     
     
     
@@ -177,8 +326,8 @@ class TempControl_CTC100(GenericInstrument):
             low_limit = str(low_limit)
             high_limit = str(high_limit)
         
-        self.query(f"{channel}.LowLmt {low_limit}")
-        self.query(f"{channel}.HiLmt {high_limit}")
+        self._set_param(channel, "LowLmt", low_limit)
+        self._set_param(channel, "HiLmt", high_limit)
         return
     
 
@@ -208,7 +357,7 @@ class TempControl_CTC100(GenericInstrument):
             print("io_type not specified. Please provide 'Meas out' or 'Set out'.")
             return None
         
-        return self.query(f"{channel}.IOType {io_type}")
+        return self._set_param(channel, "IOType", io_type)
     
     
     
@@ -241,7 +390,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Input not specified. Please provide 'Tp', 'Tr', 'T1s', or 'Tsw'.")
             return None
         
-        return self.query(f"{channel}.PID.Input {input}")
+        return self._set_param(channel, "PID.Input", input)
     
     
     
@@ -268,7 +417,7 @@ class TempControl_CTC100(GenericInstrument):
         else:
             setpoint = str(setpoint)
         
-        return self.query(f"{channel}.PID.Setpoint {setpoint}")
+        return self._set_param(channel, "PID.Setpoint", setpoint)
     
     
     
@@ -293,7 +442,7 @@ class TempControl_CTC100(GenericInstrument):
         else:
             rate = str(rate)
 
-        return self.query(f"{channel}.PID.Ramp {rate}")
+        return self._set_param(channel, "PID.Ramp", rate)
     
     
     
@@ -316,7 +465,7 @@ class TempControl_CTC100(GenericInstrument):
         else:
             ramp_t = str(ramp_t)
             
-        return self.query(f"{channel}.PID.RampT {ramp_t}")
+        return self._set_param(channel, "PID.RampT", ramp_t)
     
     
     
@@ -355,9 +504,9 @@ class TempControl_CTC100(GenericInstrument):
         else:
             D = str(D)
 
-        self.query(f"{channel}.PID.P {P}")
-        self.query(f"{channel}.PID.I {I}")
-        self.query(f"{channel}.PID.D {D}")
+        self._set_param(channel, "PID.P", P)
+        self._set_param(channel, "PID.I", I)
+        self._set_param(channel, "PID.D", D)
         return
     
     
@@ -381,7 +530,7 @@ class TempControl_CTC100(GenericInstrument):
         else:
             step_y = str(step_y)
         
-        return self.query(f"{channel}.Tune.StepY {step_y}")
+        return self._set_param(channel, "Tune.StepY", step_y)
     
     def set_output_lag(self, lag_time_s = False, channel = False):
         if channel:
@@ -402,7 +551,7 @@ class TempControl_CTC100(GenericInstrument):
         else:
             lag_time_s = str(lag_time_s)
         
-        return self.query(f"{channel}.Tune.Lag {lag_time_s}")
+        return self._set_param(channel, "Tune.Lag", lag_time_s)
     
     def set_channel_off(self, channel = False):
         if channel in ["hpump", "Hpump", "HPUMP"]:
@@ -412,6 +561,7 @@ class TempControl_CTC100(GenericInstrument):
         else:
             print(f"Invalid channel name: {channel}. Must be 'hpump' or 'switch'.")
             return None
+        self.shadow.invalidate(prefix = f"{channel}.PID.Mode") ### the output goes off behind its PID
         return self.query(f"{channel}.Off")
     
     
@@ -465,8 +615,8 @@ class TempControl_CTC100(GenericInstrument):
             min_val = str(min_val)
             max_val = str(max_val)
         
-        self.query(f"{channel}.Alarm.Min {min_val}")
-        self.query(f"{channel}.Alarm.Max {max_val}")
+        self._set_param(channel, "Alarm.Min", min_val)
+        self._set_param(channel, "Alarm.Max", max_val)
         return
     
     
@@ -495,7 +645,7 @@ class TempControl_CTC100(GenericInstrument):
         else:
             lag_time_s = str(lag_time_s)
             
-        return self.query(f"{channel}.Alarm.Lag {lag_time_s}")
+        return self._set_param(channel, "Alarm.Lag", lag_time_s)
     
     
     
@@ -527,7 +677,7 @@ class TempControl_CTC100(GenericInstrument):
             return None
         
         
-        return self.query(f"{channel}.Alarm.Sound {sound_status}")
+        return self._set_param(channel, "Alarm.Sound", sound_status)
     
     
     
@@ -560,7 +710,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Latch status not specified. Please provide 'On' or 'Off'.")
             return None
         
-        return self.query(f"{channel}.Alarm.Latch {latch_status}")
+        return self._set_param(channel, "Alarm.Latch", latch_status)
     
     
     
@@ -595,7 +745,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Mode not specified. Please provide 'Off', 'Level', or 'Rate /s'.")
             return None
         
-        return self.query(f"{channel}.Alarm.Mode {mode}")
+        return self._set_param(channel, "Alarm.Mode", mode)
     
     
     
@@ -629,7 +779,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Output channel not specified. Please provide 'hpump' or 'switch'.")
             return None
         
-        return self.query(f"{channel}.Alarm.Output {output_channel}")
+        return self._set_param(channel, "Alarm.Output", output_channel)
     
     
     
@@ -659,7 +809,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Channel not specified. Please provide 'Tp', 'Tr', 'T1s', 'Tsw', 'hpump', or 'switch'.")
             return None
         
-        resp = self.query(f"{channel}.Value?")
+        resp = self.query(f"{channel}.Value?", priority = SAFETY)
 
         return resp.split("=", 1)[1].strip()
     
@@ -696,7 +846,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Sensor type not specified. Please provide 'Diode', 'ROX', 'RTD', or 'Therm'.")
             return None
         
-        return self.query(f"{channel}.Sensor {sensor}")
+        return self._set_param(channel, "Sensor", sensor)
     
     
     
@@ -724,7 +874,7 @@ class TempControl_CTC100(GenericInstrument):
         else:
             range = str(range) 
         
-        return self.query(f"{channel}.Range {range}")
+        return self._set_param(channel, "Range", range)
     
     
     
@@ -761,7 +911,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Current type not specified. Please provide 'Forward', 'Reverse', 'AC', or 'Off'.")
             return None
         
-        return self.query(f"{channel}.Current {current}")
+        return self._set_param(channel, "Current", current)
     
     def set_input_power(self, power = False, channel = False): # power, Auto, Low, High
         if channel:
@@ -793,7 +943,7 @@ class TempControl_CTC100(GenericInstrument):
             print("Power setting not specified. Please provide 'Auto', 'Low', or 'High'.")
             return None
         
-        return self.query(f"{channel}.Power {power}")
+        return self._set_param(channel, "Power", power)
     
 
     
@@ -809,35 +959,162 @@ class TempControl_CTC100(GenericInstrument):
 
         return output
 
+    def update_snapshot(self, values):
+        """ Stores a full getOutput? frame as the latest snapshot """
+        with self._snapshot_lock:
+            self._snapshot = values
+            self._snapshot_time = self.clock.monotonic()
+        return
+
+    def get_snapshot(self, max_age_s = None):
+        """
+        Returns the latest frame of all channels (ordered as self.data_names).
+        Only goes to the serial port when the cached frame is older than max_age_s
+        (defaults to self.snapshot_ttl_s), so while start_logging is running the
+        frames from __data_loop__ are reused and no extra query is sent.
+        """
+        if max_age_s is None:
+            max_age_s = self.snapshot_ttl_s
+
+        ### lock held across the fetch so concurrent callers share one getOutput? round-trip
+        with self._snapshot_lock:
+            if self._snapshot is not None and self.clock.monotonic() - self._snapshot_time <= max_age_s:
+                return self._snapshot
+            try:
+                with self.io.priority(SAFETY): ### the cycle's abort checks read through here
+                    values = self.get_data("values")
+            except QueryCancelled:
+                raise
+            except Exception as e:
+                print(f"Could not refresh channel snapshot: {e}")
+                return None
+            self._snapshot = values
+            self._snapshot_time = self.clock.monotonic()
+            return values
+
+    def get_snapshot_value(self, channel = False, max_age_s = None):
+        """
+        Named read of one channel from the snapshot, e.g. get_snapshot_value("Tr").
+        Raises LinkLost when no reading can be had, so callers never compare a None.
+        """
+        if not channel:
+            print(f"Channel not specified. Please provide one of {self.data_names}.")
+            return None
+        index = self.data_index.get(str(channel).lower())
+        if index is None:
+            print(f"Invalid channel name: {channel}. Must be one of {self.data_names}.")
+            return None
+
+        snapshot = self.get_snapshot(max_age_s = max_age_s)
+        if snapshot is None and self.is_monitoring:
+            snapshot = self.__await_snapshot__(max_age_s)
+        if snapshot is None:
+            raise LinkLost(f"no reading of {channel} from {self._name}")
+        return snapshot[index]
+
+    def __await_snapshot__(self, max_age_s = None):
+        """
+        The read failed while the logging loop runs, so the link is probably being
+        brought back: retries for up to outage_wait_s instead of handing the cycle
+        a None. Raises QueryCancelled if the cancel_on event of the thread is set,
+        LinkLost if the link is still down after outage_wait_s.
+        """
+        print(f"No reading from {self._name}, waiting up to {self.outage_wait_s:.0f} s for the link")
+        cancel_event = getattr(self._local, "cancel_event", None)
+        ### real time, the outage does not follow a virtual clock
+        deadline = time.monotonic() + self.outage_wait_s
+        while self.is_monitoring and time.monotonic() < deadline:
+            if cancel_event is not None:
+                if cancel_event.wait(1.):
+                    raise QueryCancelled("waiting for the link to come back")
+            else:
+                time.sleep(1.)
+            if not self.connected:
+                continue
+            snapshot = self.get_snapshot(max_age_s = max_age_s)
+            if snapshot is not None:
+                return snapshot
+        raise LinkLost(f"{self._name} did not answer for {self.outage_wait_s:.0f} s")
+
+    def add_frame_listener(self, listener):
+        """ listener(timestamp, values) is called from the logging thread for every frame, keep it quick """
+        if listener not in self.frame_listeners:
+            self.frame_listeners.append(listener)
+        return self
+
+    def remove_frame_listener(self, listener):
+        if listener in self.frame_listeners:
+            self.frame_listeners.remove(listener)
+        return self
+
+    def __notify_frame_listeners__(self, timestamp, values):
+        for listener in list(self.frame_listeners):
+            try:
+                listener(timestamp, values)
+            except Exception as e:
+                print(f"Frame listener {listener} failed: {e}")
+        return
+
     def __data_loop__(self, refresh_s = 1.0):
+        ### samples on fixed deadlines, the query time is absorbed instead of added to the period
+        self.loop_scheduler = DeadlineScheduler(refresh_s, clock = self.clock).start()
+        failures = 0
         while self.is_monitoring:
+            t_sent = self.clock.time()
             try:
-                new_data = self.get_data("values") 
-                if self.data.shape[1] < self.data_length:
-                    self.data = np.column_stack((self.data, new_data))
-
-                else: 
-                    self.data = np.roll(self.data, -1, axis=1)
-                    self.data[:,-1] = new_data
+                with self.io.priority(BACKGROUND): ### never ahead of safety reads or control writes
+                    new_data = self.get_data("values")
             except Exception as e:
+                failures += 1
                 print(f"Error occurred: {e}")
-                print("Stopping data update loop")
-                break
+                if failures == 1: ### the outage starts here, mark it in the data
+                    self.__mark_gap__(t_sent)
+                if failures >= self.reconnect_after_failures:
+                    print(f"Lost {self._name}, reconnecting")
+                    if not self.reconnect_with_backoff(stop_event = self._monitoring_stop):
+                        print("Stopping data update loop")
+                        break
+                    failures = 0
+                    continue
+            else:
+                failures = 0
+                ### stamp the frame halfway through the round-trip
+                timestamp = 0.5 * (t_sent + self.clock.time())
+                self.update_snapshot(new_data)
+                self.buffer.append(new_data, timestamp)
+                self.__notify_frame_listeners__(timestamp, new_data)
             
-            time.sleep(refresh_s)
+            if self.loop_scheduler.wait(self._monitoring_stop):
+                break
         self.is_monitoring = False
         return
 
+    def __mark_gap__(self, timestamp):
+        """ All-NaN frame: plots break the line there, loggers and rollups record the hole """
+        gap = [float("nan")] * len(self.data_names)
+        self.gaps += 1
+        self.buffer.append(gap, timestamp)
+        self.__notify_frame_listeners__(timestamp, gap)
+        return
+
+    def loop_stats(self):
+        """ Tick count, missed ticks and lag/jitter histograms of the logging loop """
+        if self.loop_scheduler is None:
+            return None
+        return self.loop_scheduler.stats()
+
     def start_logging(self, refresh_s = 1.0):
         self.is_monitoring = True
+        self._monitoring_stop.clear()
         self.monitoring_thread = threading.Thread(target=self.__data_loop__, args=(refresh_s,), daemon=True)
         self.monitoring_thread.start()
         return 
     
-    def stop_logging(self):
+    def stop_logging(self, timeout_s = None):
         self.is_monitoring = False  
+        self._monitoring_stop.set()
         if self.monitoring_thread:
-            self.monitoring_thread.join()
+            self.monitoring_thread.join(timeout_s)
         return
     
     def set_output(self, status = False):
@@ -863,15 +1140,22 @@ class TempControl_CTC100(GenericInstrument):
     
     def set_pid_off(self):
         """Ping someone to check"""
-        self.set_pid_status(status = "Off", channel = "hpump")
-        self.set_pid_status(status = "Off", channel = "switch")
-        self.set_channel_off(channel = "hpump")
-        self.set_channel_off(channel = "switch")
+        with self.io.priority(SAFETY): ### safe state goes ahead of anything queued
+            self.set_pid_status(status = "Off", channel = "hpump")
+            self.set_pid_status(status = "Off", channel = "switch")
+            self.set_channel_off(channel = "hpump")
+            self.set_channel_off(channel = "switch")
     
         return
 
 
     def set_initial_input_config(self, cfg):
+        """ Pushes cfg["inputs"], parameters already at their value are skipped. Returns the [(key, old, new)] sent """
+        diff = self.__config_push__(lambda: self.__push_input_config__(cfg))
+        self.__report_push__("Input", diff)
+        return diff
+
+    def __push_input_config__(self, cfg):
 
         inputs = cfg.get("inputs", {})
 
@@ -909,6 +1193,12 @@ class TempControl_CTC100(GenericInstrument):
         
     
     def set_initial_output_config(self, cfg):
+        """ Pushes cfg["outputs"], parameters already at their value are skipped. Returns the [(key, old, new)] sent """
+        diff = self.__config_push__(lambda: self.__push_output_config__(cfg))
+        self.__report_push__("Output", diff)
+        return diff
+
+    def __push_output_config__(self, cfg):
         
         outputs = cfg.get("outputs", {})
 
@@ -945,13 +1235,50 @@ class TempControl_CTC100(GenericInstrument):
     
     def _sleep_or_stop(self, stop_event, seconds: float) -> bool:
  
+        seconds = max(seconds, 0.) # resumed steps can have less than nothing left to wait
         if stop_event is None:  # incase stop_event isnt defined or anything, then is sleeps normally but cannot be stopped if it does
-            time.sleep(seconds)
+            self.clock.sleep(seconds)
             return False
-        return stop_event.wait(seconds) # waits seconds, as soon as someone calls stop_event.set() during the wait, it returns true and wakes early, else it returns False after timeout. Its a condition variable / futex style trigger like wake-up system
+        return self.clock.wait(stop_event, seconds) # waits seconds, as soon as someone calls stop_event.set() during the wait, it returns true and wakes early, else it returns False after timeout. Its a condition variable / futex style trigger like wake-up system
     
-    def run_evaporation(self, stop_event=None, json_config_file = None):
-        """Run evaporation"""
+    ### step names reported to progress_callback, in the order they run
+    EVAPORATION_STEPS = ["precheck", "evap_wait", "tr_checks", "soft_abort_condensation", "soft_abort_checks"]
+    CONDENSATION_STEPS = ["cond_wait", "cond_checks"]
+    
+    def __link_lost_abort__(self, procedure, error, code):
+        """ A procedure could not read the controller any more: safe state, and its hard abort code """
+        print(f"{procedure} aborted, no readings from {self._name}: {error}")
+        try:
+            self.set_pid_off()
+        except Exception as e:
+            print(f"Could not set the PIDs off, check the controller: {e}")
+        return code
+
+    def __procedure_io__(self, asynchronous = False):
+        """ Reads, waits and writes the step procedures run on: awaitables, or blocking calls made awaitable """
+        if asynchronous:
+            return SimpleNamespace(read = self.aget_snapshot_value, sleep = self._asleep_or_stop, pid_off = self.aset_pid_off,
+                                   output = self.aset_output, pid_status = self.aset_pid_status)
+        return SimpleNamespace(read = blocking(self.get_snapshot_value), sleep = blocking(self._sleep_or_stop),
+                               pid_off = blocking(self.set_pid_off), output = blocking(self.set_output),
+                               pid_status = blocking(self.set_pid_status))
+
+    def run_evaporation(self, stop_event=None, json_config_file = None, progress_callback = None, resume_step = None, resume_elapsed_s = 0.):
+        """
+        Run evaporation
+        
+        progress_callback(step) is called every time the procedure enters one of EVAPORATION_STEPS,
+        so the caller can checkpoint it. resume_step/resume_elapsed_s restart the procedure
+        inside that step, resume_elapsed_s seconds after it began (e.g. after a crash of the host).
+        Losing the link for longer than outage_wait_s is a hard abort (4).
+        """
+        try:
+            return run_blocking(self.__evaporation__(self.__procedure_io__(), stop_event, json_config_file, progress_callback, resume_step, resume_elapsed_s))
+        except LinkLost as e:
+            return self.__link_lost_abort__("Evaporation", e, 4)
+
+    async def __evaporation__(self, io, stop_event, json_config_file, progress_callback, resume_step, resume_elapsed_s):
+        """ The evaporation steps, shared by run_evaporation and arun_evaporation through io (see __procedure_io__) """
         
         if json_config_file is None:
             print("Please provide a json config file of the conditions for your cryo. And example should be found alongside this repo.")
@@ -968,101 +1295,91 @@ class TempControl_CTC100(GenericInstrument):
         Tr_warm_high         = float(evap_cfg["Tr_warm_high_end"])      
         extra_cond_check_s   = float(evap_cfg["extra_cond_time"])
 
-        self.set_pid_off()
-        self.set_output("on")
-        t2 = time.time()
-        
-        while True: # Loop to check if the initial temperatures are met and safe to evaporate
-            if stop_event is not None and stop_event.is_set():
-                print("Evaporation stopped by user.")
-                self.set_pid_off()
-                return 1
+        resume_at = self.EVAPORATION_STEPS.index(resume_step) if resume_step in self.EVAPORATION_STEPS else 0
+        def progress(step):
+            if progress_callback is not None:
+                progress_callback(step)
+        def elapsed(step): # time already spent in the step we resume into
+            return resume_elapsed_s if self.EVAPORATION_STEPS[resume_at] == step else 0.
+
+        if resume_at >= 3: # crashed during the soft abort, pick it up where it was
+            await io.output("on")
+            return await self._evaporation_soft_abort(io, stop_event, progress, Tp_start_thresh, emergency_cond_s, Tr_warm_low, Tr_warm_high, extra_cond_check_s,
+                                                      skip_condensation = resume_at == 4, elapsed_s = resume_elapsed_s)
+
+        if resume_at == 0:
+            await io.pid_off()
+            await io.output("on")
+            progress("precheck")
+            t2 = self.clock.time()
             
-        
-            if float(self.get_channel_value(channel = "Tp")) > Tp_start_thresh: # Check if Tp is high enough to start evaporation, if yes, start evaporation PID Switch On
-                self.set_pid_status(status = "On", channel = "switch") 
-             
-                break
-            else:
-                self.set_pid_off()     
-                self.set_pid_status(status = "On", channel = "hpump") # If Tp is not high enough, condensate for 1.5h and try again 
-                
-                
-                # time.sleep(60*90)
-                if self._sleep_or_stop(stop_event, mini_cond_wait_s):
-                    print("Evaporation stopped by user during pre-condensation wait.")
-                    self.set_pid_off()
+            while True: # Loop to check if the initial temperatures are met and safe to evaporate
+                if stop_event is not None and stop_event.is_set():
+                    print("Evaporation stopped by user.")
+                    await io.pid_off()
                     return 1
                 
-                self.set_pid_off()
-                if abs(time.time() - t2) > 60*60*2: # 2 hours extra
-                    """Slack notificaiton, evap starting conditions never met please check"""
-                    return 2
-                
-        print("Starting Evaporation process")
-        
-        
-        # time.sleep(60*60) # 1h wait to let the cryo evaporate and get down to low temp
-        if self._sleep_or_stop(stop_event, evap_wait_s):
-            print("Evaporation stopped by user during 1h evaporation wait.")
-            self.set_pid_off()
-            return 1
+            
+                if await io.read(channel = "Tp") > Tp_start_thresh: # Check if Tp is high enough to start evaporation, if yes, start evaporation PID Switch On
+                    await io.pid_status(status = "On", channel = "switch") 
+                 
+                    break
+                else:
+                    await io.pid_off()     
+                    await io.pid_status(status = "On", channel = "hpump") # If Tp is not high enough, condensate for 1.5h and try again 
+                    
+                    
+                    # time.sleep(60*90)
+                    if await io.sleep(stop_event, mini_cond_wait_s):
+                        print("Evaporation stopped by user during pre-condensation wait.")
+                        await io.pid_off()
+                        return 1
+                    
+                    await io.pid_off()
+                    if abs(self.clock.time() - t2) > 60*60*2: # 2 hours extra
+                        """Slack notificaiton, evap starting conditions never met please check"""
+                        return 2
+        else:
+            await io.output("on")
+            if resume_at == 1:
+                await io.pid_status(status = "On", channel = "switch") # make sure the switch is still heating after a restart
+                    
+        if resume_at <= 1:
+            print("Starting Evaporation process")
+            progress("evap_wait")
+            
+            
+            # time.sleep(60*60) # 1h wait to let the cryo evaporate and get down to low temp
+            if await io.sleep(stop_event, evap_wait_s - elapsed("evap_wait")):
+                print("Evaporation stopped by user during 1h evaporation wait.")
+                await io.pid_off()
+                return 1
 
         
-        t0 = time.time()  # Start timer to monitor how long its been since cold -ish
+        progress("tr_checks")
+        t0 = self.clock.time() - elapsed("tr_checks")  # Start timer to monitor how long its been since cold -ish
         while True:
             
             if stop_event is not None and stop_event.is_set():
                 print("Evaporation stopped by user.")
-                self.set_pid_off()
+                await io.pid_off()
                 return 1
             
-            if float(self.get_channel_value(channel = "Tr")) < Tr_cold_thresh:  # Check if Tr is low enough, if cold enough, get out of the loop, evaporation was successful
+            if await io.read(channel = "Tr") < Tr_cold_thresh:  # Check if Tr is low enough, if cold enough, get out of the loop, evaporation was successful
                 print("Evaporation complete. Cryo is cold. Happy Experimenting!")
-                t_evaporation = time.time()
+                t_evaporation = self.clock.time()
                 return 0
             
             else:
                 # time.sleep(60*5) 
-                if self._sleep_or_stop(stop_event, extra_evap_time_s):
+                if await io.sleep(stop_event, extra_evap_time_s):
                     print("Evaporation stopped by user during Tr checks.")
-                    self.set_pid_off()
+                    await io.pid_off()
                     return 1
                 
-                if abs(time.time() - t0) > 60*60: # 60 minutes extra
+                if abs(self.clock.time() - t0) > 60*60: # 60 minutes extra
                     print("Evaporation taking too long. Aborting process.") # for the next 1h, check every 5 minutes to see if Tr is low enough, if Tr never gets to < 1K, attempt soft abort
-                    self.set_pid_off()
-                    self.set_pid_status(status = "On", channel = "hpump") # Soft abort = trying condensation procedure 
-                    # time.sleep(60*60*2) # 2 hours condensation to make sure helium is back to normal level
-                    
-                    if self._sleep_or_stop(stop_event, emergency_cond_s):
-                        print("Evaporation stopped by user during soft-abort condensation.")
-                        self.set_pid_off()
-                        return 1
-
-                    
-                    t1 = time.time()
-                    while True:
-                        if stop_event is not None and stop_event.is_set():
-                            print("Evaporation stopped by user.")
-                            self.set_pid_off()
-                            return 1
-
-                        if float(self.get_channel_value(channel = "Tp")) > Tp_start_thresh and Tr_warm_low < float(self.get_channel_value(channel = "Tr")) < Tr_warm_high: # Checking if soft abort was successful by checking if Tp is back to setpoint and that Tr is back to normal range. 
-                            """pring slack channel with alert message that evap aborted softly"""
-                            return 3
-                        else:
-                            # time.sleep(60*30)
-                            if self._sleep_or_stop(stop_event, extra_cond_check_s):
-                                print("Evaporation stopped by user during soft-abort checks.")
-                                self.set_pid_off()
-                                return 1
-
-                            if abs(time.time() - t1) > 60*60: # for the next 1h, check every 30 min to see if soft abort was successful, if not, hard abort
-                                print("resetting temp controller to safe state. Failed")
-                                self.set_pid_off()
-                                """ping slack channel with alert message that evap aborted hard"""
-                                return 4
+                    return await self._evaporation_soft_abort(io, stop_event, progress, Tp_start_thresh, emergency_cond_s, Tr_warm_low, Tr_warm_high, extra_cond_check_s)
                     
                 else:
                     continue 
@@ -1072,8 +1389,61 @@ class TempControl_CTC100(GenericInstrument):
         # Max runtime if aborts = 9h
     
     
-    def run_condensation(self, stop_event=None, json_config_file=None):
-        """Run condensation"""
+    async def _evaporation_soft_abort(self, io, stop_event, progress, Tp_start_thresh, emergency_cond_s, Tr_warm_low, Tr_warm_high, extra_cond_check_s,
+                                      skip_condensation = False, elapsed_s = 0.):
+        
+        if not skip_condensation:
+            await io.pid_off()
+            await io.pid_status(status = "On", channel = "hpump") # Soft abort = trying condensation procedure 
+            progress("soft_abort_condensation")
+            # time.sleep(60*60*2) # 2 hours condensation to make sure helium is back to normal level
+            
+            if await io.sleep(stop_event, emergency_cond_s - elapsed_s):
+                print("Evaporation stopped by user during soft-abort condensation.")
+                await io.pid_off()
+                return 1
+            elapsed_s = 0.
+
+        
+        progress("soft_abort_checks")
+        t1 = self.clock.time() - elapsed_s
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                print("Evaporation stopped by user.")
+                await io.pid_off()
+                return 1
+
+            if await io.read(channel = "Tp") > Tp_start_thresh and Tr_warm_low < await io.read(channel = "Tr") < Tr_warm_high: # Checking if soft abort was successful by checking if Tp is back to setpoint and that Tr is back to normal range. 
+                """pring slack channel with alert message that evap aborted softly"""
+                return 3
+            else:
+                # time.sleep(60*30)
+                if await io.sleep(stop_event, extra_cond_check_s):
+                    print("Evaporation stopped by user during soft-abort checks.")
+                    await io.pid_off()
+                    return 1
+
+                if abs(self.clock.time() - t1) > 60*60: # for the next 1h, check every 30 min to see if soft abort was successful, if not, hard abort
+                    print("resetting temp controller to safe state. Failed")
+                    await io.pid_off()
+                    """ping slack channel with alert message that evap aborted hard"""
+                    return 4
+    
+    
+    def run_condensation(self, stop_event=None, json_config_file=None, progress_callback = None, resume_step = None, resume_elapsed_s = 0.):
+        """
+        Run condensation
+        
+        progress_callback/resume_step/resume_elapsed_s work as in run_evaporation, with CONDENSATION_STEPS.
+        Losing the link for longer than outage_wait_s is a hard abort (5).
+        """
+        try:
+            return run_blocking(self.__condensation__(self.__procedure_io__(), stop_event, json_config_file, progress_callback, resume_step, resume_elapsed_s))
+        except LinkLost as e:
+            return self.__link_lost_abort__("Condensation", e, 5)
+
+    async def __condensation__(self, io, stop_event, json_config_file, progress_callback, resume_step, resume_elapsed_s):
+        """ The condensation steps, shared by run_condensation and arun_condensation through io (see __procedure_io__) """
         
         if json_config_file is None:
             print("Please provide a json config file of the conditions for your cryo. And example should be found alongside this repo.")
@@ -1086,40 +1456,47 @@ class TempControl_CTC100(GenericInstrument):
         Tr_warm_high         = float(cond_cfg["Tr_warm_high_end"]) 
         extra_cond_time_s     = float(cond_cfg["extra_cond_time"])  
         
+        resume_at = self.CONDENSATION_STEPS.index(resume_step) if resume_step in self.CONDENSATION_STEPS else 0
+        def progress(step):
+            if progress_callback is not None:
+                progress_callback(step)
         
         
-        self.set_output("on")
-        self.set_pid_off()
-     
-
-        self.set_pid_status(status = "On", channel = "hpump")
-        print("Starting Condensation process")
-           
-        # time.sleep(60*60*1.5) # turning condensation on and waiting 1.5h to let the cryo condense enough helium
-        if self._sleep_or_stop(stop_event, cond_wait_s):
-            print("Condensation stopped by user during initial 1.5h wait.")
-            self.set_pid_off()
-            return 1
+        await io.output("on")
+        if resume_at == 0:
+            await io.pid_off()
+         
+
+            await io.pid_status(status = "On", channel = "hpump")
+            print("Starting Condensation process")
+            progress("cond_wait")
+               
+            # time.sleep(60*60*1.5) # turning condensation on and waiting 1.5h to let the cryo condense enough helium
+            if await io.sleep(stop_event, cond_wait_s - resume_elapsed_s):
+                print("Condensation stopped by user during initial 1.5h wait.")
+                await io.pid_off()
+                return 1
 
-        t0 = time.time()
+        progress("cond_checks")
+        t0 = self.clock.time() - (resume_elapsed_s if resume_at == 1 else 0.)
         while True:
             if stop_event is not None and stop_event.is_set():
                 print("Condensation stopped by user.")
-                self.set_pid_off()
+                await io.pid_off()
                 return 1
             
-            if float(self.get_channel_value(channel = "Tp")) > Tp_end_thresh and Tr_warm_low < float(self.get_channel_value(channel = "Tr")) < Tr_warm_high: # checking if Tp is at the setpoint and that Tr is in the normal range
+            if await io.read(channel = "Tp") > Tp_end_thresh and Tr_warm_low < await io.read(channel = "Tr") < Tr_warm_high: # checking if Tp is at the setpoint and that Tr is in the normal range
                 print("Condensation complete. Cryo is ready!")
                 return 0
             else:
                 # time.sleep(60*5) # for the nect 1h30, check every 5 minutes to see if Tp and Tr are at the right values, if not, abort and send slack message.
-                if self._sleep_or_stop(stop_event, extra_cond_time_s):
+                if await io.sleep(stop_event, extra_cond_time_s):
                     print("Condensation stopped by user during checks.")
-                    self.set_pid_off()
+                    await io.pid_off()
                     return 1
-                if time.time() - t0 > 60*90: # 90 minutes extra
+                if self.clock.time() - t0 > 60*90: # 90 minutes extra
                     print("Condensation taking too long. Aborting process.")
-                    self.set_pid_off()
+                    await io.pid_off()
                     return 5
                 else:
                     continue
@@ -1129,17 +1506,196 @@ class TempControl_CTC100(GenericInstrument):
     
     
     
+    """ asyncio API: same procedures, awaiting instead of blocking a thread, see attach_async """
+
+    async def aget_data(self, type = 'values'):
+        """ get_data for asyncio, None when the controller did not answer """
+        if type == 'values':
+            output = await self.aquery("getOutput?")
+            if output is None:
+                return None
+            output = [float(x) for x in output.replace(' ','').split(',')]
+        elif type == 'names':
+            output = await self.aquery("getOutputNames?")
+            if output is None:
+                return None
+            output = [x for x in output.replace(' ','').split(',')]
+        return output
+
+    async def aget_channel_value(self, channel = False):
+        index = self.data_index.get(str(channel).lower()) if channel else None
+        if index is None:
+            print(f"Invalid channel name: {channel}. Must be one of {self.data_names}.")
+            return None
+        resp = await self.aquery(f"{self.data_names[index]}.Value?")
+        if resp is None:
+            return None
+        return resp.split("=", 1)[1].strip()
+
+    async def __aget_snapshot__(self, max_age_s):
+        with self._snapshot_lock:
+            snapshot, snapshot_time = self._snapshot, self._snapshot_time
+        if snapshot is not None and self.clock.monotonic() - snapshot_time <= max_age_s:
+            return snapshot
+        try:
+            snapshot = await self.aget_data("values")
+        except Exception as e:
+            print(f"Could not refresh channel snapshot: {e}")
+            return None
+        if snapshot is not None:
+            self.update_snapshot(snapshot)
+        return snapshot
+
+    async def aget_snapshot_value(self, channel = False, max_age_s = None):
+        """
+        get_snapshot_value for asyncio, shares the snapshot with the threaded API.
+        While alogging_loop runs a failed read waits up to outage_wait_s for the link,
+        then, as without the loop, raises LinkLost.
+        """
+        index = self.data_index.get(str(channel).lower()) if channel else None
+        if index is None:
+            print(f"Invalid channel name: {channel}. Must be one of {self.data_names}.")
+            return None
+        if max_age_s is None:
+            max_age_s = self.snapshot_ttl_s
+        snapshot = await self.__aget_snapshot__(max_age_s)
+        if snapshot is None and self.is_alogging:
+            print(f"No reading from {self._name}, waiting up to {self.outage_wait_s:.0f} s for the link")
+            deadline = time.monotonic() + self.outage_wait_s ### real time, as in __await_snapshot__
+            while snapshot is None and self.is_alogging and time.monotonic() < deadline:
+                await asyncio.sleep(1.)
+                if self.connected:
+                    snapshot = await self.__aget_snapshot__(max_age_s)
+        if snapshot is None:
+            raise LinkLost(f"no reading of {channel} from {self._name}")
+        return snapshot[index]
+
+    async def _aset_param(self, channel, param, value):
+        key = f"{channel}.{param}"
+        response = await self.aquery(f"{key} {value}")
+        if response is not None:
+            self.shadow.set(key, value)
+        else:
+            self.shadow.invalidate(key = key)
+        return response
+
+    async def aset_pid_status(self, status, channel):
+        return await self._aset_param(channel, "PID.Mode", "On" if str(status).lower() == "on" else "Off")
+
+    async def aset_output(self, status):
+        return await self.aquery(f"outputEnable {'on' if str(status).lower() == 'on' else 'off'}")
+
+    async def aset_pid_off(self):
+        for channel in ["hpump", "switch"]:
+            await self.aset_pid_status("Off", channel)
+        for channel in ["hpump", "switch"]:
+            self.shadow.invalidate(prefix = f"{channel}.PID.Mode")
+            await self.aquery(f"{channel}.Off")
+        return
+
+    async def aprobe(self):
+        return await self.aquery("getOutputNames?", timeout_s = 5.) is not None
+
+    async def aafter_reconnect(self):
+        """ after_reconnect for asyncio: every shadowed parameter is written again """
+        if self.aio is None:
+            return await asyncio.to_thread(self.after_reconnect)
+        with self._snapshot_lock:
+            self._snapshot = None
+        wanted = self.shadow.items()
+        self.shadow.clear()
+        for key, value in wanted.items():
+            channel, param = key.split(".", 1)
+            await self._aset_param(channel, param, value)
+        print(f"Reconnect config: {len(wanted)} parameter(s) written")
+        return
+
+    async def alogging_loop(self, refresh_s = 1.0, stop_event = None):
+        """
+        __data_loop__ as a coroutine: fills the same buffer/snapshot and calls the frame listeners.
+        A failed poll writes a NaN gap frame, reconnect_after_failures in a row reconnect with backoff.
+        """
+        scheduler = DeadlineScheduler(refresh_s, clock = self.clock).start()
+        self.loop_scheduler = scheduler
+        self.is_alogging = True
+        failures = 0
+        try:
+            while True:
+                t_sent = self.clock.time()
+                try:
+                    new_data = await self.aget_data("values")
+                except Exception as e:
+                    print(f"Error occurred: {e}")
+                    new_data = None
+                if new_data is None:
+                    failures += 1
+                    if failures == 1: ### the outage starts here, mark it in the data
+                        self.__mark_gap__(t_sent)
+                    if failures >= self.reconnect_after_failures:
+                        print(f"Lost {self._name}, reconnecting")
+                        if not await self.areconnect_with_backoff(stop_event = stop_event):
+                            print("Stopping async data update loop")
+                            return
+                        failures = 0
+                        continue
+                else:
+                    failures = 0
+                    timestamp = 0.5 * (t_sent + self.clock.time())
+                    self.update_snapshot(new_data)
+                    self.buffer.append(new_data, timestamp)
+                    self.__notify_frame_listeners__(timestamp, new_data)
+                if await scheduler.await_next(stop_event):
+                    return
+        finally:
+            self.is_alogging = False
+
+    async def _asleep_or_stop(self, stop_event, seconds):
+        """ _sleep_or_stop for asyncio, stop_event is an asyncio.Event (or None) """
+        seconds = max(seconds, 0.)
+        if stop_event is None:
+            await self.clock.await_event(asyncio.Event(), seconds)
+            return False
+        return await self.clock.await_event(stop_event, seconds)
+
+    async def __alink_lost_abort__(self, procedure, error, code):
+        print(f"{procedure} aborted, no readings from {self._name}: {error}")
+        try:
+            await self.aset_pid_off()
+        except Exception as e:
+            print(f"Could not set the PIDs off, check the controller: {e}")
+        return code
+
+    async def arun_evaporation(self, stop_event = None, json_config_file = None, progress_callback = None, resume_step = None, resume_elapsed_s = 0.):
+        """ run_evaporation as a coroutine, the same steps (__evaporation__) awaited instead of blocking """
+        try:
+            return await self.__evaporation__(self.__procedure_io__(asynchronous = True), stop_event, json_config_file,
+                                              progress_callback, resume_step, resume_elapsed_s)
+        except LinkLost as e:
+            return await self.__alink_lost_abort__("Evaporation", e, 4)
+
+    async def arun_condensation(self, stop_event = None, json_config_file = None, progress_callback = None, resume_step = None, resume_elapsed_s = 0.):
+        """ run_condensation as a coroutine, the same steps (__condensation__) awaited instead of blocking """
+        try:
+            return await self.__condensation__(self.__procedure_io__(asynchronous = True), stop_event, json_config_file,
+                                               progress_callback, resume_step, resume_elapsed_s)
+        except LinkLost as e:
+            return await self.__alink_lost_abort__("Condensation", e, 5)
+
+
     def force_abort(self):
         
-        self.set_pid_off()
-        self.set_output("off")
-        self.query("abort")
+        with self.io.priority(SAFETY):
+            self.set_pid_off()
+            self.set_output("off")
+            self.query("abort")
+        self.shadow.invalidate(suffix = ".PID.Mode")
         print("Aborted any running process and set to safe state.")
         return
     
     
     def kill_all(self):
-        return self.query("kill.all")
+        self.shadow.invalidate(suffix = ".PID.Mode")
+        return self.query("kill.all", priority = SAFETY)
     
     
     
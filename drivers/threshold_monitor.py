@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+import itertools
+import threading
+from collections import deque
+
+
+'''
+Streaming threshold watcher for instrument frames
+
+ThresholdMonitor.push is a frame listener (timestamp, values), so attached to
+TempControl_CTC100.add_frame_listener it sees every sample of __data_loop__
+and fires callbacks within one sample period of a crossing.
+
+    monitor = ThresholdMonitor(tc.data_names)
+    tc.add_frame_listener(monitor.push)
+    monitor.add_level_trigger("Tr", 3.0, on_runout, direction = "above", hysteresis = 0.2)
+    monitor.add_rate_trigger("Tr", 0.01, on_fast_warmup, direction = "rising", window_s = 30)
+
+Callbacks get (trigger, value, timestamp) and run on the acquisition thread,
+so they should only hand work over (set an event, schedule a timer).
+'''
+
+
+class Trigger:
+
+    def __init__(self, trigger_id, kind, channel, index, threshold, callback, direction,
+                 hysteresis, once, window_s, name):
+        self.id = trigger_id
+        self.kind = kind ### "level" or "rate"
+        self.channel = channel
+        self.index = index
+        self.threshold = float(threshold)
+        self.callback = callback
+        self.direction = direction
+        self.hysteresis = float(hysteresis)
+        self.once = once
+        self.window_s = window_s
+        self.name = name if name else f"{channel} {kind} {direction} {threshold}"
+        self.armed = True
+        self.fired = 0
+        self.history = deque() ### (timestamp, value) kept for rate triggers
+
+    def __repr__(self):
+        return f"Trigger({self.name})"
+
+    def __crossed__(self, value):
+        if self.direction in ["above", "rising"]:
+            return value > self.threshold
+        return value < self.threshold
+
+    def __rearmed__(self, value):
+        ### only re-arm once the value is back past the threshold by the hysteresis band
+        if self.direction in ["above", "rising"]:
+            return value < self.threshold - self.hysteresis
+        return value > self.threshold + self.hysteresis
+
+    def evaluate(self, timestamp, value):
+        """ Returns the value that fired the trigger (level or rate), else None """
+        if value != value: ### NaN, e.g. a gap in the data
+            return None
+
+        if self.kind == "rate":
+            self.history.append((timestamp, value))
+            window_s = self.window_s if self.window_s else 0.
+            while len(self.history) > 2 and timestamp - self.history[1][0] >= window_s:
+                self.history.popleft()
+            if len(self.history) < 2:
+                return None
+            t0, v0 = self.history[0]
+            if timestamp <= t0:
+                return None
+            value = (value - v0) / (timestamp - t0)
+
+        if self.armed and self.__crossed__(value):
+            self.armed = False
+            return value
+        if not self.armed and self.__rearmed__(value):
+            self.armed = True
+        return None
+
+
+class ThresholdMonitor:
+
+    def __init__(self, names, verbose = False):
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self.triggers = {}
+        self.set_names(names)
+
+    def set_names(self, names):
+        self.names = list(names)
+        self.index = {name.lower(): i for i, name in enumerate(self.names)}
+        return self
+
+    def _add_trigger(self, kind, channel, threshold, callback, direction, hysteresis, once, window_s, name):
+        index = self.index.get(str(channel).lower())
+        if index is None:
+            print(f"Invalid channel name: {channel}. Must be one of {self.names}.")
+            return None
+        trigger_id = next(self._ids)
+        with self._lock:
+            self.triggers[trigger_id] = Trigger(trigger_id, kind, channel, index, threshold, callback,
+                                                direction, hysteresis, once, window_s, name)
+        return trigger_id
+
+    def add_level_trigger(self, channel, level, callback, direction = "above", hysteresis = 0.,
+                          once = False, name = None):
+        """
+        Fires callback when channel goes above (or below) level. It re-arms
+        only after the value came back by more than hysteresis, so noise
+        around the level does not fire it on every sample.
+        """
+        if direction not in ["above", "below"]:
+            print(f"Invalid direction: {direction}. Must be 'above' or 'below'.")
+            return None
+        return self._add_trigger("level", channel, level, callback, direction, hysteresis, once, None, name)
+
+    def add_rate_trigger(self, channel, rate_per_s, callback, direction = "rising", hysteresis = 0.,
+                         window_s = None, once = False, name = None):
+        """
+        Fires callback when d(channel)/dt, taken over the last window_s seconds
+        (between consecutive samples if None), is faster than rate_per_s.
+        direction "rising" compares rate > rate_per_s, "falling" rate < rate_per_s
+        (so pass a negative rate_per_s for cooling).
+        """
+        if direction not in ["rising", "falling"]:
+            print(f"Invalid direction: {direction}. Must be 'rising' or 'falling'.")
+            return None
+        return self._add_trigger("rate", channel, rate_per_s, callback, direction, hysteresis, once, window_s, name)
+
+    def remove_trigger(self, trigger_id):
+        with self._lock:
+            self.triggers.pop(trigger_id, None)
+        return self
+
+    def clear(self):
+        with self._lock:
+            self.triggers = {}
+        return self
+
+    def push(self, timestamp, values):
+        """ Frame listener, evaluates every trigger against the new sample """
+        with self._lock:
+            triggers = list(self.triggers.values())
+
+        for trigger in triggers:
+            try:
+                value = float(values[trigger.index])
+            except (IndexError, TypeError, ValueError):
+                continue
+            fired_value = trigger.evaluate(timestamp, value)
+            if fired_value is None:
+                continue
+
+            trigger.fired += 1
+            if self.verbose:
+                print(f"{trigger.name} fired at {fired_value}")
+            if trigger.once:
+                self.remove_trigger(trigger.id)
+            try:
+                trigger.callback(trigger, fired_value, timestamp)
+            except Exception as e:
+                print(f"Threshold callback for {trigger.name} failed: {e}")
+        return
@@ -0,0 +1,50 @@
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("pyqtgraph") ### cryocycle_datalogger pulls in the live plotter
+pytest.importorskip("PyQt5")
+
+from cryocycle_datalogger import CryoCycler
+from local_webhook import LocalWebhookServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_auto_cycle_runs_a_condensation_on_the_simulator(tmp_path):
+    config_dir = tmp_path / "config"
+    shutil.copytree(os.path.join(ROOT, "config", "ctc100"), config_dir / "ctc100")
+    start = datetime.datetime.now().replace(hour = 19, minute = 55, second = 0, microsecond = 0).timestamp()
+    config = {"logging": {"relative_dir": str(tmp_path / "log")},
+              "liveplotter": {"refresh_rate": 1},
+              "tempcontroller": {"simulated": {"start": start, "rate": 1000}, "macro_dir": "ctc100/macros"}}
+
+    with LocalWebhookServer() as hook:
+        with open(config_dir / "slack.json", 'w') as f:
+            json.dump({"slack_url": hook.url, "error_code_messages": {"0": ""}}, f)
+        cycler = CryoCycler(config_dir = str(config_dir), config = config, liveplotter = object())
+        stop_event = threading.Event()
+        thread = threading.Thread(target = cycler.run_ctc100_automatic_cycle_thread, daemon = True,
+                                  args = (stop_event, 7, 20, "ctc100/matterhorn/matterhorn_configuration.json", "slack.json"))
+        try:
+            thread.start()
+            checkpoint = tmp_path / "log" / "auto_cycle_checkpoint.json"
+            deadline = time.time() + 60
+            while time.time() < deadline and thread.is_alive():
+                if checkpoint.exists() and json.loads(checkpoint.read_text()).get("cond_ran_today"):
+                    break
+                time.sleep(0.2)
+            assert thread.is_alive()
+            assert json.loads(checkpoint.read_text())["cond_ran_today"]
+            assert hook.received == [] ### condensation ended with 0, nothing alerted
+        finally:
+            stop_event.set()
+            cycler._cycle_scheduler.wake()
+            thread.join(10)
+            cycler.tempcontroller.stop_logging()
+            cycler.close()
@@ -0,0 +1,69 @@
+import asyncio
+import json
+import os
+import threading
+
+import pytest
+
+from simulated_ctc100 import simulated_tempcontroller, VirtualClock
+from generic_instrument_dependencies.async_transport import InProcessAsyncTransport
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      "config", "ctc100", "matterhorn", "matterhorn_configuration.json")
+
+
+@pytest.fixture
+def config():
+    with open(CONFIG, 'r') as f:
+        return json.load(f)
+
+
+def run(procedure, config, **model_kwargs):
+    """ Runs procedure on a simulated controller in step mode, returns (code, controller) """
+    tc = simulated_tempcontroller(clock = VirtualClock(), **model_kwargs)
+    code = getattr(tc, procedure)(stop_event = threading.Event(), json_config_file = config)
+    return code, tc
+
+
+SCENARIOS = [
+    ("run_evaporation", {}, 0),
+    ("run_evaporation", {"Tp": 10}, 0),                                  ### pump heats up first
+    ("run_evaporation", {"pump_max_K": 30, "Tp": 10}, 2),                ### broken pump heater, precheck fails
+    ("run_evaporation", {"switch_max_K": 10}, 3),                        ### broken heat switch, soft abort
+    ("run_evaporation", {"switch_max_K": 10, "pump_max_K": 30}, 4),      ### both, hard abort
+    ("run_condensation", {"Tp": 5, "helium": 0}, 0),
+    ("run_condensation", {"Tp": 5, "helium": 0, "pump_max_K": 30}, 5),   ### broken pump heater, hard abort
+]
+
+
+@pytest.mark.parametrize("procedure, model_kwargs, code", SCENARIOS)
+def test_procedures(config, procedure, model_kwargs, code):
+    assert run(procedure, config, **model_kwargs)[0] == code
+
+
+@pytest.mark.parametrize("procedure, model_kwargs, code", SCENARIOS)
+def test_async_procedures(config, procedure, model_kwargs, code):
+    tc = simulated_tempcontroller(clock = VirtualClock(), **model_kwargs)
+    tc.attach_async(InProcessAsyncTransport(tc.client))
+    assert asyncio.run(getattr(tc, "a" + procedure)(asyncio.Event(), config)) == code
+
+
+def test_evaporation_cools_the_fridge(config):
+    code, tc = run("run_evaporation", config)
+    assert code == 0
+    assert tc.get_snapshot_value("Tr") < 1.
+
+
+def test_helium_runout(config):
+    code, tc = run("run_evaporation", config)
+    assert code == 0
+    tc.clock.advance(25 * 3600) ### the model catches up on the next reading
+    assert tc.get_snapshot_value("Tr") > config["temperature_conditions"]["cryo_cycle"]["evap_monitering_temp"]
+    assert tc.client.helium == 0
+
+
+def test_step_mode_takes_no_wall_time(config):
+    clock = VirtualClock()
+    start = clock.time()
+    clock.sleep(9 * 3600)
+    assert clock.time() - start == pytest.approx(9 * 3600)
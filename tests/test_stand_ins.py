@@ -0,0 +1,93 @@
+import time
+
+from simulated_ctc100 import SimulatedCTC100Server
+from tempcontroller_ctc100 import TempControl_CTC100
+from local_webhook import LocalWebhookServer
+from local_smtp import LocalSMTPServer
+from slack import Slack, SMTPSink, LogFileSink
+from alert_router import AlertRouter
+
+
+def test_ctc100_over_tcp():
+    server = SimulatedCTC100Server().start()
+    tc = TempControl_CTC100(server.address, "CTC100 over tcp")
+    try:
+        assert tc.data_names == server.simulator.NAMES
+        assert len(tc.get_data()) == len(tc.data_names)
+        assert float(tc.get_channel_value("Tr")) > 0 ### raw reply of <ch>.Value?
+    finally:
+        tc.close()
+        server.stop()
+
+
+def test_ctc100_reconnects_after_the_server_comes_back():
+    server = SimulatedCTC100Server().start()
+    port = int(server.address.rsplit(":", 1)[1])
+    tc = TempControl_CTC100(server.address, "CTC100 over tcp")
+    try:
+        server.stop()
+        assert tc.query("getOutput?") is None
+        server = SimulatedCTC100Server(port = port).start()
+        deadline = time.time() + 10
+        while tc.query("getOutput?") is None and time.time() < deadline:
+            time.sleep(0.1)
+        assert tc.query("getOutput?") is not None
+        assert tc.client.reconnects >= 1
+    finally:
+        tc.close()
+        server.stop()
+
+
+def test_webhook_retries_and_info_codes_stay_quiet():
+    with LocalWebhookServer() as hook:
+        config = {"slack_url": hook.url, "error_code_messages": {"0": "", "4": "hard abort"}}
+        slack = Slack("config")
+        try:
+            hook.fail_next(2, 500)
+            slack.send_message_to_slack(4, config)
+            slack.send_message_to_slack(0, config) ### info code with an empty message
+            slack.send_message_to_slack(6, config) ### no message, fallback text
+            assert hook.wait_for(2, 10)
+            texts = sorted(payload["text"] for _, payload, _ in hook.received)
+            assert texts == ["Cryo cycle reported code 6", "hard abort"]
+            assert hook.attempts >= 4
+        finally:
+            slack.close()
+
+
+def test_smtp_sink_retries():
+    with LocalSMTPServer() as smtp:
+        sink = SMTPSink("email", host = smtp.host, port = smtp.port, recipients = ["oncall@lab"], retry_s = 0.05)
+        try:
+            smtp.fail_next(1)
+            sink.send({"severity": "critical", "text": "Evaporation hard aborted", "time": "now"})
+            assert smtp.wait_for(1, 10)
+            message = smtp.received[0][2]
+            assert message["To"] == "oncall@lab"
+            assert message["Subject"] == "[cryocycle] CRITICAL: Evaporation hard aborted"
+            assert sink.stats()["failed_attempts"] >= 1
+        finally:
+            sink.close()
+
+
+def test_logfile_sinks_write_under_each_cryostat(tmp_path):
+    config = {"error_code_messages": {"4": "hard abort"}, "sinks": {"log": {"type": "logfile", "path": "alerts.log"}}}
+    slack = Slack("config") ### shared, as under CryostatSupervisor
+    routers = [AlertRouter(slack, name = name, log_dir = str(tmp_path / name)) for name in ["a", "b"]]
+    try:
+        for router in routers:
+            router.send_message_to_slack(4, config)
+    finally:
+        slack.close()
+        for router in routers:
+            router.close()
+    for name in ["a", "b"]:
+        assert (tmp_path / name / "alerts.log").read_text().count("hard abort") == 1
+
+
+def test_only_webhooks_open_an_http_session(tmp_path):
+    sink = LogFileSink("log", str(tmp_path / "alerts.log"))
+    try:
+        assert sink.dispatcher.session is None
+    finally:
+        sink.close()